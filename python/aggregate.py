@@ -1,13 +1,19 @@
 import pandas as pd
 
 import json
-import re
-from datetime import datetime, timezone
+import os
+from array import array
+from collections import Counter
 
 import pandas as pd
 import numpy as np
 
+from buckets import group as group_buckets
+from cache import cached_frame
+from clean import add_time_columns, clean_listens
+from codec import CODEC_VERSION, RECORD_DTYPE, encode_listens, to_text, track_listens
 from firebase import FireManager
+from reader import ALL_SONGS_PATH, LISTEN_COLUMNS, iter_history, iter_json_object, iter_ndjson_documents
 
 df_dtypes = {
     'ts':str,
@@ -35,6 +41,21 @@ df_dtypes = {
     'episode_show_name':str
 }
 
+INFO_SOURCES = [
+    ALL_SONGS_PATH,
+    "../data/2020_year_data/StreamingHistory1.json",
+    "../data/2020_year_data/StreamingHistory2.json",
+    "../data/2020_year_data/StreamingHistory3.json",
+    "final_track_ids.csv",
+    "tracks_info_final.json",
+]
+# The songs collection as exported by export.py. get_fb_info also reads a firebase_songs.json from download_songs.
+FB_SNAPSHOT_PATH = "snapshot/songs.ndjson"
+FB_INFO_SOURCES = [FB_SNAPSHOT_PATH]
+
+# The timestamp of the newest listen in the agg_* files, which incremental.py merges newer listens after
+STATE_FILE = "agg_state.json"
+
 def save_dict_json(my_dict, filename):
     with open(f"{filename}.json", "w") as f:
         f.write(json.dumps(my_dict))
@@ -43,18 +64,81 @@ def read_dict_json(filename):
     with open(f"{filename}.json", "r") as f:
         return json.load(f)
 
+def _listen_keys(info):
+    """ Gets a key for each listen that tells apart the listens with the same timestamp """
+    return (info["track_id"].astype(str) + ":" + info["ms_played"].astype(np.int64).astype(str)).tolist()
+
+def read_high_water_mark(directory="."):
+    """ Reads the timestamp of the newest listen in the agg_* files and the keys of the listens at it
+
+    Parameters
+    ----------
+    directory : str (default=".") - the directory of the agg_* files
+
+    Returns
+    -------
+    tuple (float, list) - the high water mark, or -inf if no aggregate has been built yet, and the key of each
+    listen at it, see save_high_water_mark
+    """
+    path = os.path.join(directory, STATE_FILE)
+    if not os.path.exists(path):
+        return float("-inf"), []
+    with open(path, "r") as f:
+        state = json.load(f)
+    return state["high_water_mark"], state.get("boundary", [])
+
+def save_high_water_mark(info, directory="."):
+    """ Saves the timestamp of the newest listen in info and the keys of the listens at it. Timestamps only have
+    minute resolution, so the keys tell which listens at the mark were merged and which arrived later.
+
+    Parameters
+    ----------
+    info : pd.DataFrame - every listen in the agg_* files
+
+    directory : str (default=".") - the directory of the agg_* files
+
+    Returns
+    -------
+    None
+    """
+    high_water_mark = float(info["timestamp"].max())
+    boundary = _listen_keys(info[info["timestamp"] == high_water_mark])
+    with open(os.path.join(directory, STATE_FILE), "w") as f:
+        f.write(json.dumps({"high_water_mark": high_water_mark, "boundary": boundary}))
+
+def new_listens(info, high_water_mark, boundary):
+    """ Finds the listens in info that are not yet in the agg_* files: those after the high water mark and those at
+    it beyond the ones with each key in boundary
+
+    Parameters
+    ----------
+    info : pd.DataFrame - the listens
+
+    high_water_mark : float - the timestamp of the newest listen in the agg_* files
+
+    boundary : list - the keys of the listens at high_water_mark in the agg_* files
+
+    Returns
+    -------
+    np.ndarray - whether each listen is new
+    """
+    at_mark = (info["timestamp"] == high_water_mark).values
+    merged = Counter(boundary)
+    is_new = (info["timestamp"] > high_water_mark).to_numpy(copy=True)
+    for idx, key in zip(np.flatnonzero(at_mark), _listen_keys(info[at_mark])):
+        if merged[key] > 0:
+            merged[key] -= 1
+        else:
+            is_new[idx] = True
+    return is_new
+
 def read_bulk_tracks():
-    f = open("../data/AllSongs.json", "r")
-    rows = []
-    for row in f:
-        r = json.loads(row) 
-        rows.append(r)
-    f.close()
-    rows.reverse()
-    df = pd.DataFrame(rows)
-    df = df.rename(columns={'master_metadata_track_name':'track_name', 'master_metadata_album_artist_name':'artist_name', 'ts':'end_time'})
-    df = df.loc[:, ['track_name', 'artist_name', 'ms_played', 'end_time']]
-    return df.dropna()
+    chunks = []
+    for chunk in iter_history(columns=LISTEN_COLUMNS, reverse=True):
+        chunk = chunk.rename(columns={'master_metadata_track_name':'track_name', 'master_metadata_album_artist_name':'artist_name', 'ts':'end_time'})
+        chunk = chunk.loc[:, ['track_name', 'artist_name', 'ms_played', 'end_time']]
+        chunks.append(chunk.dropna())
+    return pd.concat(chunks, ignore_index=True)
 
 def read_2020_tracks():
     data = []
@@ -75,31 +159,11 @@ def write_df_dict(df, path):
         f.write(json_str)
 
 def group(tracks_cleaned):
-    plays = pd.Series(np.ones(tracks_cleaned.shape[0]).astype(int), name="play_count")
-    tracks = pd.concat((tracks_cleaned, plays), axis=1)
-    tracks = pd.get_dummies(tracks, columns=["year", "hour", "month", "year_month"])
-    tracks_songs = tracks.drop(columns=["artist_name", "day", "minute", "play_id"])
-    tracks_songs = tracks_songs.groupby('track_name').sum().astype(int)
-    tracks_artists = tracks.drop(columns=["track_name", "day", "minute", "play_id"])
-    tracks_artists = tracks_artists.groupby('artist_name').sum().astype(int)
-    return tracks_songs, tracks_artists
+    tracks_songs, tracks_artists = group_buckets(tracks_cleaned)
+    return tracks_songs.astype(int), tracks_artists.astype(int)
 
 def clean(df):
-    df['track_name'] = df['track_name'].astype(str)
-    df['artist_name'] = df['artist_name'].astype(str)
-    df['ms_played'] = pd.to_numeric(df['ms_played'])
-    df['end_time'] = df['end_time'].apply(lambda date : re.sub(r':[0-9][0-9] UTC', '', date))
-    df['end_time'] = df['end_time'].apply(lambda date_str : datetime.strptime(date_str, '%Y-%m-%d %H:%M'))
-    df['year'] = df['end_time'].apply(lambda dt : dt.date().year)
-    df['month'] = df['end_time'].apply(lambda dt : dt.date().month)
-    df['day'] = df['end_time'].apply(lambda dt : dt.date().day)
-    df['weekday'] = df['end_time'].apply(lambda dt : dt.weekday())
-    df['hour'] = df['end_time'].apply(lambda dt : dt.time().hour)
-    df['minute'] = df['end_time'].apply(lambda dt : dt.time().minute)
-    df['year_month'] = df.apply(lambda row : f"{row['year']}{0 if row['month'] < 10 else ''}{row['month']}", axis=1)
-    df['timestamp'] = df['end_time'].apply(lambda dt : int(dt.timestamp()))
-    df = df.sort_values(by='end_time').reset_index(drop=True)
-    return df.drop(columns=['end_time'])  
+    return clean_listens(df)
 
 def get_artist_songs(tracks):
     tracks = tracks.loc[:, ["artist_name", "track_name"]]
@@ -107,192 +171,311 @@ def get_artist_songs(tracks):
     tracks = tracks.groupby("artist_name")['track_name'].apply(list)
     return tracks
 
+def report_missing(names, path):
+    """ Prints how many listens could not be resolved and saves the unique names, one per line, to path """
+    names = pd.unique(names)
+    print(f"{len(names)} tracks could not be resolved, see {path}")
+    with open(path, "w", encoding="utf-8") as f:
+        for name in names:
+            f.write(f"{name}\n")
+
+def attach_track_info(cleaned_tracks, ids, info):
+    """ Joins the track id and its metadata onto each listen with two hash lookups on a precomputed key column.
+    Listens whose name has no id are saved to missing_ids.txt in the no_results.txt format and listens whose id has
+    no metadata to missing_info.txt, instead of failing part way through.
+
+    Parameters
+    ----------
+    cleaned_tracks : pd.DataFrame - the cleaned listens with track_name and artist_name columns
+
+    ids : pd.DataFrame - the track_id column indexed by "{track_name} {artist_name}"
+
+    info : pd.DataFrame - the artist_id, artist_name, duration_ms and track_name columns indexed by track_id
+
+    Returns
+    -------
+    pd.DataFrame - the listens with the names replaced by the track_id and its metadata
+    """
+    keys = cleaned_tracks["track_name"].astype(str) + " " + cleaned_tracks["artist_name"].astype(str)
+    id_map = ids.loc[~ids.index.duplicated(), "track_id"]
+    cleaned_tracks = cleaned_tracks.assign(track_id=keys.map(id_map).values)
+
+    no_id = cleaned_tracks["track_id"].isna()
+    if no_id.any():
+        missing = cleaned_tracks.loc[no_id, "track_name"].astype(str) + " $BY$ " + cleaned_tracks.loc[no_id, "artist_name"].astype(str) + " $FROM$ "
+        report_missing(missing.values, "missing_ids.txt")
+    cleaned_tracks = cleaned_tracks[~no_id & (cleaned_tracks["track_id"] != "none")]
+    cleaned_tracks = cleaned_tracks.drop(columns=["track_name", "artist_name"])
+
+    meta_columns = ["artist_id", "artist_name", "duration_ms", "track_name"]
+    info = info.loc[~info.index.duplicated(), meta_columns]
+    no_info = ~cleaned_tracks["track_id"].isin(info.index)
+    if no_info.any():
+        report_missing(cleaned_tracks.loc[no_info, "track_id"].values, "missing_info.txt")
+        cleaned_tracks = cleaned_tracks[~no_info]
+    meta = info.reindex(cleaned_tracks["track_id"].values)
+    return cleaned_tracks.assign(**{column: meta[column].values for column in meta_columns})
+
 def get_info(ids):
     info = pd.read_json("tracks_info_final.json", orient="index", encoding="utf-8")
     bulk_tracks = read_bulk_tracks()
     year_tracks = read_2020_tracks()
     tracks = pd.concat((bulk_tracks, year_tracks))
     cleaned_tracks = clean(tracks)
+    return attach_track_info(cleaned_tracks, ids, info)
+
+TIME_FIELDS = ["hour", "day", "weekday", "month", "year"]
+
+def _group_rows(keys):
+    """ Groups rows by key in one sort. Returns each row's key code, the sorted unique keys, the row order listing
+    each key's rows contiguously (in frame order), and where each key's run starts """
+    codes, uniques = pd.factorize(keys, sort=True)
+    order = np.argsort(codes, kind="mergesort")
+    counts = np.bincount(codes, minlength=len(uniques))
+    starts = np.cumsum(counts) - counts
+    return codes, list(uniques), order, starts
+
+def _extreme_rows(codes, timestamps, starts, latest=False):
+    """ Returns the first row in frame order with each key's earliest (or latest) timestamp """
+    timestamps = -timestamps if latest else timestamps
+    return np.lexsort((timestamps, codes))[starts]
+
+def _group_sums(values, order, starts):
+    """ Sums values over each key's run of rows """
+    if len(order) == 0:
+        return []
+    return np.add.reduceat(values[order], starts).tolist()
+
+def _time_infos(info, rows):
+    values = [info[field].values[rows].astype(np.int64).tolist() for field in TIME_FIELDS]
+    return [dict(zip(TIME_FIELDS, row)) for row in zip(*values)]
+
+def _agg_history(info, codes, track_ids, track_artists):
+    # One row per (track, month) in the same order the per-track loop used to visit them
+    pairs = pd.DataFrame({
+        "track": codes,
+        "year_month": info["year_month"].astype(str).values,
+        "ms_played": info["ms_played"].values,
+        "count": 1,
+    }).groupby(["track", "year_month"]).sum().reset_index()
+    pairs["ms_played"] = pairs["ms_played"].astype(np.int64)
+    pairs["track_id"] = np.asarray(track_ids, dtype=object)[pairs["track"].values]
+    pairs["artist_id"] = np.asarray(track_artists, dtype=object)[pairs["track"].values]
+
+    months = pairs.groupby("year_month", sort=False)
+    listen_counts = months["count"].sum()
+    listen_times = months["ms_played"].sum()
+    uq_songs = months["track_id"].agg(list)
+    uq_artists = pairs.drop_duplicates(subset=["year_month", "artist_id"]).groupby("year_month")["artist_id"].agg(list)
 
-    cleaned_tracks["track_id"] = cleaned_tracks.apply(lambda row : ids.loc[f"{row['track_name']} {row['artist_name']}", "track_id"], axis=1)
-    cleaned_tracks = cleaned_tracks[cleaned_tracks["track_id"] != "none"]
-    cleaned_tracks = cleaned_tracks.drop(columns=["track_name", "artist_name"])
-    cleaned_tracks[["artist_id", "artist_name", "duration_ms", "track_name"]] = cleaned_tracks["track_id"].apply(lambda id : info.loc[id, :])
-    return cleaned_tracks
+    history = {}
+    for year_month in listen_counts.index:
+        year = int(year_month[0:4])
+        month = int(year_month[4:6])
+        if year not in history:
+            history[year] = {}
+        history[year][month] = {
+            "listen_count": int(listen_counts[year_month]),
+            "listen_time": int(listen_times[year_month]),
+            "uq_artists": uq_artists[year_month],
+            "uq_songs": uq_songs[year_month],
+        }
+    return history
 
 def agg_tracks(info):
-    tracks = {}
-    history = {}
+    info = info.reset_index(drop=True)
+    codes, track_ids, order, starts = _group_rows(info["track_id"].values)
+    timestamps = info["timestamp"].values
+    first_rows = order[starts]
+    first_listens = _time_infos(info, _extreme_rows(codes, timestamps, starts))
+    last_listens = _time_infos(info, _extreme_rows(codes, timestamps, starts, latest=True))
+    artist_ids = info["artist_id"].values[first_rows].tolist()
+    artist_names = info["artist_name"].values[first_rows].tolist()
+    song_names = info["track_name"].values[first_rows].tolist()
+    durations = info["duration_ms"].values[first_rows].astype(np.int64).tolist()
+    ends = np.append(starts[1:], len(order)).tolist()
+    listen_times = _group_sums(info["ms_played"].values, order, starts)
+
+    # Every listen encoded once in grouped order, so each track's records are a slice of the same buffer
+    records = encode_listens(timestamps[order], info["ms_played"].values[order])[1:]
+    header = bytes([CODEC_VERSION])
 
-    # for track_id in ["2j4RC1LkwV47B0BMZNyvE3"]:
-    for track_id in np.unique(info["track_id"]):
-        listens = info[info["track_id"] == track_id]
-        listens.loc[:, "count"] = 1
-        
-        artist_id = listens.iloc[0, listens.columns.get_loc("artist_id")]
-        artist_name = listens.iloc[0, listens.columns.get_loc("artist_name")]
-        song_name = listens.iloc[0, listens.columns.get_loc("track_name")]
-        listen_count = listens.shape[0]
-        listen_time = int(listens["ms_played"].sum())
-
-        # TRACKS
-        first_listen_row = listens[listens["timestamp"] == listens["timestamp"].min()]
-        last_listen_row = listens[listens["timestamp"] == listens["timestamp"].max()]
-        track_info = {
-            "artist_id" : artist_id,
-            "artist_name" : artist_name,
-            "duration" : int(listens.iloc[0, listens.columns.get_loc("duration_ms")]),
-            "first_listen" : {
-                "hour": int(first_listen_row.iloc[0, first_listen_row.columns.get_loc("hour")]),
-                "day": int(first_listen_row.iloc[0, first_listen_row.columns.get_loc("day")]),
-                "weekday": int(first_listen_row.iloc[0, first_listen_row.columns.get_loc("weekday")]),
-                "month": int(first_listen_row.iloc[0, first_listen_row.columns.get_loc("month")]),
-                "year": int(first_listen_row.iloc[0, first_listen_row.columns.get_loc("year")]),
-            },
-            "last_listen" : {
-                "hour": int(last_listen_row.iloc[0, last_listen_row.columns.get_loc("hour")]),
-                "day": int(last_listen_row.iloc[0, last_listen_row.columns.get_loc("day")]),
-                "weekday": int(last_listen_row.iloc[0, last_listen_row.columns.get_loc("weekday")]),
-                "month": int(last_listen_row.iloc[0, last_listen_row.columns.get_loc("month")]),
-                "year": int(last_listen_row.iloc[0, last_listen_row.columns.get_loc("year")]),
-            },
-            "listen_count" : listen_count,
-            "listen_time" : listen_time,
-            "listens": [],
-            "song_name" : song_name,
+    tracks = {}
+    for idx, track_id in enumerate(track_ids):
+        start, end = int(starts[idx]), ends[idx]
+        tracks[track_id] = {
+            "artist_id" : artist_ids[idx],
+            "artist_name" : artist_names[idx],
+            "duration" : durations[idx],
+            "first_listen" : first_listens[idx],
+            "last_listen" : last_listens[idx],
+            "listen_count" : end - start,
+            "listen_time" : int(listen_times[idx]),
+            "records": to_text(header + records[start * RECORD_DTYPE.itemsize:end * RECORD_DTYPE.itemsize]),
+            "song_name" : song_names[idx],
             "track_id" : track_id,
         }
 
-        for _, row in listens.iterrows():
-            track_info["listens"].append({
-                "hour": row["hour"],
-                "day": row["day"],
-                "weekday": row["weekday"],
-                "month": row["month"],
-                "year": row["year"],
-                "duration": row["ms_played"]
-            })
-        tracks[track_id] = track_info
-
-        # HISTORY
-        listen_months = listens.loc[:, ["ms_played", "year_month", "count"]].groupby("year_month").sum()
-        for year_month, row in listen_months.iterrows():
-            year_month = f"{year_month}"
-            year = int(year_month[0:4])
-            month = int(year_month[4:6])
-            if year not in history:
-                history[year] = {}
-            if month not in history[year]:
-                history[year][month] = {
-                    "listen_count": 0,
-                    "listen_time": 0,
-                    "uq_artists": set(),
-                    "uq_songs": set(),
-                }
-            history[year][month]["listen_count"] += int(row["count"])
-            history[year][month]["listen_time"] += int(row["ms_played"])
-            history[year][month]["uq_artists"].add(artist_id)
-            history[year][month]["uq_songs"].add(track_id)
-                    
-    for year in history:
-        for month in history[year]:
-            history[year][month]["uq_artists"] = list(history[year][month]["uq_artists"])
-            history[year][month]["uq_songs"] = list(history[year][month]["uq_songs"])
+    history = _agg_history(info, codes, track_ids, artist_ids)
     return tracks, history
 
 def agg_artists(info):
+    info = info.reset_index(drop=True)
+    codes, artist_ids, order, starts = _group_rows(info["artist_id"].values)
+    timestamps = info["timestamp"].values
+    first_rows = _extreme_rows(codes, timestamps, starts)
+    last_rows = _extreme_rows(codes, timestamps, starts, latest=True)
+    first_listen_times = _time_infos(info, first_rows)
+    last_listen_times = _time_infos(info, last_rows)
+    artist_names = info["artist_name"].values[order[starts]].tolist()
+    track_ids = info["track_id"].values
+    track_names = info["track_name"].values
+    ends = np.append(starts[1:], len(order)).tolist()
+    listen_times = _group_sums(info["ms_played"].values, order, starts)
+
+    # Each artist's unique tracks in the order they were first listened to
+    uq_tracks = pd.DataFrame({
+        "artist": codes[order],
+        "track_id": track_ids[order],
+        "song_name": track_names[order],
+    }).drop_duplicates(subset=["artist", "track_id"])
+    uq_counts = np.bincount(uq_tracks["artist"].values, minlength=len(artist_ids))
+    uq_ends = np.cumsum(uq_counts).tolist()
+    uq_track_list = [
+        {"track_id" : track_id, "song_name" : song_name}
+        for track_id, song_name in zip(uq_tracks["track_id"].tolist(), uq_tracks["song_name"].tolist())
+    ]
+
     artists = {}
     artist_list = []
-
-    # for artist_id in ["6Yv6OBXD6ZQakEljaGaDAk"]:
-    for artist_id in np.unique(info["artist_id"]):
-        listens = info[info["artist_id"] == artist_id]
-        artist_name = listens.iloc[0, listens.columns.get_loc("artist_name")]
-
-        first_listen_row = listens[listens["timestamp"] == listens["timestamp"].min()]
-        last_listen_row = listens[listens["timestamp"] == listens["timestamp"].max()]
-
-        artist_info = {
+    for idx, artist_id in enumerate(artist_ids):
+        start, end = int(starts[idx]), ends[idx]
+        first_row, last_row = first_rows[idx], last_rows[idx]
+        artists[artist_id] = {
             "artist_id" : artist_id,
-            "artist_name" : artist_name,
+            "artist_name" : artist_names[idx],
             "first_listen" : {
-                "song_name" : first_listen_row.iloc[0, first_listen_row.columns.get_loc("track_name")],
-                "track_id" : first_listen_row.iloc[0, first_listen_row.columns.get_loc("track_id")]
-            },
-            "first_listen_time" : {
-                "hour": int(first_listen_row.iloc[0, first_listen_row.columns.get_loc("hour")]),
-                "day": int(first_listen_row.iloc[0, first_listen_row.columns.get_loc("day")]),
-                "weekday": int(first_listen_row.iloc[0, first_listen_row.columns.get_loc("weekday")]),
-                "month": int(first_listen_row.iloc[0, first_listen_row.columns.get_loc("month")]),
-                "year": int(first_listen_row.iloc[0, first_listen_row.columns.get_loc("year")]),
+                "song_name" : track_names[first_row],
+                "track_id" : track_ids[first_row]
             },
+            "first_listen_time" : first_listen_times[idx],
             "last_listen" : {
-                "song_name" : last_listen_row.iloc[0, last_listen_row.columns.get_loc("track_name")],
-                "track_id" : last_listen_row.iloc[0, last_listen_row.columns.get_loc("track_id")]
-            },
-            "last_listen_time" : {
-                "hour": int(last_listen_row.iloc[0, last_listen_row.columns.get_loc("hour")]),
-                "day": int(last_listen_row.iloc[0, last_listen_row.columns.get_loc("day")]),
-                "weekday": int(last_listen_row.iloc[0, last_listen_row.columns.get_loc("weekday")]),
-                "month": int(last_listen_row.iloc[0, last_listen_row.columns.get_loc("month")]),
-                "year": int(last_listen_row.iloc[0, last_listen_row.columns.get_loc("year")]),
+                "song_name" : track_names[last_row],
+                "track_id" : track_ids[last_row]
             },
-            "listen_count" : listens.shape[0],
-            "listen_time" : int(listens["ms_played"].sum()),
-            "tracks" : []
+            "last_listen_time" : last_listen_times[idx],
+            "listen_count" : end - start,
+            "listen_time" : int(listen_times[idx]),
+            "tracks" : uq_track_list[uq_ends[idx] - int(uq_counts[idx]):uq_ends[idx]]
         }
-        uq_tracks = listens.drop_duplicates(subset=["track_id"])
-        for _, uq_track_row in uq_tracks.iterrows():
-            artist_info["tracks"].append({
-                "track_id" : uq_track_row["track_id"],
-                "song_name" : uq_track_row["track_name"],
-            })
-        artists[artist_id] = artist_info
 
         # ARTIST LIST
         artist_list.append({
             "artist_id": artist_id,
-            "artist_name": artist_name
+            "artist_name": artist_names[idx]
         })
 
     return artists, artist_list
 
-def get_fb_info():
-    with open("firebase_songs.json", "r") as f:
-        tracks = json.load(f)
-    track_rows = []
-    for track_id in tracks:
-        artist_id = tracks[track_id]["artist_id"]
-        artist_name = tracks[track_id]["artist_name"]
-        duration = tracks[track_id]["duration"]
-        song_name = tracks[track_id]["song_name"]
-        for listen in tracks[track_id]["listens"]:
-            month = listen["month"] if listen["month"] > 9 else f"0{listen['month']}"
-            dt = datetime(listen["year"], listen["month"], listen["day"], listen["hour"], tzinfo=timezone.utc)
-            timestamp = datetime.timestamp(dt)
-            track_rows.append({
-                "track_id": track_id,
-                "artist_id": artist_id,
-                "artist_name": artist_name,
-                "duration_ms": duration,
-                "track_name": song_name,
-                "minute": 0,
-                "hour": listen["hour"],
-                "day": listen["day"],
-                "month": listen["month"],
-                "year": listen["year"],
-                "year_month": f"{listen['year']}{month}",
-                "weekday": listen["weekday"],
-                "ms_played": listen["duration"],
-                "timestamp": timestamp
-            })
-    return pd.DataFrame(track_rows)
+ROLLUP_FIELDS = {"month": "year_month", "weekday": "weekday", "hour": "hour"}
+
+def _rollup_stats(info, keys):
+    """ Counts and sums the ms played of the listens in each group of the key columns, in one groupby
+
+    Returns
+    -------
+    tuple (list, list, list) - the key tuples, listen counts and listen times of the groups that occur
+    """
+    stats = info.groupby(keys, sort=True)["ms_played"].agg(["size", "sum"])
+    return stats.index.tolist(), stats["size"].astype(np.int64).tolist(), stats["sum"].astype(np.int64).tolist()
+
+def _add_rollup_field(rollups, field, groups):
+    """ Adds the stats of (id, period) groups to the field of each id's rollup """
+    for (doc_id, period), listen_count, listen_time in zip(*groups):
+        rollups[doc_id][field][str(period)] = {"listen_count": listen_count, "listen_time": listen_time}
+
+def agg_rollups(info):
+    """ Builds the song and artist rollup documents that FireManager keeps up to date on each listen, see
+    firebase.SONG_ROLLUPS
+
+    Parameters
+    ----------
+    info : pd.DataFrame - listens in the format returned by get_info or get_fb_info
+
+    Returns
+    -------
+    tuple (dict, dict) - the song rollups keyed by track_id and the artist rollups keyed by artist_id
+    """
+    info = info.loc[:, ["track_id", "artist_id", "ms_played", "timestamp"] + list(ROLLUP_FIELDS.values())]
+    song_rollups = {
+        track_id: {"track_id": track_id, "month": {}, "weekday": {}, "hour": {}}
+        for track_id in pd.unique(info["track_id"])
+    }
+    artist_rollups = {
+        artist_id: {"artist_id": artist_id, "month": {}, "weekday": {}, "hour": {}, "tracks": {}, "month_songs": {}}
+        for artist_id in pd.unique(info["artist_id"])
+    }
+    for field, column in ROLLUP_FIELDS.items():
+        _add_rollup_field(song_rollups, field, _rollup_stats(info, ["track_id", column]))
+        _add_rollup_field(artist_rollups, field, _rollup_stats(info, ["artist_id", column]))
+
+    for (artist_id, track_id), listen_count, listen_time in zip(*_rollup_stats(info, ["artist_id", "track_id"])):
+        artist_rollups[artist_id]["tracks"][track_id] = {"listen_count": listen_count, "listen_time": listen_time}
+
+    # The tracks of each artist's months in the order they were first listened to in that month
+    month_songs = info.sort_values("timestamp", kind="mergesort").drop_duplicates(
+        subset=["artist_id", "year_month", "track_id"]
+    ).groupby(["artist_id", "year_month"], sort=True)["track_id"].agg(list)
+    for (artist_id, year_month), track_ids in zip(month_songs.index.tolist(), month_songs.tolist()):
+        artist_rollups[artist_id]["month_songs"][str(year_month)] = track_ids
+    return song_rollups, artist_rollups
+
+def get_fb_info(path=FB_SNAPSHOT_PATH):
+    # Stream the snapshot one song at a time, decoding each song's listen records straight into arrays
+    documents = iter_ndjson_documents(path) if path.endswith(".ndjson") else iter_json_object(path)
+    song_cols = {"track_id": [], "artist_id": [], "artist_name": [], "duration_ms": [], "track_name": []}
+    timestamps, ms_played = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    listen_counts = array("q")
+    for track_id, track in documents:
+        song_cols["track_id"].append(track_id)
+        song_cols["artist_id"].append(track["artist_id"])
+        song_cols["artist_name"].append(track["artist_name"])
+        song_cols["duration_ms"].append(track["duration"])
+        song_cols["track_name"].append(track["song_name"])
+        song_timestamps, song_ms_played = track_listens(track)
+        listen_counts.append(len(song_timestamps))
+        timestamps.append(song_timestamps)
+        ms_played.append(song_ms_played)
+
+    counts = np.frombuffer(listen_counts, dtype=np.int64) if len(listen_counts) else np.zeros(0, dtype=np.int64)
+    df = pd.DataFrame({
+        column: np.repeat(np.array(values, dtype=np.int64 if column == "duration_ms" else object), counts)
+        for column, values in song_cols.items()
+    })
+
+    # Listens are stored as UTC epoch seconds
+    end_times = np.concatenate(timestamps).astype("datetime64[s]")
+    df = add_time_columns(df, pd.Series(end_times))
+    df["ms_played"] = np.concatenate(ms_played)
+    df["timestamp"] = df["timestamp"].astype(float)
+    return df.loc[:, [
+        "track_id", "artist_id", "artist_name", "duration_ms", "track_name", "minute", "hour", "day", "month", "year",
+        "year_month", "weekday", "ms_played", "timestamp"
+    ]]
+
+def get_cached_info():
+    """ get_info on the ids in final_track_ids.csv, read from the cache unless one of INFO_SOURCES changed """
+    return cached_frame("info", INFO_SOURCES, lambda : get_info(pd.read_csv("final_track_ids.csv", index_col="name")))
+
+def get_cached_fb_info():
+    """ get_fb_info, read from the cache unless the songs snapshot changed. Refresh the snapshot with
+    `python export.py --sync`, which only reads the songs changed since it last ran. """
+    return cached_frame("fb_info", FB_INFO_SOURCES, get_fb_info)
 
 if __name__ == "__main__":
     fb = FireManager()
-    # ids = pd.read_csv("final_track_ids.csv", index_col="name")
-    # info = get_info(ids)
-    # fb_info = get_fb_info()
+    # info = get_cached_info()
+    # fb_info = get_cached_fb_info()
     # info = pd.concat((info, fb_info)).reset_index(drop=True)
     # tracks, history = agg_tracks(info)
     # artists, artist_list = agg_artists(info)
@@ -300,24 +483,14 @@ if __name__ == "__main__":
     # save_dict_json(history, "agg_history")
     # save_dict_json(artists, "agg_artists")
     # save_dict_json(artist_list, "agg_artist_list")
+    # song_rollups, artist_rollups = agg_rollups(info)
+    # save_dict_json(song_rollups, "agg_song_rollups")
+    # save_dict_json(artist_rollups, "agg_artist_rollups")
+    # save_high_water_mark(info)
     tracks = read_dict_json("agg_tracks")
     history = read_dict_json("agg_history")
     artists = read_dict_json("agg_artists")
     artist_list = read_dict_json("agg_artist_list")
 
-    # fb.set_artist_list(artist_list)
-
-    # for year in history:
-    #     fb.set_history(year, history[year])
-
-    # for artist_id in artists:
-    #     print(artist_id)
-    #     fb.set_artist(artist_id, artists[artist_id])
-    
-    # for track_id in tracks:
-    #     print(track_id)
-    #     fb.set_track(track_id, tracks[track_id])
-
-
-
-    
\ No newline at end of file
+    # Upload with `python upload.py`, which sends the documents in concurrent batches and resumes from
+    # upload_checkpoint.txt if interrupted
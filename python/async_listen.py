@@ -0,0 +1,216 @@
+""" Listener that polls spotify, looks up durations, releases listens, updates the current track and
+backfills missed listens in separate asyncio tasks, so a slow call to one service never delays noticing the next song
+
+Usage: python async_listen.py
+"""
+import asyncio
+import sys
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+import spotipy
+
+from gmail import Gmail
+from listen import Listener
+
+class AsyncListener(Listener):
+    """ Listens to the spotify songs with the same release rules as Listener, in four tasks
+
+    The poll task reads the playing track on the PollScheduler's schedule and hands each song change to the release
+    task and each new track to the current task. The release task looks up the duration of the last song and
+    queues it for the write behind worker if _should_release says so, in the order the changes were seen. The
+    current task writes only the latest track to overview/current, skipping any that were replaced while it waited.
+    The reconcile task backfills the listens polling missed from the recently played history every interval_sec of
+    the Reconciler.
+
+    Polls, duration lookups, current track updates and reconciles each run on their own thread pool with a timeout
+    each, so a slow call only holds up calls of the same kind. A call that times out keeps its thread until it
+    returns, so a pool whose threads are all busy fails new calls straight away rather than queueing them. A poll
+    that times out is tried again on the next poll, a duration lookup that times out is treated as unknown, as a
+    ReadTimeout is by _get_track_duration, and a reconcile that times out is tried again when it is next due. An
+    update of the current track waits for one that timed out to finish, then writes the latest track.
+
+    Parameters
+    ----------
+    poll_timeout_sec : float (default=10) - the longest wait for current_user_playing_track
+
+    duration_timeout_sec : float (default=5) - the longest wait for a track duration
+
+    current_timeout_sec : float (default=10) - the longest wait for the update of overview/current
+
+    reconcile_timeout_sec : float (default=60) - the longest wait for a reconcile
+    """
+    def __init__(self, poll_timeout_sec=10, duration_timeout_sec=5, current_timeout_sec=10, reconcile_timeout_sec=60):
+        super().__init__()
+        self.poll_timeout_sec = poll_timeout_sec
+        self.duration_timeout_sec = duration_timeout_sec
+        self.current_timeout_sec = current_timeout_sec
+        self.reconcile_timeout_sec = reconcile_timeout_sec
+        self.timeouts = {"poll": 0, "duration": 0, "current": 0, "reconcile": 0}
+        self._workers = {"poll": 3, "duration": 2, "current": 1, "reconcile": 1}
+        self._pools = {
+            name: ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+            for name, workers in self._workers.items()
+        }
+        self._running = {name: set() for name in self._workers}
+        self._current_write = None
+        self._gmail = None
+        self._current = None
+        self._current_changed = None
+
+    def _submit(self, pool, func, *args):
+        """ Starts a blocking call on the named thread pool, raising asyncio.TimeoutError if every thread of the
+        pool is still busy, such as with calls that timed out, as the call would only wait behind them """
+        running = self._running[pool]
+        running.difference_update([future for future in running if future.done()])
+        if len(running) >= self._workers[pool]:
+            raise asyncio.TimeoutError()
+        future = asyncio.get_running_loop().run_in_executor(self._pools[pool], func, *args)
+        # The result of a call that timed out is never awaited, so its error is retrieved here
+        future.add_done_callback(lambda done : done.cancelled() or done.exception())
+        running.add(future)
+        return future
+
+    async def _call(self, pool, timeout_sec, func, *args):
+        """ Runs a blocking call on the named thread pool, raising asyncio.TimeoutError after timeout_sec. The call
+        carries on in its thread after a timeout. """
+        return await asyncio.wait_for(asyncio.shield(self._submit(pool, func, *args)), timeout_sec)
+
+    def _report(self, msg, send=True):
+        print(msg)
+        if send:
+            self._gmail.send_message(msg)
+
+    async def _poll_task(self, releases):
+        """ Polls the playing track, passing each song change to releases as (current_id, last_id, last_track, seen
+        at) and each playing track to the current task """
+        last_track = await self._call("poll", self.poll_timeout_sec, self.spotify.current_user_playing_track)
+        last_id = self._get_track_id(last_track)
+        while True:
+            try:
+                current_track = await self._call("poll", self.poll_timeout_sec, self.spotify.current_user_playing_track)
+                if current_track is None or current_track["item"] is None or self._check_if_podcast(current_track):
+                    self.scheduler.record_poll(None)
+                    await asyncio.sleep(self.scheduler.next_delay(None))
+                    continue
+
+                current_id = self._get_track_id(current_track)
+                self.scheduler.record_poll(current_track, changed=current_id != last_id)
+                if current_id != last_id:
+                    releases.put_nowait((current_id, last_id, last_track, datetime.now().timestamp()))
+                self._current = (current_id, current_track)
+                self._current_changed.set()
+
+                last_id = current_id
+                last_track = current_track
+                await asyncio.sleep(self.scheduler.next_delay(current_track))
+
+            except asyncio.TimeoutError:
+                self.timeouts["poll"] += 1
+                self._report(f"Polling spotify timed out after {self.poll_timeout_sec}s", send=False)
+                await asyncio.sleep(self.scheduler.next_delay(None))
+            except requests.exceptions.ReadTimeout as e:
+                self._report(f"ReadTimeout {e}", send=False)
+                await asyncio.sleep(30)
+            except spotipy.exceptions.SpotifyException as e:
+                try:
+                    self.spotify = self._init_spotify()
+                except:
+                    tb = ''.join(traceback.format_tb(sys.exc_info()[2]))
+                    self._report(f"Could not init spotify: {sys.exc_info()[0]}\nTraceback:\n{tb}")
+                    raise SystemExit(1)
+
+    async def _release_task(self, releases):
+        """ Decides in order whether each song change releases the last song, and queues the releases """
+        while True:
+            current_id, last_id, last_track, seen_at = await releases.get()
+            try:
+                track_duration = await self._call(
+                    "duration", self.duration_timeout_sec, self._get_track_duration, last_id
+                )
+            except asyncio.TimeoutError:
+                self.timeouts["duration"] += 1
+                track_duration = 0
+            should_release, last_info = self._should_release(
+                current_id, last_id, last_track, now=seen_at, track_duration=track_duration
+            )
+            if should_release and last_info is not None:
+                self._queue_release(last_id, last_track, last_info)
+
+    async def _current_task(self):
+        """ Writes the latest playing track to overview/current whenever it changes """
+        while True:
+            await self._current_changed.wait()
+            if self._current_write is not None and not self._current_write.done():
+                # An update that timed out is still running, so rather than queue behind it, wait for it and then
+                # write whichever track is the latest by then
+                await asyncio.wait([self._current_write])
+            self._current_changed.clear()
+            track_id, track = self._current
+            self._current_write = self._submit("current", self._update_current, track_id, track)
+            try:
+                await asyncio.wait_for(asyncio.shield(self._current_write), self.current_timeout_sec)
+            except asyncio.TimeoutError:
+                self.timeouts["current"] += 1
+                self._report(f"Updating the current track timed out after {self.current_timeout_sec}s", send=False)
+
+    async def _reconcile_task(self):
+        """ Backfills the listens polling missed whenever the reconciler is due """
+        while True:
+            if self.reconciler.due():
+                try:
+                    await self._call("reconcile", self.reconcile_timeout_sec, self._reconcile)
+                except asyncio.TimeoutError:
+                    self.timeouts["reconcile"] += 1
+                    self._report(f"Reconciling timed out after {self.reconcile_timeout_sec}s", send=False)
+            await asyncio.sleep(self.reconciler.interval_sec)
+
+    async def run(self):
+        """ Runs the tasks until one of them fails, then stops the others and raises its error
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+        """
+        self._gmail = Gmail()
+        self._current_changed = asyncio.Event()
+        releases = asyncio.Queue()
+        self.writer.start()
+        tasks = [
+            asyncio.ensure_future(self._poll_task(releases)),
+            asyncio.ensure_future(self._release_task(releases)),
+            asyncio.ensure_future(self._current_task()),
+            asyncio.ensure_future(self._reconcile_task()),
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        except Exception:
+            tb = ''.join(traceback.format_tb(sys.exc_info()[2]))
+            self._report(f"Unhandled Error: {sys.exc_info()[0]}\nTraceback:\n{tb}")
+            raise
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def listen(self):
+        """ Listens to the songs and outputs info whenever a new song has been listened to
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+        """
+        asyncio.run(self.run())
+
+if __name__ == "__main__":
+    listener = AsyncListener()
+    listener.listen()
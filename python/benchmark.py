@@ -0,0 +1,372 @@
+""" Benchmarks for the data processing pipeline on synthetic listens
+
+Run all benchmarks with `python benchmark.py` or a subset with `python benchmark.py clean`
+"""
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+import pandas as pd
+import numpy as np
+from google.api_core.exceptions import DeadlineExceeded
+
+from aggregate import agg_artists, agg_tracks, attach_track_info, save_dict_json
+from clean import clean_listens
+from codec import decode_listens, encode_listens, from_text, to_text
+from duration_cache import DurationCache
+from fake_firestore import FakeClient
+from firebase import FireManager
+from parallel import rebuild_parallel
+from poll_scheduler import PollScheduler
+from write_queue import ListenQueue, WriteBehindWorker
+
+## HELPERS
+def make_raw_listens(n_rows, n_tracks=20000, seed=0):
+    """ Makes a synthetic raw listen table in the format read from AllSongs.json
+
+    Parameters
+    ----------
+    n_rows : int - the number of listens
+
+    n_tracks : int (default=20000) - the number of unique tracks
+
+    seed : int (default=0) - the random seed
+
+    Returns
+    -------
+    pd.DataFrame - listens with track_name, artist_name, ms_played and end_time columns
+    """
+    rng = np.random.default_rng(seed)
+    track_nums = rng.integers(0, n_tracks, n_rows)
+    seconds = rng.integers(1370000000, 1610000000, n_rows)
+    end_times = pd.to_datetime(seconds, unit="s").strftime("%Y-%m-%d %H:%M:%S UTC")
+    return pd.DataFrame({
+        "track_name": pd.Series(track_nums).map(lambda num : f"track {num}"),
+        "artist_name": pd.Series(track_nums // 10).map(lambda num : f"artist {num}"),
+        "ms_played": rng.integers(0, 300000, n_rows),
+        "end_time": end_times,
+    })
+
+def legacy_clean(df):
+    """ The row-wise cleaning that clean.clean_listens replaced, kept as a baseline """
+    df['track_name'] = df['track_name'].astype(str)
+    df['artist_name'] = df['artist_name'].astype(str)
+    df['ms_played'] = pd.to_numeric(df['ms_played'])
+    df['end_time'] = df['end_time'].apply(lambda date : re.sub(r':[0-9][0-9] UTC', '', date))
+    df['end_time'] = df['end_time'].apply(lambda date_str : datetime.strptime(date_str, '%Y-%m-%d %H:%M'))
+    df['year'] = df['end_time'].apply(lambda dt : dt.date().year)
+    df['month'] = df['end_time'].apply(lambda dt : dt.date().month)
+    df['day'] = df['end_time'].apply(lambda dt : dt.date().day)
+    df['weekday'] = df['end_time'].apply(lambda dt : dt.weekday())
+    df['hour'] = df['end_time'].apply(lambda dt : dt.time().hour)
+    df['minute'] = df['end_time'].apply(lambda dt : dt.time().minute)
+    df['year_month'] = df.apply(lambda row : f"{row['year']}{0 if row['month'] < 10 else ''}{row['month']}", axis=1)
+    df['timestamp'] = df['end_time'].apply(lambda dt : int(dt.timestamp()))
+    df = df.sort_values(by='end_time').reset_index(drop=True)
+    return df.drop(columns=['end_time'])
+
+def make_track_tables(cleaned):
+    """ Makes the final_track_ids.csv and tracks_info_final.json tables for the tracks in a cleaned listen table """
+    names = cleaned.loc[:, ["track_name", "artist_name"]].drop_duplicates()
+    keys = (names["track_name"] + " " + names["artist_name"]).values
+    track_ids = [f"id{num}" for num in range(len(keys))]
+    ids = pd.DataFrame({"track_id": track_ids}, index=pd.Index(keys, name="name"))
+    info = pd.DataFrame({
+        "artist_id": names["artist_name"].values,
+        "artist_name": names["artist_name"].values,
+        "duration_ms": 200000,
+        "track_name": names["track_name"].values,
+    }, index=track_ids)
+    return ids, info
+
+def legacy_attach_track_info(cleaned_tracks, ids, info):
+    """ The row-wise id and metadata lookups that aggregate.attach_track_info replaced, kept as a baseline """
+    cleaned_tracks["track_id"] = cleaned_tracks.apply(lambda row : ids.loc[f"{row['track_name']} {row['artist_name']}", "track_id"], axis=1)
+    cleaned_tracks = cleaned_tracks[cleaned_tracks["track_id"] != "none"]
+    cleaned_tracks = cleaned_tracks.drop(columns=["track_name", "artist_name"])
+    cleaned_tracks[["artist_id", "artist_name", "duration_ms", "track_name"]] = cleaned_tracks["track_id"].apply(lambda id : info.loc[id, :])
+    return cleaned_tracks
+
+def make_info(n_rows, n_tracks=20000):
+    """ Makes a synthetic listen table in the format returned by aggregate.get_info """
+    cleaned = clean_listens(make_raw_listens(n_rows, n_tracks=n_tracks))
+    ids, info = make_track_tables(cleaned)
+    return attach_track_info(cleaned, ids, info)
+
+def timed(func, *args, **kwargs):
+    """ Runs func and returns its result and the seconds it took """
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def report(name, n_rows, old_sec, new_sec):
+    """ Prints a one line comparison of two timings """
+    print(f"{name}: {n_rows} rows | old {old_sec:.2f}s | new {new_sec:.2f}s | {old_sec / new_sec:.1f}x")
+
+## BENCHMARKS
+def bench_clean(n_rows=2000000):
+    """ Compares clean.clean_listens to the row-wise cleaning it replaced """
+    raw = make_raw_listens(n_rows)
+    new, new_sec = timed(clean_listens, raw)
+    old, old_sec = timed(legacy_clean, raw.copy())
+    cols = ["year", "month", "day", "weekday", "hour", "minute", "year_month"]
+    assert list(old.columns) == list(new.columns)
+    assert (old.sort_values(by="timestamp", kind="mergesort")[cols].values == new[cols].values).all()
+    report("clean", n_rows, old_sec, new_sec)
+
+def bench_get_info(n_rows=1000000):
+    """ Compares aggregate.attach_track_info to the row-wise lookups it replaced """
+    cleaned = clean_listens(make_raw_listens(n_rows))
+    ids, info = make_track_tables(cleaned)
+    new, new_sec = timed(attach_track_info, cleaned, ids, info)
+    old, old_sec = timed(legacy_attach_track_info, cleaned.copy(), ids, info)
+    assert (old["track_id"].values == new["track_id"].values).all()
+    assert (old["track_name"].values == new["track_name"].values).all()
+    report("get_info", n_rows, old_sec, new_sec)
+
+def rebuild_serial(info, directory):
+    """ Writes the agg_* files the way aggregate.py does on one core """
+    tracks, history = agg_tracks(info)
+    artists, artist_list = agg_artists(info)
+    save_dict_json(tracks, os.path.join(directory, "agg_tracks"))
+    save_dict_json(history, os.path.join(directory, "agg_history"))
+    save_dict_json(artists, os.path.join(directory, "agg_artists"))
+    save_dict_json(artist_list, os.path.join(directory, "agg_artist_list"))
+
+def bench_parallel(n_rows=2000000, workers=(1, 2, 4, 8)):
+    """ Times parallel.rebuild_parallel for each worker count against the serial rebuild """
+    info = make_info(n_rows)
+    with tempfile.TemporaryDirectory() as directory:
+        _, serial_sec = timed(rebuild_serial, info, directory)
+        print(f"parallel: {n_rows} rows | serial {serial_sec:.2f}s")
+        for num_workers in workers:
+            _, parallel_sec = timed(rebuild_parallel, info, workers=num_workers, directory=directory)
+            print(f"parallel: {n_rows} rows | {num_workers} workers {parallel_sec:.2f}s | {serial_sec / parallel_sec:.1f}x")
+
+def legacy_decode(text):
+    """ Reads listens saved as a json list of time field dicts into arrays, as get_fb_info did before the codec """
+    fields = {field: [] for field in ["hour", "day", "month", "year", "weekday", "duration"]}
+    for listen in json.loads(text):
+        for field in fields:
+            fields[field].append(listen[field])
+    return {field: np.array(values, dtype=np.int64) for field, values in fields.items()}
+
+def bench_codec(n_rows=1000000):
+    """ Compares the size and decode time of codec records to the json list of dicts they replaced """
+    info = make_info(n_rows)
+    fields = ["hour", "day", "weekday", "month", "year"]
+    legacy = [dict(zip(fields + ["duration"], row)) for row in zip(*[info[col].tolist() for col in fields + ["ms_played"]])]
+    legacy_text = json.dumps(legacy)
+    text = json.dumps(to_text(encode_listens(info["timestamp"].values, info["ms_played"].values)))
+    _, old_sec = timed(legacy_decode, legacy_text)
+    (timestamps, ms_played), new_sec = timed(lambda : decode_listens(from_text(json.loads(text))))
+    assert (timestamps == info["timestamp"].values).all() and (ms_played == info["ms_played"].values).all()
+    print(f"codec: {n_rows} rows | old {len(legacy_text) / n_rows:.1f} bytes/listen | new {len(text) / n_rows:.1f} bytes/listen")
+    report("codec decode", n_rows, old_sec, new_sec)
+
+def make_fake_firestore(latency, year=2021):
+    """ Makes a fake firestore holding the documents a listen in year updates besides its artist and song """
+    client = FakeClient()
+    for month in range(1, 13):
+        client.collection(f"history_{year}").document(f"{month}").set({
+            "listen_count": 0, "listen_time": 0, "uq_artists": [], "uq_songs": []
+        })
+    client.collection("utils").document("artist_list").set({"list": []})
+    client.latency = latency
+    client.reset_counts()
+    return client
+
+def make_listen_details(num, year=2021, seq=0):
+    """ Makes the track_details of a listen as Listener passes them to FireManager.add_song, ending seq minutes into
+    its month so that listens with different seq are different listens """
+    return {
+        "artist_name": f"artist {num // 10}",
+        "song_name": f"track {num}",
+        "duration": 200000,
+        "ms_played": 180000,
+        "timestamp": datetime(year, 1 + num % 12, 1, tzinfo=timezone.utc) + timedelta(minutes=seq),
+    }
+
+def bench_firestore(n_listens=100, latency=0.02):
+    """ Reports the round trips and wall time per listen of FireManager.add_song against a fake firestore that
+    takes latency seconds per round trip """
+    with tempfile.TemporaryDirectory() as directory:
+        client = make_fake_firestore(latency)
+        fb = FireManager(known_ids_path=os.path.join(directory, "known_ids.json"), client=client)
+        cases = [
+            ("new song", False, lambda num : num),
+            ("known song", False, lambda num : num % 10),
+            ("known song + week", True, lambda num : num % 10),
+        ]
+        for case, (name, add_to_week, track_num) in enumerate(cases):
+            client.reset_counts()
+            start = time.perf_counter()
+            for num in range(n_listens):
+                track = track_num(num)
+                details = make_listen_details(track, seq=case * n_listens + num)
+                fb.add_song(f"track{track}", f"artist{track // 10}", details, add_to_week=add_to_week)
+            sec = time.perf_counter() - start
+            print(f"firestore {name}: {n_listens} listens | {client.round_trips / n_listens:.1f} round trips/listen | "
+                  f"{1000 * sec / n_listens:.1f} ms/listen at {1000 * latency:.0f} ms latency | {dict(client.calls)}")
+
+def count_written(client, fb, track_ids):
+    """ Gets the sum of the listen_count of the songs and the number of listen records in their buckets """
+    listen_count = sum(fb.song_collection.document(track_id).get().get("listen_count") for track_id in track_ids)
+    timestamps = fb.get_listen_timestamps([(track_id, 2021) for track_id in track_ids])
+    return listen_count, sum(len(track_timestamps) for track_timestamps in timestamps.values())
+
+def bench_write_queue(n_listens=100, latency=0.02, outage_round_trips=5, applied_failures=3):
+    """ Reports how long the listener waits per listen when it queues listens for WriteBehindWorker rather than
+    writing them inline, and how the worker drains them in batches through an outage of outage_round_trips failed
+    round trips followed by applied_failures commits that are applied but fail with DeadlineExceeded, checking that
+    the retries of those never count a listen twice """
+    with tempfile.TemporaryDirectory() as directory:
+        client = make_fake_firestore(latency)
+        fb = FireManager(known_ids_path=os.path.join(directory, "known_ids.json"), client=client)
+        queue = ListenQueue(os.path.join(directory, "listen_queue.db"))
+        worker = WriteBehindWorker(queue, fb, backoff_sec=0.05)
+        client.fail_next(outage_round_trips)
+        client.fail_next(applied_failures, error=DeadlineExceeded, ops=["commit"], applied=True)
+
+        start = time.perf_counter()
+        for num in range(n_listens):
+            details = make_listen_details(num % 10, seq=num)
+            queue.put(f"track{num % 10}", f"artist{num // 100}", details, add_to_week=True)
+        put_sec = time.perf_counter() - start
+
+        start = time.perf_counter()
+        worker.start()
+        while queue.depth() > 0:
+            time.sleep(0.01)
+        drain_sec = time.perf_counter() - start
+        worker.stop()
+        metrics = worker.metrics()
+        queue.close()
+        round_trips = client.round_trips
+        listen_count, records = count_written(client, fb, [f"track{track}" for track in range(10)])
+        assert listen_count == records == n_listens, (listen_count, records)
+        print(f"write queue: {n_listens} listens | {1000 * put_sec / n_listens:.2f} ms/listen queued vs "
+              f"{1000 * latency:.0f}+ ms inline | drained in {drain_sec:.2f}s, {round_trips} round trips, "
+              f"{metrics['retries']} retries, {metrics['written']} written, {metrics['dead']} dead, "
+              f"listen_count {listen_count} for {records} records")
+
+def make_listening_session(n_songs=2000, seed=0):
+    """ Makes a simulated listening session with some skipped songs and some breaks
+
+    Returns
+    -------
+    list of (float, int, int) - the start second, duration_ms and ms played of each song
+    """
+    rng = np.random.default_rng(seed)
+    songs = []
+    start = 0.0
+    for _ in range(n_songs):
+        duration_ms = int(rng.integers(90000, 360000))
+        skipped = rng.random() < 0.25
+        played_ms = int(rng.integers(1000, duration_ms)) if skipped else duration_ms
+        songs.append((start, duration_ms, played_ms))
+        start += played_ms / 1000
+        if rng.random() < 0.05:
+            start += float(rng.integers(300, 4 * 3600))
+    return songs
+
+def replay_polls(songs, scheduler, next_delay):
+    """ Polls a simulated session at the times next_delay gives, estimating each song's ms played as Listener does
+
+    Returns
+    -------
+    tuple (int, float) - the songs whose release decision matches what was really played, and the mean absolute
+    error of the ms played of the released songs in seconds
+    """
+    starts = np.array([start for start, _, _ in songs])
+    last_progress = {}
+    last_song = None
+    now = 0.0
+    end = songs[-1][0] + songs[-1][2] / 1000
+    while now < end:
+        idx = int(np.searchsorted(starts, now, side="right")) - 1
+        start, duration_ms, played_ms = songs[idx]
+        track = None
+        if now < start + played_ms / 1000:
+            progress_ms = int((now - start) * 1000)
+            track = {"is_playing": True, "progress_ms": progress_ms, "item": {"duration_ms": duration_ms}}
+            last_progress[idx] = progress_ms
+        scheduler.record_poll(track, changed=track is not None and idx != last_song, now=now)
+        last_song = idx if track is not None else last_song
+        now += next_delay(track)
+
+    correct = 0
+    errors = []
+    for idx, (_, duration_ms, played_ms) in enumerate(songs):
+        estimate = last_progress.get(idx, 0)
+        if duration_ms - estimate < 11000:
+            estimate = duration_ms
+        released = idx in last_progress and estimate / duration_ms >= 0.5
+        correct += released == (played_ms / duration_ms >= 0.5)
+        if released:
+            errors.append(abs(estimate - played_ms) / 1000)
+    return correct, float(np.mean(errors))
+
+def bench_polling(n_songs=2000):
+    """ Compares polling every 10 seconds with PollScheduler on a simulated listening session """
+    songs = make_listening_session(n_songs)
+    hours = (songs[-1][0] + songs[-1][2] / 1000) / 3600
+    for name, scheduler, next_delay in [
+        ("fixed 10s", PollScheduler(), lambda track : 10),
+        ("scheduler", None, None),
+    ]:
+        if scheduler is None:
+            scheduler = PollScheduler()
+            next_delay = scheduler.next_delay
+        correct, ms_error = replay_polls(songs, scheduler, next_delay)
+        metrics = scheduler.metrics(now=hours * 3600)
+        print(f"polling {name}: {metrics['calls_per_hour']:.0f} calls/h | changes seen {metrics['mean_latency_sec']:.1f}s "
+              f"late on average, {metrics['max_latency_sec']:.1f}s at most | {correct}/{n_songs} release decisions "
+              f"right | ms played off by {ms_error:.1f}s")
+
+def bench_durations(n_releases=5000, n_tracks=2000, known=0.7):
+    """ Counts the spotify requests made for the durations of released listens with and without DurationCache, warmed
+    from a track info table holding a share of the tracks """
+    rng = np.random.default_rng(0)
+    track_ids = [f"{num:022d}" for num in range(n_tracks)]
+    releases = [track_ids[num] for num in np.minimum(rng.zipf(1.3, n_releases) - 1, n_tracks - 1)]
+    num_requests = []
+    def fetch_tracks(ids):
+        num_requests.append(len(ids))
+        return {"tracks": [{"id": track_id, "duration_ms": 200000} for track_id in ids]}
+
+    with tempfile.TemporaryDirectory() as directory:
+        info_path = os.path.join(directory, "tracks_info_final.json")
+        save_dict_json({track_id: {"duration_ms": 200000} for track_id in track_ids[:int(known * n_tracks)]},
+                       info_path[:-len(".json")])
+        cache = DurationCache(fetch_tracks, path=os.path.join(directory, "durations.db"), max_entries=n_tracks)
+        warmed = cache.warm(info_path=info_path, snapshot_path=os.path.join(directory, "none.ndjson"))
+        start = time.perf_counter()
+        for track_id in releases:
+            cache.get(track_id)
+        sec = time.perf_counter() - start
+        metrics = cache.metrics()
+        cache.close()
+    print(f"durations: {n_releases} releases of {len(set(releases))} tracks | {n_releases} requests uncached vs "
+          f"{metrics['requests']} cached, {warmed} warmed | {metrics['hit_rate']:.1%} hits | "
+          f"{1000 * sec / n_releases:.2f} ms/lookup")
+
+BENCHMARKS = {
+    "clean": bench_clean,
+    "codec": bench_codec,
+    "durations": bench_durations,
+    "firestore": bench_firestore,
+    "get_info": bench_get_info,
+    "parallel": bench_parallel,
+    "polling": bench_polling,
+    "write_queue": bench_write_queue,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] if len(sys.argv) > 1 else list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
@@ -0,0 +1,61 @@
+""" Per track and per artist listen counts by time bucket, built without one hot encoding every listen """
+import pandas as pd
+import numpy as np
+
+BUCKET_COLUMNS = ["year", "hour", "month", "year_month"]
+
+def count_buckets(tracks, key, column):
+    """ Counts the listens of each key in each value of a bucket column
+
+    Only the (key, bucket) pairs that occur are counted, so memory scales with them rather than with listens times
+    buckets. The columns are named like the pd.get_dummies columns they replace.
+
+    Parameters
+    ----------
+    tracks : pd.DataFrame - the cleaned listens
+
+    key : str - the column to group by
+
+    column : str - the bucket column
+
+    Returns
+    -------
+    pd.DataFrame - the counts indexed by key with one "{column}_{value}" column per bucket
+    """
+    counts = tracks.groupby([key, column]).size().unstack(fill_value=0)
+    return counts.add_prefix(f"{column}_").astype(np.int64)
+
+def _group_buckets(tracks_cleaned, key, drop_columns):
+    """ Sums the listens of each key and counts them per time bucket
+
+    Parameters
+    ----------
+    tracks_cleaned : pd.DataFrame - the cleaned listens
+
+    key : str - the column to group by
+
+    drop_columns : list - the columns to leave out of the sums, skipped if not present
+
+    Returns
+    -------
+    pd.DataFrame - the sums, a play_count column and the bucket counts, indexed by key
+    """
+    dropped = [column for column in drop_columns if column in tracks_cleaned.columns]
+    totals = tracks_cleaned.drop(columns=dropped + BUCKET_COLUMNS).assign(play_count=1).groupby(key).sum()
+    buckets = [count_buckets(tracks_cleaned, key, column) for column in BUCKET_COLUMNS]
+    return pd.concat([totals] + buckets, axis=1)
+
+def group(tracks_cleaned):
+    """ Groups the cleaned listens by track and by artist
+
+    Parameters
+    ----------
+    tracks_cleaned : pd.DataFrame - the cleaned listens
+
+    Returns
+    -------
+    tuple (pd.DataFrame, pd.DataFrame) - the grouped tracks and the grouped artists
+    """
+    tracks_songs = _group_buckets(tracks_cleaned, "track_name", ["artist_name", "day", "minute", "play_id"])
+    tracks_artists = _group_buckets(tracks_cleaned, "artist_name", ["track_name", "day", "minute", "play_id"])
+    return tracks_songs, tracks_artists
@@ -0,0 +1,133 @@
+""" On disk columnar cache of DataFrames keyed by a fingerprint of the files they were built from """
+import hashlib
+import json
+import os
+
+import pandas as pd
+import numpy as np
+
+CACHE_DIR = "cache"
+CACHE_VERSION = 3
+
+def fingerprint(paths):
+    """ Fingerprints files by their path, size and modification time. Missing files are part of the fingerprint too.
+
+    Parameters
+    ----------
+    paths : list - the paths of the files
+
+    Returns
+    -------
+    str - a hex digest that changes whenever any of the files change
+    """
+    stats = [CACHE_VERSION]
+    for path in paths:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            stats.append([path, stat.st_size, stat.st_mtime_ns])
+        else:
+            stats.append([path, None, None])
+    return hashlib.sha256(json.dumps(stats).encode("utf-8")).hexdigest()
+
+def save_frame(df, path, key):
+    """ Saves the columns of a DataFrame to a compressed npz file along with the fingerprint it was built from
+
+    Text columns are stored as the codes of pd.factorize and an array of their distinct values, so each value costs
+    one code rather than the width of the longest string, and missing values are kept as code -1.
+
+    Parameters
+    ----------
+    df : pd.DataFrame - the frame to save
+
+    path : str - the path of the npz file
+
+    key : str - the fingerprint of the frame's sources
+
+    Returns
+    -------
+    None
+    """
+    arrays = {}
+    object_columns = []
+    none_columns = []
+    for column in df.columns:
+        values = df[column].to_numpy()
+        if values.dtype != object:
+            arrays[f"col_{column}"] = values
+            continue
+        codes, categories = pd.factorize(values)
+        if not all(isinstance(category, str) for category in categories):
+            raise TypeError(f"Only text object columns can be cached, {column} has other values")
+        object_columns.append(column)
+        # Missing values come back as None if that is all they were, NaN otherwise
+        if (codes == -1).any() and all(value is None for value in values[codes == -1]):
+            none_columns.append(column)
+        arrays[f"col_{column}"] = codes.astype(np.int32)
+        arrays[f"cat_{column}"] = np.array(list(categories), dtype=str)
+    arrays["__key__"] = np.array(key)
+    arrays["__columns__"] = np.array(list(df.columns), dtype=str)
+    arrays["__object_columns__"] = np.array(object_columns, dtype=str)
+    arrays["__none_columns__"] = np.array(none_columns, dtype=str)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(tmp_path, path)
+
+def load_frame(path, key):
+    """ Loads a DataFrame saved with save_frame if it was built from sources with the given fingerprint
+
+    Parameters
+    ----------
+    path : str - the path of the npz file
+
+    key : str - the fingerprint of the frame's sources
+
+    Returns
+    -------
+    pd.DataFrame or None - the frame, or None if it is missing or stale
+    """
+    if not os.path.exists(path):
+        return None
+    with np.load(path, allow_pickle=False) as arrays:
+        if str(arrays["__key__"]) != key:
+            return None
+        object_columns = set(arrays["__object_columns__"].tolist())
+        none_columns = set(arrays["__none_columns__"].tolist())
+        df = pd.DataFrame()
+        for column in arrays["__columns__"].tolist():
+            values = arrays[f"col_{column}"]
+            if column in object_columns:
+                codes = values
+                values = np.empty(len(codes), dtype=object)
+                values[:] = None if column in none_columns else np.nan
+                present = codes != -1
+                values[present] = arrays[f"cat_{column}"].astype(object)[codes[present]]
+                values = pd.Series(values, dtype=object)
+            df[column] = values
+    return df
+
+def cached_frame(name, sources, build):
+    """ Returns the cached frame for name if none of its sources changed since it was built, otherwise builds it
+    and caches the result
+
+    Parameters
+    ----------
+    name : str - the name of the cache entry
+
+    sources : list - the paths of the files the frame is built from
+
+    build : function - builds the frame when the cache is missing or stale
+
+    Returns
+    -------
+    pd.DataFrame - the frame
+    """
+    path = os.path.join(CACHE_DIR, f"{name}.npz")
+    key = fingerprint(sources)
+    df = load_frame(path, key)
+    if df is None:
+        df = build()
+        save_frame(df, path, key)
+    return df
@@ -0,0 +1,65 @@
+""" Vectorized cleaning of raw listen tables """
+import pandas as pd
+import numpy as np
+
+TIME_FORMAT = "%Y-%m-%d %H:%M"
+
+def parse_end_times(end_times):
+    """ Parses a column of end time strings to datetimes in a single pass
+
+    Both the extended history format ("2013-06-08 17:45:34 UTC") and the yearly format ("2020-01-01 12:34") are
+    accepted. Seconds are dropped, matching the minute resolution of the yearly data.
+
+    Parameters
+    ----------
+    end_times : pd.Series - the end time strings
+
+    Returns
+    -------
+    pd.Series - the parsed datetimes
+    """
+    return pd.to_datetime(end_times.astype(str).str.slice(0, 16), format=TIME_FORMAT)
+
+def add_time_columns(df, end_times):
+    """ Adds the year, month, day, weekday, hour, minute, year_month and timestamp columns derived from end_times
+
+    Parameters
+    ----------
+    df : pd.DataFrame - the listens to add the columns to
+
+    end_times : pd.Series - the datetimes the listens ended at, aligned with df
+
+    Returns
+    -------
+    pd.DataFrame - df with the time columns added
+    """
+    dt = end_times.dt
+    df['year'] = dt.year.astype(np.int64)
+    df['month'] = dt.month.astype(np.int64)
+    df['day'] = dt.day.astype(np.int64)
+    df['weekday'] = dt.weekday.astype(np.int64)
+    df['hour'] = dt.hour.astype(np.int64)
+    df['minute'] = dt.minute.astype(np.int64)
+    df['year_month'] = (df['year'] * 100 + df['month']).astype(str)
+    df['timestamp'] = end_times.values.astype('datetime64[s]').astype(np.int64)
+    return df
+
+def clean_listens(df):
+    """ Types the name columns and replaces end_time with its time components, sorted by end time
+
+    Parameters
+    ----------
+    df : pd.DataFrame - listens with track_name, artist_name, ms_played and end_time columns
+
+    Returns
+    -------
+    pd.DataFrame - the cleaned listens
+    """
+    df = df.copy()
+    df['track_name'] = df['track_name'].astype(str)
+    df['artist_name'] = df['artist_name'].astype(str)
+    df['ms_played'] = pd.to_numeric(df['ms_played'])
+    df['end_time'] = parse_end_times(df['end_time'])
+    df = add_time_columns(df, df['end_time'])
+    df = df.sort_values(by='end_time', kind='mergesort').reset_index(drop=True)
+    return df.drop(columns=['end_time'])
@@ -0,0 +1,114 @@
+""" Versioned fixed width binary encoding of listen records
+
+A record is the UTC epoch second a listen ended and its ms_played, both little endian uint32. An encoded block is one
+version byte followed by the records. Firestore stores blocks as bytes and the json files as base64 text.
+"""
+import base64
+
+import numpy as np
+
+CODEC_VERSION = 1
+RECORD_DTYPE = np.dtype([("timestamp", "<u4"), ("ms_played", "<u4")])
+MAX_UINT32 = 2 ** 32 - 1
+
+def encode_listens(timestamps, ms_played):
+    """ Packs listens into an encoded block
+
+    Parameters
+    ----------
+    timestamps : array like - the UTC epoch seconds the listens ended
+
+    ms_played : array like - the ms played of each listen
+
+    Returns
+    -------
+    bytes - the version byte followed by one record per listen
+    """
+    timestamps = np.asarray(timestamps, dtype=np.float64).round()
+    ms_played = np.asarray(ms_played, dtype=np.int64)
+    if len(timestamps) != len(ms_played):
+        raise ValueError(f"Got {len(timestamps)} timestamps but {len(ms_played)} ms_played")
+    for name, values in (("timestamps", timestamps), ("ms_played", ms_played)):
+        if len(values) and (values.min() < 0 or values.max() > MAX_UINT32):
+            raise ValueError(f"{name} must fit in an unsigned 32 bit int")
+    records = np.empty(len(timestamps), dtype=RECORD_DTYPE)
+    records["timestamp"] = timestamps
+    records["ms_played"] = ms_played
+    return bytes([CODEC_VERSION]) + records.tobytes()
+
+def decode_listens(data):
+    """ Unpacks an encoded block
+
+    Parameters
+    ----------
+    data : bytes - the encoded block
+
+    Returns
+    -------
+    tuple (np.ndarray, np.ndarray) - the int64 UTC epoch seconds and ms_played of each listen
+    """
+    if len(data) == 0 or data[0] != CODEC_VERSION:
+        raise ValueError(f"Unsupported listen record version {data[0] if len(data) else None}")
+    if (len(data) - 1) % RECORD_DTYPE.itemsize != 0:
+        raise ValueError(f"Listen records are {len(data) - 1} bytes, not a multiple of {RECORD_DTYPE.itemsize}")
+    records = np.frombuffer(data, dtype=RECORD_DTYPE, offset=1)
+    return records["timestamp"].astype(np.int64), records["ms_played"].astype(np.int64)
+
+def decode_chunks(chunks):
+    """ Unpacks several encoded blocks, such as the records array of a listen bucket, one after another
+
+    Parameters
+    ----------
+    chunks : list of bytes - the encoded blocks
+
+    Returns
+    -------
+    tuple (np.ndarray, np.ndarray) - the int64 UTC epoch seconds and ms_played of each listen
+    """
+    decoded = [decode_listens(chunk) for chunk in chunks]
+    if len(decoded) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate([t for t, _ in decoded]), np.concatenate([m for _, m in decoded])
+
+def to_text(data):
+    """ Encodes a block as base64 so it can be saved in json """
+    return base64.b64encode(data).decode("ascii")
+
+def from_text(text):
+    """ Decodes a block saved with to_text """
+    return base64.b64decode(text)
+
+def listens_from_dicts(listens):
+    """ Reads listens stored as dicts of time fields, as they were before this codec, assuming the fields are in UTC
+
+    Parameters
+    ----------
+    listens : list - the dicts with year, month, day, hour, optionally minute and second, and duration
+
+    Returns
+    -------
+    tuple (np.ndarray, np.ndarray) - the int64 UTC epoch seconds and ms_played of each listen
+    """
+    fields = {
+        field: np.array([listen.get(field, 0) for listen in listens], dtype=np.int64)
+        for field in ["year", "month", "day", "hour", "minute", "second", "duration"]
+    }
+    months = (fields["year"] - 1970) * 12 + fields["month"] - 1
+    days = months.astype("datetime64[M]").astype("datetime64[D]").astype(np.int64) + fields["day"] - 1
+    timestamps = days * 86400 + fields["hour"] * 3600 + fields["minute"] * 60 + fields["second"]
+    return timestamps, fields["duration"]
+
+def track_listens(track):
+    """ Reads the listens of a track aggregate or song snapshot, from its base64 records or its legacy listens list
+
+    Parameters
+    ----------
+    track : dict - the track with a records or a listens field
+
+    Returns
+    -------
+    tuple (np.ndarray, np.ndarray) - the int64 UTC epoch seconds and ms_played of each listen
+    """
+    if "records" in track:
+        return decode_listens(from_text(track["records"]))
+    return listens_from_dicts(track.get("listens", []))
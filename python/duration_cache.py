@@ -0,0 +1,171 @@
+""" Persistent least recently used cache of track durations in front of the spotify tracks endpoint
+
+Durations are kept in a SQLite file and warmed from tracks_info_final.json and the songs snapshot written by
+export.py, so a track that has been played before costs no API call. Tracks that are not cached are fetched up to
+MAX_TRACKS_PER_REQUEST at a time.
+"""
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from reader import iter_json_object, iter_ndjson_documents
+
+# The most ids the spotify tracks endpoint takes in one request
+MAX_TRACKS_PER_REQUEST = 50
+
+# Ids of tracks without a spotify id are hashes, see Listener._get_track_id, which spotify can not look up
+SPOTIFY_ID = re.compile(r"^[0-9A-Za-z]{22}$")
+
+class DurationCache():
+    """ Caches the duration in ms of each track id, evicting the least recently used beyond max_entries
+
+    Parameters
+    ----------
+    fetch_tracks : function - takes a list of at most MAX_TRACKS_PER_REQUEST track ids and returns the response of
+    the spotify tracks endpoint for them, such as spotipy.Spotify.tracks
+
+    path : str (default="track_durations.db") - the SQLite file
+
+    max_entries : int (default=100000) - the most durations kept
+    """
+    def __init__(self, fetch_tracks, path="track_durations.db", max_entries=100000):
+        self.fetch_tracks = fetch_tracks
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS durations (track_id TEXT PRIMARY KEY, duration_ms INTEGER, last_used REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS durations_last_used ON durations (last_used)")
+        self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM durations").fetchone()[0]
+
+    def put_many(self, durations, last_used=None):
+        """ Caches durations, replacing any already cached for the same ids
+
+        Parameters
+        ----------
+        durations : dict - the duration in ms of each track id
+
+        last_used : float (default=None) - when the tracks were last used, now if None. Warming uses 0 so the
+        warmed durations are evicted before any that were looked up.
+
+        Returns
+        -------
+        None
+        """
+        last_used = time.time() if last_used is None else last_used
+        rows = [(track_id, int(duration_ms), last_used) for track_id, duration_ms in durations.items() if duration_ms]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO durations (track_id, duration_ms, last_used) VALUES (?, ?, ?) ON CONFLICT(track_id) "
+                "DO UPDATE SET duration_ms = excluded.duration_ms, last_used = MAX(last_used, excluded.last_used)",
+                rows
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """ Deletes the least recently used durations beyond max_entries. The lock must be held. """
+        excess = self._conn.execute("SELECT COUNT(*) FROM durations").fetchone()[0] - self.max_entries
+        if excess > 0:
+            self._conn.execute(
+                "DELETE FROM durations WHERE track_id IN "
+                "(SELECT track_id FROM durations ORDER BY last_used LIMIT ?)", (excess,)
+            )
+
+    def _lookup(self, track_ids):
+        """ Gets the cached durations of track_ids and marks them used """
+        with self._lock:
+            found = {}
+            for start in range(0, len(track_ids), 500):
+                chunk = track_ids[start:start + 500]
+                found.update(self._conn.execute(
+                    f"SELECT track_id, duration_ms FROM durations WHERE track_id IN ({','.join('?' * len(chunk))})",
+                    chunk
+                ).fetchall())
+            now = time.time()
+            self._conn.executemany("UPDATE durations SET last_used = ? WHERE track_id = ?", [(now, i) for i in found])
+            self._conn.commit()
+        return found
+
+    def get_many(self, track_ids):
+        """ Gets the durations of several tracks, fetching those that are not cached in batches
+
+        Parameters
+        ----------
+        track_ids : list - the track ids
+
+        Returns
+        -------
+        dict - the duration in ms of each track id, 0 for tracks spotify does not have
+        """
+        track_ids = list(dict.fromkeys(track_ids))
+        durations = self._lookup(track_ids)
+        self.hits += len(durations)
+        missing = [track_id for track_id in track_ids if track_id not in durations]
+        self.misses += len(missing)
+
+        fetchable = [track_id for track_id in missing if SPOTIFY_ID.match(track_id)]
+        fetched = {}
+        for start in range(0, len(fetchable), MAX_TRACKS_PER_REQUEST):
+            self.requests += 1
+            response = self.fetch_tracks(fetchable[start:start + MAX_TRACKS_PER_REQUEST])
+            for track in response["tracks"]:
+                if track is not None and track.get("duration_ms"):
+                    fetched[track["id"]] = track["duration_ms"]
+        self.put_many(fetched)
+        durations.update(fetched)
+        return {track_id: durations.get(track_id, 0) for track_id in track_ids}
+
+    def get(self, track_id):
+        """ Gets the duration in ms of a track, fetching it if it is not cached, or 0 if spotify does not have it """
+        return self.get_many([track_id])[track_id]
+
+    def warm(self, info_path="tracks_info_final.json", snapshot_path="snapshot/songs.ndjson"):
+        """ Caches the durations in the track info table and the songs snapshot, where they exist, without marking
+        them used
+
+        Parameters
+        ----------
+        info_path : str (default="tracks_info_final.json") - the track info keyed by track id, with duration_ms
+
+        snapshot_path : str (default="snapshot/songs.ndjson") - the songs exported by export.py, with duration
+
+        Returns
+        -------
+        int - the number of durations cached
+        """
+        durations = {}
+        if os.path.exists(info_path):
+            for track_id, info in iter_json_object(info_path):
+                durations[track_id] = info.get("duration_ms")
+        if os.path.exists(snapshot_path):
+            for track_id, song in iter_ndjson_documents(snapshot_path):
+                durations[track_id] = song.get("duration") or durations.get(track_id)
+        self.put_many(durations, last_used=0)
+        return len(durations)
+
+    def metrics(self):
+        """ Gets the hits, misses, hit rate, spotify requests made for misses and number of cached durations """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0,
+            "requests": self.requests,
+            "entries": len(self),
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
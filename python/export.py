@@ -0,0 +1,356 @@
+""" Concurrent, paginated export of the Firestore collections to a local newline delimited json snapshot
+
+Usage: python export.py --workers 4, or python export.py --sync to only read the documents changed since the last run
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import partial
+
+from google.api_core.datetime_helpers import DatetimeWithNanoseconds
+from google.cloud.firestore_v1.field_path import FieldPath
+
+from firebase import LISTEN_BUCKETS, UPDATED_AT, FireManager, snapshot_song
+
+SNAPSHOT_DIR = "snapshot"
+MANIFEST_FILE = "manifest.json"
+
+# Sync reads again the documents written this long before the last sync, in case their commits landed out of order
+SYNC_OVERLAP = timedelta(minutes=5)
+SYNC_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# How document_line starts a line and separates the id from the update time, which _line_header reads directly
+LINE_ID_PREFIX = '{"id": '
+LINE_UPDATE_TIME_SEPARATOR = ', "update_time": '
+
+def iter_pages(query, page_size, order_by=FieldPath.document_id()):
+    """ Streams the documents of a query one page at a time, resuming each page from a cursor on the last document
+    so no single request has to read the whole collection
+
+    Parameters
+    ----------
+    query : google.cloud.firestore_v1.query.Query - the collection or query to page through
+
+    page_size : int - the number of documents per request
+
+    order_by : str (default=document id) - the field to order by, which must be the field of any inequality filter
+
+    Returns
+    -------
+    generator of DocumentSnapshot - the documents in order
+    """
+    query = query.order_by(order_by).limit(page_size)
+    last = None
+    while True:
+        page = list((query if last is None else query.start_after(last)).stream())
+        yield from page
+        if len(page) < page_size:
+            return
+        last = page[-1]
+
+def update_time_text(snapshot):
+    """ Gets a document's update time as RFC 3339 text. Older clients give a protobuf Timestamp, newer a datetime. """
+    if hasattr(snapshot.update_time, "ToJsonString"):
+        return snapshot.update_time.ToJsonString()
+    return snapshot.update_time.rfc3339()
+
+def document_line(doc_id, update_time, data):
+    """ Formats one document as a line of an ndjson snapshot, see reader.iter_ndjson_documents """
+    return json.dumps({"id": doc_id, "update_time": update_time, "data": data}, default=str) + "\n"
+
+def _line_header(line):
+    """ Decodes the id and update time at the start of a snapshot line without decoding its data. A line that is not
+    formatted as document_line writes it is decoded whole. """
+    decoder = json.JSONDecoder()
+    if line.startswith(LINE_ID_PREFIX):
+        try:
+            doc_id, end = decoder.raw_decode(line, len(LINE_ID_PREFIX))
+            if line.startswith(LINE_UPDATE_TIME_SEPARATOR, end):
+                update_time, _ = decoder.raw_decode(line, end + len(LINE_UPDATE_TIME_SEPARATOR))
+                return doc_id, update_time
+        except json.JSONDecodeError:
+            pass
+    document = json.loads(line)
+    return document["id"], document["update_time"]
+
+class Exporter():
+    """ Exports the songs, artists, artist list and history_{year} collections to one ndjson file each, several
+    collections at a time, or syncs only the documents that changed since the last export
+
+    Every file is written to a temporary path and only replaces the previous snapshot once all of the collections
+    have been exported, after which the manifest listing them is written. A failed export leaves the previous
+    snapshot as it was.
+
+    Parameters
+    ----------
+    fb : FireManager - the firebase manager to read with
+
+    directory : str (default=SNAPSHOT_DIR) - the directory of the snapshot
+
+    page_size : int (default=500) - the number of documents read per request
+
+    max_workers : int (default=4) - the most collections exported at once
+    """
+    def __init__(self, fb, directory=SNAPSHOT_DIR, page_size=500, max_workers=4):
+        self.fb = fb
+        self.directory = directory
+        self.page_size = page_size
+        self.max_workers = max_workers
+
+    def _collections(self):
+        """ Gets the collections in the snapshot keyed by name """
+        collections = {
+            "songs": self.fb.song_collection,
+            "artists": self.fb.artist_collection,
+            "utils": self.fb.artist_list_doc.parent,
+        }
+        for collection in self.fb.get_history_collections():
+            collections[collection.id] = collection
+        return collections
+
+    def _path(self, name):
+        return os.path.join(self.directory, f"{name}.ndjson")
+
+    def _document_data(self, name, doc):
+        """ Gets the data saved for a document. Songs are saved with the listens of their year buckets as records. """
+        if name != "songs":
+            return doc.to_dict()
+        buckets = [bucket.to_dict() for bucket in doc.reference.collection(LISTEN_BUCKETS).stream()]
+        return snapshot_song(doc.to_dict(), buckets)
+
+    def _export_collection(self, name, collection, path):
+        """ Writes the documents of a collection to path line by line
+
+        Returns
+        -------
+        tuple (int, datetime) - the number of documents written and the latest UPDATED_AT among them
+        """
+        num_docs = 0
+        synced_to = None
+        with open(path, "w", encoding="utf-8") as f:
+            for doc in iter_pages(collection, self.page_size):
+                data = doc.to_dict()
+                f.write(document_line(doc.id, update_time_text(doc), data))
+                num_docs += 1
+                synced_to = _latest(synced_to, data.get(UPDATED_AT))
+        return num_docs, synced_to
+
+    def _export_songs(self, name, collection, path):
+        """ Writes the songs to path line by line with the listens of their year buckets as records
+
+        The songs and the buckets are both paged in document path order, which sorts buckets by their song's id, so
+        each song's buckets are read alongside it without holding the collection in memory.
+
+        Returns
+        -------
+        tuple (int, datetime) - the number of songs written and the latest UPDATED_AT among them
+        """
+        buckets = (
+            bucket for bucket in iter_pages(self.fb.db.collection_group(LISTEN_BUCKETS), self.page_size)
+            if bucket.reference.parent.parent is not None
+            and bucket.reference.parent.parent.parent.id == collection.id
+        )
+        bucket = next(buckets, None)
+        num_docs = 0
+        synced_to = None
+        with open(path, "w", encoding="utf-8") as f:
+            for doc in iter_pages(collection, self.page_size):
+                song_buckets = []
+                # Skip the buckets of songs before this one, which have no song document
+                while bucket is not None and bucket.reference.parent.parent.id <= doc.id:
+                    if bucket.reference.parent.parent.id == doc.id:
+                        song_buckets.append(bucket.to_dict())
+                    bucket = next(buckets, None)
+                data = doc.to_dict()
+                f.write(document_line(doc.id, update_time_text(doc), snapshot_song(data, song_buckets)))
+                num_docs += 1
+                synced_to = _latest(synced_to, data.get(UPDATED_AT))
+        return num_docs, synced_to
+
+    def _sync_collection(self, name, collection, path, synced_to):
+        """ Writes the snapshot of a collection to path with only the documents changed since synced_to read again
+
+        Documents written since synced_to, less SYNC_OVERLAP for commits that land out of order, are queried by
+        UPDATED_AT. Those whose update time matches their line in the snapshot are kept as they are, the rest of the
+        changed lines are replaced and new documents are appended. A write can change a song's listen buckets without
+        its document, so for songs the buckets are queried by UPDATED_AT too and their songs always read again.
+
+        Returns
+        -------
+        tuple (int, datetime, int) - the number of documents, the latest UPDATED_AT and the number of documents read
+        again
+        """
+        since = DatetimeWithNanoseconds.from_rfc3339(synced_to) - SYNC_OVERLAP if synced_to else SYNC_EPOCH
+        changed = {}
+        for doc in iter_pages(collection.where(UPDATED_AT, ">", since), self.page_size, order_by=UPDATED_AT):
+            changed[doc.id] = doc
+            synced_to = _latest(synced_to, doc.get(UPDATED_AT))
+        stale = set()
+        if name == "songs":
+            stale, synced_to = self._changed_bucket_songs(collection, since, synced_to)
+            unread = sorted(stale - set(changed))
+            for start in range(0, len(unread), self.page_size):
+                doc_refs = [collection.document(doc_id) for doc_id in unread[start:start + self.page_size]]
+                changed.update((doc.id, doc) for doc in self.fb.db.get_all(doc_refs) if doc.exists)
+
+        num_docs = 0
+        num_read = 0
+        with open(self._path(name), "r", encoding="utf-8") as old, open(path, "w", encoding="utf-8") as f:
+            for line in old:
+                if not line.strip():
+                    continue
+                doc_id, update_time = _line_header(line)
+                doc = changed.pop(doc_id, None)
+                if doc is None or (update_time_text(doc) == update_time and doc_id not in stale):
+                    f.write(line)
+                else:
+                    f.write(document_line(doc.id, update_time_text(doc), self._document_data(name, doc)))
+                    num_read += 1
+                num_docs += 1
+            for doc in changed.values():
+                f.write(document_line(doc.id, update_time_text(doc), self._document_data(name, doc)))
+                num_read += 1
+                num_docs += 1
+        return num_docs, synced_to, num_read
+
+    def _changed_bucket_songs(self, collection, since, synced_to):
+        """ Gets the ids of the songs whose listen buckets were written after since
+
+        Returns
+        -------
+        tuple (set, datetime) - the song ids and synced_to advanced to the latest UPDATED_AT of the buckets
+        """
+        song_ids = set()
+        query = self.fb.db.collection_group(LISTEN_BUCKETS).where(UPDATED_AT, ">", since)
+        for bucket in iter_pages(query, self.page_size, order_by=UPDATED_AT):
+            song_ref = bucket.reference.parent.parent
+            if song_ref is not None and song_ref.parent.id == collection.id:
+                song_ids.add(song_ref.id)
+                synced_to = _latest(synced_to, bucket.get(UPDATED_AT))
+        return song_ids, synced_to
+
+    def _replace(self, jobs):
+        """ Runs the jobs, each writing one collection to a temporary file, then replaces the snapshot with the
+        files and writes the manifest
+
+        Parameters
+        ----------
+        jobs : dict - a function taking the temporary path and returning the number of documents and the latest
+        UPDATED_AT, keyed by collection name
+
+        Returns
+        -------
+        dict - the manifest, with the export time and the file, number of documents and the latest UPDATED_AT of
+        each collection
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        exported_at = time.time()
+        paths = {name: self._path(name) for name in jobs}
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                futures = {name: pool.submit(job, paths[name] + ".tmp") for name, job in jobs.items()}
+                results = {name: future.result() for name, future in futures.items()}
+        except BaseException:
+            for path in paths.values():
+                if os.path.exists(path + ".tmp"):
+                    os.remove(path + ".tmp")
+            raise
+
+        for path in paths.values():
+            os.replace(path + ".tmp", path)
+        manifest = {"exported_at": exported_at, "collections": {}}
+        for name, (num_docs, synced_to) in results.items():
+            manifest["collections"][name] = {
+                "path": os.path.basename(paths[name]),
+                "documents": num_docs,
+                "synced_to": synced_to.rfc3339() if isinstance(synced_to, DatetimeWithNanoseconds) else synced_to,
+            }
+        with open(os.path.join(self.directory, MANIFEST_FILE), "w") as f:
+            f.write(json.dumps(manifest))
+        return manifest
+
+    def read_manifest(self):
+        """ Reads the manifest of the snapshot, or None if nothing has been exported """
+        path = os.path.join(self.directory, MANIFEST_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def export(self):
+        """ Exports every collection and replaces the snapshot with them
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        dict - the manifest, see _replace
+        """
+        jobs = {}
+        for name, collection in self._collections().items():
+            export_collection = self._export_songs if name == "songs" else self._export_collection
+            jobs[name] = partial(export_collection, name, collection)
+        return self._replace(jobs)
+
+    def sync(self):
+        """ Patches the snapshot with the documents changed since it was last exported or synced. Collections that
+        are not in the snapshot yet are exported whole, and if there is no snapshot everything is.
+
+        Documents that were last written before UPDATED_AT was added are only picked up by export.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        dict - the manifest, see _replace, with the number of documents read again as "read" for each synced
+        collection
+        """
+        manifest = self.read_manifest()
+        if manifest is None:
+            return self.export()
+
+        num_read = {}
+        def sync_job(name, collection, synced_to, path):
+            num_docs, synced_to, num_read[name] = self._sync_collection(name, collection, path, synced_to)
+            return num_docs, synced_to
+
+        jobs = {}
+        for name, collection in self._collections().items():
+            if name in manifest["collections"]:
+                jobs[name] = partial(sync_job, name, collection, manifest["collections"][name].get("synced_to"))
+            else:
+                export_collection = self._export_songs if name == "songs" else self._export_collection
+                jobs[name] = partial(export_collection, name, collection)
+        manifest = self._replace(jobs)
+        for name, read in num_read.items():
+            manifest["collections"][name]["read"] = read
+        return manifest
+
+def _latest(current, value):
+    """ Gets the later of two UPDATED_AT values, either of which may be missing """
+    if value is None:
+        return current
+    if isinstance(current, str):
+        current = DatetimeWithNanoseconds.from_rfc3339(current)
+    return value if current is None or value > current else current
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exports the firebase collections to a local ndjson snapshot")
+    parser.add_argument("--directory", default=SNAPSHOT_DIR, help="the directory of the snapshot")
+    parser.add_argument("--workers", type=int, default=4, help="the most collections exported at once")
+    parser.add_argument("--page-size", type=int, default=500, help="the number of documents read per request")
+    parser.add_argument("--sync", action="store_true", help="only read the documents changed since the last run")
+    args = parser.parse_args()
+
+    exporter = Exporter(FireManager(), directory=args.directory, page_size=args.page_size, max_workers=args.workers)
+    manifest = exporter.sync() if args.sync else exporter.export()
+    for name, collection in manifest["collections"].items():
+        read = f", {collection['read']} read again" if "read" in collection else ""
+        print(f"{name}: {collection['documents']} documents{read}")
@@ -0,0 +1,364 @@
+""" In-process stand-in for the subset of the Firestore client that FireManager and export.py use
+
+Every request is one round trip: it is counted, can be delayed by a fixed latency and can be made to fail, so the
+cost of the write and read paths can be measured without the live project. Pass a FakeClient to FireManager as its
+client.
+"""
+import copy
+import random
+import threading
+import time
+from collections import Counter
+from datetime import timezone
+
+from google.api_core.datetime_helpers import DatetimeWithNanoseconds
+from google.api_core.exceptions import AlreadyExists, NotFound, ServiceUnavailable
+from google.cloud.firestore_v1.transforms import (DELETE_FIELD, SERVER_TIMESTAMP, ArrayRemove, ArrayUnion,
+                                                  Increment)
+
+DOCUMENT_ID = "__name__"
+
+def _split(path):
+    return path.split("/")
+
+def _get_field(data, field_path):
+    """ Gets a possibly dotted field of data, raising KeyError if it is missing """
+    value = data
+    for field in field_path.split("."):
+        if not isinstance(value, dict) or field not in value:
+            raise KeyError(field_path)
+        value = value[field]
+    return value
+
+def _transform(current, value, now):
+    """ Gets the value a field takes when value is written over current, applying any transform """
+    if value is SERVER_TIMESTAMP:
+        return now
+    if isinstance(value, Increment):
+        return (current if isinstance(current, (int, float)) else 0) + value.value
+    if isinstance(value, ArrayUnion):
+        result = list(current) if isinstance(current, list) else []
+        for item in value.values:
+            if item not in result:
+                result.append(item)
+        return result
+    if isinstance(value, ArrayRemove):
+        current = current if isinstance(current, list) else []
+        return [item for item in current if item not in value.values]
+    if isinstance(value, dict):
+        return _merge({}, value, now)
+    return copy.deepcopy(value)
+
+def _merge(data, values, now):
+    """ Writes values over data in place, merging nested dicts as a set with merge=True does """
+    for field, value in values.items():
+        if value is DELETE_FIELD:
+            data.pop(field, None)
+        elif isinstance(value, dict) and isinstance(data.get(field), dict):
+            _merge(data[field], value, now)
+        else:
+            data[field] = _transform(data.get(field), value, now)
+    return data
+
+def _update(data, values, now):
+    """ Writes values over data in place, with the keys as dotted field paths as update does """
+    for field_path, value in values.items():
+        *parents, field = field_path.split(".")
+        target = data
+        for parent in parents:
+            if not isinstance(target.get(parent), dict):
+                target[parent] = {}
+            target = target[parent]
+        if value is DELETE_FIELD:
+            target.pop(field, None)
+        else:
+            target[field] = _transform(target.get(field), value, now)
+    return data
+
+class FakeDocumentSnapshot():
+    def __init__(self, reference, data, update_time):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self.update_time = update_time
+        self._data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+    def get(self, field_path):
+        return copy.deepcopy(_get_field(self._data or {}, field_path))
+
+class FakeDocumentReference():
+    def __init__(self, client, path):
+        self._client = client
+        self.path = path
+        self.id = _split(path)[-1]
+
+    @property
+    def parent(self):
+        return FakeCollectionReference(self._client, self.path.rsplit("/", 1)[0])
+
+    def collection(self, collection_id):
+        return FakeCollectionReference(self._client, f"{self.path}/{collection_id}")
+
+    def get(self):
+        self._client._round_trip("get")
+        return self._client._snapshot(self)
+
+    def set(self, data, merge=False):
+        batch = self._client.batch()
+        batch.set(self, data, merge=merge)
+        batch.commit(op="set")
+
+    def update(self, data):
+        batch = self._client.batch()
+        batch.update(self, data)
+        batch.commit(op="update")
+
+    def delete(self):
+        batch = self._client.batch()
+        batch.delete(self)
+        batch.commit(op="delete")
+
+class FakeQuery():
+    """ A query over a collection, or over every collection with an id when all_descendants is True """
+    def __init__(self, client, collection_path, all_descendants=False, filters=(), orders=(), limit=None,
+                 start_after=None):
+        self._client = client
+        self._collection_path = collection_path
+        self._all_descendants = all_descendants
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+        self._start_after = start_after
+
+    def _copy(self, **changes):
+        kwargs = {
+            "filters": self._filters, "orders": self._orders, "limit": self._limit, "start_after": self._start_after,
+        }
+        kwargs.update(changes)
+        return FakeQuery(self._client, self._collection_path, self._all_descendants, **kwargs)
+
+    def where(self, field_path, op, value):
+        return self._copy(filters=self._filters + ((field_path, op, value),))
+
+    def order_by(self, field_path):
+        return self._copy(orders=self._orders + (field_path,))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, snapshot):
+        return self._copy(start_after=snapshot)
+
+    def _matches(self, path):
+        parts = _split(path)
+        if self._all_descendants:
+            return len(parts) >= 2 and parts[-2] == _split(self._collection_path)[-1]
+        return path.rsplit("/", 1)[0] == self._collection_path
+
+    def _sort_key(self, path, data):
+        # Documents are always ordered by path last, as Firestore does
+        return tuple(_get_field(data, order) for order in self._orders if order != DOCUMENT_ID) + (_split(path),)
+
+    def stream(self):
+        self._client._round_trip("stream")
+        with self._client._lock:
+            docs = [(path, doc) for path, doc in self._client._docs.items() if self._matches(path)]
+        rows = []
+        for path, doc in docs:
+            try:
+                if all(_compare(_get_field(doc["data"], field), op, value) for field, op, value in self._filters):
+                    rows.append((self._sort_key(path, doc["data"]), path, doc))
+            except KeyError:
+                continue
+        rows.sort(key=lambda row : row[0])
+        if self._start_after is not None:
+            cursor = self._sort_key(self._start_after.reference.path, self._start_after._data)
+            rows = [row for row in rows if row[0] > cursor]
+        if self._limit is not None:
+            rows = rows[:self._limit]
+        for _, path, doc in rows:
+            yield FakeDocumentSnapshot(FakeDocumentReference(self._client, path), copy.deepcopy(doc["data"]),
+                                       doc["update_time"])
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, client, path):
+        super().__init__(client, path)
+        self.id = _split(path)[-1]
+
+    @property
+    def parent(self):
+        if "/" not in self._collection_path:
+            return None
+        return FakeDocumentReference(self._client, self._collection_path.rsplit("/", 1)[0])
+
+    def document(self, document_id):
+        return FakeDocumentReference(self._client, f"{self._collection_path}/{document_id}")
+
+    def list_documents(self):
+        self._client._round_trip("list_documents")
+        with self._client._lock:
+            paths = [path for path in self._client._docs if self._matches(path)]
+        return [FakeDocumentReference(self._client, path) for path in sorted(paths)]
+
+def _compare(field_value, op, value):
+    if op == "==":
+        return field_value == value
+    if op == "<":
+        return field_value < value
+    if op == "<=":
+        return field_value <= value
+    if op == ">":
+        return field_value > value
+    if op == ">=":
+        return field_value >= value
+    if op == "array_contains":
+        return isinstance(field_value, list) and value in field_value
+    raise ValueError(f"Unsupported operator {op}")
+
+class FakeWriteBatch():
+    """ Applies its writes all at once when committed, or none of them if any update targets a missing document or
+    any create targets an existing one """
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def create(self, reference, data):
+        self._writes.append(("create", reference, data, False))
+
+    def set(self, reference, data, merge=False):
+        self._writes.append(("set", reference, data, merge))
+
+    def update(self, reference, data):
+        self._writes.append(("update", reference, data, False))
+
+    def delete(self, reference):
+        self._writes.append(("delete", reference, None, False))
+
+    def commit(self, op="commit"):
+        error = self._client._round_trip(op, writes=True)
+        self._client._apply(self._writes)
+        self._writes = []
+        if error is not None:
+            raise error(f"Injected failure of {op} after it was applied")
+
+class FakeClient():
+    """ Stores documents in memory and answers the Firestore client calls FireManager makes
+
+    Parameters
+    ----------
+    latency : float (default=0) - the seconds each round trip takes
+
+    failure_rate : float (default=0) - the chance that a round trip fails with ServiceUnavailable
+
+    seed : int (default=0) - the seed of the failures
+    """
+    def __init__(self, latency=0, failure_rate=0, seed=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.calls = Counter()
+        self._random = random.Random(seed)
+        self._failures = []
+        self._docs = {}
+        self._lock = threading.Lock()
+        self._last_time = None
+
+    @property
+    def round_trips(self):
+        return sum(self.calls.values())
+
+    def reset_counts(self):
+        self.calls = Counter()
+
+    def fail_next(self, count=1, error=ServiceUnavailable, ops=None, applied=False):
+        """ Makes the next count round trips, or the next count of the ops named in ops, raise error. If applied, the
+        error of a commit is raised after its writes are applied, as when a commit succeeds but its response is
+        lost. """
+        for _ in range(count):
+            self._failures.append((error, ops, applied))
+
+    def _round_trip(self, op, writes=False):
+        """ Counts a round trip and raises any failure due for it. For a round trip that writes, the error of a
+        failure due after the writes are applied is returned for the caller to raise once it has applied them. """
+        with self._lock:
+            self.calls[op] += 1
+            error = None
+            applied = False
+            for idx, (failure, ops, after_apply) in enumerate(self._failures):
+                if ops is None or op in ops:
+                    error, applied = failure, after_apply
+                    del self._failures[idx]
+                    break
+            if error is None and self.failure_rate and self._random.random() < self.failure_rate:
+                error = ServiceUnavailable
+        if self.latency:
+            time.sleep(self.latency)
+        if error is not None and applied and writes:
+            return error
+        if error is not None:
+            raise error(f"Injected failure of {op}")
+        return None
+
+    def _now(self):
+        """ A commit time later than every earlier one, as a server timestamp is """
+        now = DatetimeWithNanoseconds.fromtimestamp(time.time(), tz=timezone.utc)
+        if self._last_time is not None and now <= self._last_time:
+            now = DatetimeWithNanoseconds.fromtimestamp(self._last_time.timestamp() + 1e-6, tz=timezone.utc)
+        self._last_time = now
+        return now
+
+    def _snapshot(self, reference):
+        with self._lock:
+            doc = self._docs.get(reference.path)
+            if doc is None:
+                return FakeDocumentSnapshot(reference, None, None)
+            return FakeDocumentSnapshot(reference, copy.deepcopy(doc["data"]), doc["update_time"])
+
+    def _apply(self, writes):
+        """ Applies the writes in order to a copy of the documents that replaces them only if every write succeeds """
+        with self._lock:
+            now = self._now()
+            staged = {}
+            for kind, reference, data, merge in writes:
+                doc = staged[reference.path] if reference.path in staged else self._docs.get(reference.path)
+                if kind == "delete":
+                    staged[reference.path] = None
+                    continue
+                if kind == "update" and doc is None:
+                    raise NotFound(f"No document to update: {reference.path}")
+                if kind == "create" and doc is not None:
+                    raise AlreadyExists(f"Document already exists: {reference.path}")
+                current = copy.deepcopy(doc["data"]) if doc is not None and (merge or kind == "update") else {}
+                if kind == "update":
+                    current = _update(current, data, now)
+                else:
+                    current = _merge(current, data, now)
+                staged[reference.path] = {"data": current, "update_time": now}
+            for path, doc in staged.items():
+                if doc is None:
+                    self._docs.pop(path, None)
+                else:
+                    self._docs[path] = doc
+
+    def collection(self, collection_id):
+        return FakeCollectionReference(self, collection_id)
+
+    def collection_group(self, collection_id):
+        return FakeQuery(self, collection_id, all_descendants=True)
+
+    def collections(self):
+        with self._lock:
+            ids = sorted(set(_split(path)[0] for path in self._docs))
+        return [FakeCollectionReference(self, collection_id) for collection_id in ids]
+
+    def document(self, path):
+        return FakeDocumentReference(self, path)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def get_all(self, references):
+        self._round_trip("get_all")
+        return [self._snapshot(reference) for reference in references]
@@ -1,39 +1,177 @@
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import json
+import os
 
+import numpy as np
 from google.cloud.firestore_v1 import Increment
-from google.api_core.exceptions import ServiceUnavailable
+from google.api_core.exceptions import (Aborted, AlreadyExists, DeadlineExceeded, InternalServerError, NotFound,
+                                        ResourceExhausted, ServiceUnavailable, TooManyRequests)
 import firebase_admin
 from firebase_admin import credentials, firestore
 
+from codec import decode_chunks, encode_listens, listens_from_dicts, to_text
+
+# Each song's listens are kept in one document per year under songs/{track_id}/listens/{year}, so the song
+# document stays a fixed size no matter how often the song is played. A bucket's records field is an array of
+# blocks encoded by codec.encode_listens, one for each listen added live and one for each bulk upload.
+LISTEN_BUCKETS = u"listens"
+
+# Each song and artist has a rollup document of its listen_count and listen_time per month, keyed "YYYYMM", per
+# weekday, keyed 0 for Monday, and per hour, all in UTC, so pages can chart them without reading every listen. The
+# artist rollup also has the totals of each of its tracks and the tracks listened to in each month.
+SONG_ROLLUPS = u"song_rollups"
+ARTIST_ROLLUPS = u"artist_rollups"
+
+# The listens of the previous week are kept in one document per UTC day under overview/prev_week/days/{YYYY-MM-DD},
+# so a day expires by deleting its document. Eight days are kept so the playlist's local week is always covered.
+PREV_WEEK_DAYS = 8
+
+# Each listen written live creates a marker document listen_markers/{track_id}_{end time in ms} in the same batch.
+# Its Increments are not safe to apply twice, and a commit that fails with DeadlineExceeded or Aborted may still have
+# been applied, so a retry whose markers already exist fails with AlreadyExists and only the unapplied listens are
+# written again.
+LISTEN_MARKERS = u"listen_markers"
+
+# A listen is at most 12 writes, initializing its artist and song, adding it to the week and creating its marker, and
+# a batch at most 500
+MAX_LISTENS_PER_BATCH = 40
+
+# Errors that a write can be retried after
+RETRYABLE_ERRORS = (Aborted, DeadlineExceeded, InternalServerError, ResourceExhausted, ServiceUnavailable, TooManyRequests)
+
+# Every write to the synced collections sets this field to the commit time, so export.py can query what changed
+UPDATED_AT = u"updated_at"
+
 def save_dict_json(my_dict, filename):
     with open(f"{filename}.json", "w") as f:
         f.write(json.dumps(my_dict))
 
+def stamped(data):
+    """ Adds the UPDATED_AT server timestamp to the data of a write """
+    return dict(data, **{UPDATED_AT: firestore.SERVER_TIMESTAMP})
+
+def bucket_listens(timestamps, ms_played):
+    """ Groups the listens of a song into the year bucket documents they are stored in
+
+    Parameters
+    ----------
+    timestamps : np.ndarray - the UTC epoch seconds the listens ended
+
+    ms_played : np.ndarray - the ms played of each listen
+
+    Returns
+    -------
+    dict - the bucket document of each year keyed by year, with the year, listen_count, listen_time and the listens
+    encoded as a single records block
+    """
+    years = np.asarray(timestamps).astype("datetime64[s]").astype("datetime64[Y]").astype(np.int64) + 1970
+    buckets = {}
+    for year in np.unique(years).tolist():
+        in_year = years == year
+        buckets[year] = {
+            "year": year,
+            "listen_count": int(in_year.sum()),
+            "listen_time": int(ms_played[in_year].sum()),
+            "records": [encode_listens(timestamps[in_year], ms_played[in_year])],
+        }
+    return buckets
+
+def listen_marker_id(track_id, timestamp):
+    """ Gets the id of the marker document of a listen of track_id that ended at the datetime timestamp """
+    return f"{track_id}_{int(round(timestamp.timestamp() * 1000))}"
+
+def rollup_key(year, month):
+    """ Gets the key of a month in the month field of a rollup """
+    return f"{year}{month:02d}"
+
+def listen_rollup(time_info, ms_played):
+    """ Gets the increments a listen makes to the month, weekday and hour fields of a rollup
+
+    Parameters
+    ----------
+    time_info : dict - the time fields of the listen, see FireManager._get_time_info
+
+    ms_played : int - the ms played of the listen
+
+    Returns
+    -------
+    dict - the rollup fields, to be written with set(..., merge=True)
+    """
+    def stats():
+        return {"listen_count": Increment(1), "listen_time": Increment(ms_played)}
+    return {
+        "month": {rollup_key(time_info["year"], time_info["month"]): stats()},
+        "weekday": {str(time_info["weekday"]): stats()},
+        "hour": {str(time_info["hour"]): stats()},
+    }
+
+def _read_bucket(bucket):
+    """ Reads the listens of a year bucket, including any stored as a list of dicts before they were encoded """
+    timestamps, ms_played = decode_chunks(bucket.get("records", []))
+    legacy_timestamps, legacy_ms_played = listens_from_dicts(bucket.get("listens", []))
+    return np.concatenate([legacy_timestamps, timestamps]), np.concatenate([legacy_ms_played, ms_played])
+
+def snapshot_song(song, buckets):
+    """ Gets a song as it is saved in local snapshots, with its listens as base64 records, see codec.py
+
+    Parameters
+    ----------
+    song : dict - the song document
+
+    buckets : list - the song's listen bucket documents in year order
+
+    Returns
+    -------
+    dict - the song without any legacy listens list and with the listens of the song and its buckets as records
+    """
+    song = dict(song)
+    listens = [listens_from_dicts(song.pop("listens", []))] + [_read_bucket(bucket) for bucket in buckets]
+    timestamps = np.concatenate([t for t, _ in listens])
+    ms_played = np.concatenate([m for _, m in listens])
+    song["records"] = to_text(encode_listens(timestamps, ms_played))
+    return song
+
 class FireManager():
-    """ Deals with all firebase interactions """
-    def __init__(self):
-        cred = credentials.Certificate("config.json")
-        fb = firebase_admin.initialize_app(cred, {
-            "project_id": "spotifydataexplorer-81773"
-        })
-        self.db = firestore.client()
+    """ Deals with all firebase interactions 
+    
+    Parameters
+    ----------
+    known_ids_path : str (default="known_ids.json") - the local snapshot of the artist and song ids already in firebase
+
+    client : google.cloud.firestore.Client (default=None) - the client to use, such as a fake_firestore.FakeClient.
+    If None the app is initialized from config.json and its client is used.
+    """
+    def __init__(self, known_ids_path="known_ids.json", client=None):
+        if client is None:
+            cred = credentials.Certificate("config.json")
+            fb = firebase_admin.initialize_app(cred, {
+                "project_id": "spotifydataexplorer-81773"
+            })
+            client = firestore.client()
+        self.db = client
         self.artist_collection = self.db.collection(u"artists")
         self.song_collection = self.db.collection(u"songs")
         self.artist_list_doc = self.db.collection(u"utils").document(u"artist_list")
+        self.song_rollup_collection = self.db.collection(SONG_ROLLUPS)
+        self.artist_rollup_collection = self.db.collection(ARTIST_ROLLUPS)
+        self.listen_marker_collection = self.db.collection(LISTEN_MARKERS)
         self.prev_week_doc = self.db.collection(u"overview").document(u"prev_week")
-        self.prev_week_stage_doc = self.db.collection(u"overview").document(u"prev_week_stage")
+        self.prev_week_days = self.prev_week_doc.collection(u"days")
         years = list(range(2013, 2022))
         years.remove(2014)
         self.history_collections = {}
         for year in years:
             self.history_collections[year] = self.db.collection(f"history_{year}")
+        self.known_ids_path = known_ids_path
+        self.known_artists, self.known_tracks = self._load_known_ids()
 
-    def _add_listen(self, artist_id, track_id, track_details):
+    def _add_listen(self, batch, artist_id, track_id, track_details):
         """ Adds a listen event to the firebase 
         
         Parameters
         ----------
+        batch : google.cloud.firestore_v1.batch.WriteBatch - the batch to add the writes to
+
         artist_id : str - the id of the song's artist
 
         track_id : str - the id of the song
@@ -46,31 +184,88 @@ class FireManager():
         
         """
         # Update Artist
-        self.artist_collection.document(artist_id).update({
+        batch.update(self.artist_collection.document(artist_id), {
             "listen_count": Increment(1),
             "listen_time": Increment(track_details["ms_played"]),
             "last_listen_time": track_details["time_info"],
-            "last_listen": {"track_id":track_id, "song_name":track_details["song_name"]}
+            "last_listen": {"track_id":track_id, "song_name":track_details["song_name"]},
+            UPDATED_AT: firestore.SERVER_TIMESTAMP
         })
 
         # Update Song
-        listen_info = self._get_time_info(track_details["timestamp"])
-        listen_info["duration"] = track_details["ms_played"]
-        self.song_collection.document(track_id).update({
+        batch.update(self.song_collection.document(track_id), {
             "listen_count": Increment(1),
             "listen_time": Increment(track_details["ms_played"]),
             "last_listen": track_details["time_info"],
-            "listens": firestore.ArrayUnion([listen_info])
+            UPDATED_AT: firestore.SERVER_TIMESTAMP
         })
 
+        # Add to the song's bucket for the year, creating it if this is the first listen of the year
+        year = track_details["time_info"]["year"]
+        batch.set(self.get_listen_bucket(track_id, year), {
+            "year": year,
+            "listen_count": Increment(1),
+            "listen_time": Increment(track_details["ms_played"]),
+            "records": firestore.ArrayUnion([
+                encode_listens([track_details["timestamp"].timestamp()], [track_details["ms_played"]])
+            ]),
+            UPDATED_AT: firestore.SERVER_TIMESTAMP
+        }, merge=True)
+
+        # Add to the song and artist rollups, creating them if this is the first listen
+        time_info = track_details["time_info"]
+        batch.set(self.song_rollup_collection.document(track_id), {
+            "track_id": track_id,
+            **listen_rollup(time_info, track_details["ms_played"]),
+            UPDATED_AT: firestore.SERVER_TIMESTAMP
+        }, merge=True)
+        batch.set(self.artist_rollup_collection.document(artist_id), {
+            "artist_id": artist_id,
+            **listen_rollup(time_info, track_details["ms_played"]),
+            "tracks": {track_id: {"listen_count": Increment(1), "listen_time": Increment(track_details["ms_played"])}},
+            "month_songs": {rollup_key(time_info["year"], time_info["month"]): firestore.ArrayUnion([track_id])},
+            UPDATED_AT: firestore.SERVER_TIMESTAMP
+        }, merge=True)
+
         # Add to History
-        self.history_collections[track_details['time_info']['year']].document(f"{track_details['time_info']['month']}").update({
+        batch.update(self.history_collections[track_details['time_info']['year']].document(f"{track_details['time_info']['month']}"), {
             "listen_count": Increment(1),
             "listen_time": Increment(track_details["ms_played"]),
             "uq_artists": firestore.ArrayUnion([artist_id]),
-            "uq_songs": firestore.ArrayUnion([track_id])
+            "uq_songs": firestore.ArrayUnion([track_id]),
+            UPDATED_AT: firestore.SERVER_TIMESTAMP
         })
 
+    def _add_to_week(self, batch, track_id, artist_id, track_details):
+        """ Adds a listen to the previous week's songs, in the bucket of the day it was listened to
+
+        Parameters
+        ----------
+        batch : google.cloud.firestore_v1.batch.WriteBatch - the batch to add the write to
+
+        track_id : str - the id of the track
+
+        artist_id : str - the id of the artist
+
+        track_details : dict - the information about the listen
+
+        Returns
+        -------
+        None
+        """
+        day = self._prev_week_day(track_details["timestamp"])
+        batch.set(self.prev_week_days.document(day), {
+            "day": day,
+            "tracks": firestore.ArrayUnion([{
+                "artist_id": artist_id,
+                "artist_name": track_details["artist_name"],
+                "listen_time": track_details["ms_played"],
+                "song_name": track_details["song_name"],
+                "track_id": track_id,
+                "timestamp": track_details["timestamp"]
+            }])
+        }, merge=True)
+
     def _doc_to_dict(self, doc):
         """ Converts a document to a dictionary
 
@@ -84,6 +279,20 @@ class FireManager():
         """
         return doc.get().to_dict()
         
+    def _get_snapshots(self, doc_refs):
+        """ Reads several documents in a single request
+
+        Parameters
+        ----------
+        doc_refs : list - the document references to read
+
+        Returns
+        -------
+        list - the document snapshots in the same order as doc_refs
+        """
+        snapshots = {snapshot.reference.path: snapshot for snapshot in self.db.get_all(doc_refs)}
+        return [snapshots[doc_ref.path] for doc_ref in doc_refs]
+
     def _get_time_info(self, dt):
         """ Gets a dictionary of the elements of the datetime 
         
@@ -105,11 +314,13 @@ class FireManager():
         info["second"] = dt.time().second
         return info
 
-    def _init_artist(self, artist_id, track_id, track_details):
+    def _init_artist(self, batch, artist_id, track_id, track_details):
         """ Adds a new artist to firebase for the first time 
         
         Parameters
         ----------
+        batch : google.cloud.firestore_v1.batch.WriteBatch - the batch to add the writes to
+
         artist_id : str - the id of the song's artist
 
         track_id : str - the id of the first song played
@@ -120,8 +331,7 @@ class FireManager():
         -------
         None
         """
-        doc_ref = self.artist_collection.document(artist_id)
-        doc_ref.set({
+        batch.set(self.artist_collection.document(artist_id), {
             "artist_id": artist_id,
             "artist_name": track_details["artist_name"],
             "first_listen_time": self._get_time_info(track_details["timestamp"]),
@@ -129,10 +339,12 @@ class FireManager():
             "listen_count": 0,
             "listen_time": 0,
             "tracks": [],
+            UPDATED_AT: firestore.SERVER_TIMESTAMP
         })
 
-        self.artist_list_doc.update({
-            "list": firestore.ArrayUnion([{"artist_id":artist_id, "artist_name":track_details["artist_name"]}])
+        batch.update(self.artist_list_doc, {
+            "list": firestore.ArrayUnion([{"artist_id":artist_id, "artist_name":track_details["artist_name"]}]),
+            UPDATED_AT: firestore.SERVER_TIMESTAMP
         })
 
     def _init_history(self, year):
@@ -151,15 +363,18 @@ class FireManager():
                 "listen_count": 0,
                 "listen_time": 0,
                 "uq_artists": [],
-                "uq_songs": []
+                "uq_songs": [],
+                UPDATED_AT: firestore.SERVER_TIMESTAMP
             })
         self.history_collections[int(year)] = self.db.collection(f"history_{year}")
 
-    def _init_song(self, artist_id, track_id, track_details):
+    def _init_song(self, batch, artist_id, track_id, track_details):
         """ Adds a new song to firebase for the first time 
         
         Parameters
         ----------
+        batch : google.cloud.firestore_v1.batch.WriteBatch - the batch to add the writes to
+
         artist_id : str - the id of the song's artist
 
         track_id : str - the id of the song
@@ -170,24 +385,137 @@ class FireManager():
         -------
         None
         """
-        song_doc_ref = self.song_collection.document(track_id)
-        song_doc_ref.set({
+        batch.set(self.song_collection.document(track_id), {
             "artist_id": artist_id,
             "artist_name": track_details["artist_name"],
             "duration": track_details["duration"],
             "first_listen": self._get_time_info(track_details["timestamp"]),
             "song_name": track_details["song_name"],
             "track_id": track_id,
-            "listens": []
+            UPDATED_AT: firestore.SERVER_TIMESTAMP
         })
 
-        artist_doc_ref = self.artist_collection.document(artist_id)
-        artist_doc_ref.update({
-            "tracks": firestore.ArrayUnion([{"track_id":track_id, "song_name":track_details["song_name"]}])
+        batch.update(self.artist_collection.document(artist_id), {
+            "tracks": firestore.ArrayUnion([{"track_id":track_id, "song_name":track_details["song_name"]}]),
+            UPDATED_AT: firestore.SERVER_TIMESTAMP
         })
 
-    def add_song(self, track_id, artist_id, track_details):
+    def _load_known_ids(self):
+        """ Loads the ids of the artist and song documents from the local snapshot. If there is none, the ids are
+        listed from firebase without reading the documents and the snapshot is saved.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        tuple (set, set) - the known artist ids and the known track ids
+        """
+        if os.path.exists(self.known_ids_path):
+            with open(self.known_ids_path, "r") as f:
+                known_ids = json.load(f)
+            return set(known_ids["artists"]), set(known_ids["tracks"])
+        known_artists = set(doc_ref.id for doc_ref in self.artist_collection.list_documents())
+        known_tracks = set(doc_ref.id for doc_ref in self.song_collection.list_documents())
+        self._save_known_ids(known_artists, known_tracks)
+        return known_artists, known_tracks
+
+    def _prev_week_day(self, dt):
+        """ Gets the id of the previous week bucket of a listen at dt, its UTC date """
+        return dt.astimezone(timezone.utc).strftime("%Y-%m-%d")
+
+    def _prev_week_live_days(self):
+        """ Gets the ids of the PREV_WEEK_DAYS previous week buckets that have not expired, oldest first """
+        today = datetime.now(timezone.utc)
+        return [self._prev_week_day(today - timedelta(days=days)) for days in range(PREV_WEEK_DAYS - 1, -1, -1)]
+
+    def _save_known_ids(self, known_artists, known_tracks):
+        """ Saves the known artist and track ids to the local snapshot """
+        with open(self.known_ids_path, "w") as f:
+            f.write(json.dumps({"artists": sorted(known_artists), "tracks": sorted(known_tracks)}))
+
+    def _write_listens(self, listens):
+        """ Commits all of the writes for several listens as a single batch
+
+        Parameters
+        ----------
+        listens : list - the (artist_id, track_id, track_details, add_to_week) of each listen. The artists and songs
+        not in the known ids are read, in one request, to initialize those that are missing.
+
+        Returns
+        -------
+        None
+        """
+        batch = self.db.batch()
+        unknown_artists = sorted(set(artist_id for artist_id, _, _, _ in listens) - self.known_artists)
+        unknown_tracks = sorted(set(track_id for _, track_id, _, _ in listens) - self.known_tracks)
+        missing = set()
+        if unknown_artists or unknown_tracks:
+            doc_refs = [self.artist_collection.document(artist_id) for artist_id in unknown_artists]
+            doc_refs += [self.song_collection.document(track_id) for track_id in unknown_tracks]
+            missing = set(snapshot.reference.path for snapshot in self._get_snapshots(doc_refs) if not snapshot.exists)
+
+        for artist_id, track_id, track_details, add_to_week in listens:
+            artist_path = self.artist_collection.document(artist_id).path
+            if artist_path in missing:
+                self._init_artist(batch, artist_id, track_id, track_details)
+                missing.discard(artist_path)
+            song_path = self.song_collection.document(track_id).path
+            if song_path in missing:
+                self._init_song(batch, artist_id, track_id, track_details)
+                missing.discard(song_path)
+
+            # Increase stats, failing the whole batch if the listen was already written
+            marker_id = listen_marker_id(track_id, track_details["timestamp"])
+            batch.create(self.listen_marker_collection.document(marker_id), {
+                "track_id": track_id,
+                "timestamp": track_details["timestamp"].timestamp(),
+            })
+            self._add_listen(batch, artist_id, track_id, track_details)
+            if add_to_week:
+                self._add_to_week(batch, track_id, artist_id, track_details)
+        batch.commit()
+
+        if unknown_artists or unknown_tracks:
+            self.known_artists.update(unknown_artists)
+            self.known_tracks.update(unknown_tracks)
+            self._save_known_ids(self.known_artists, self.known_tracks)
+
+    def _unwritten_listens(self, listens):
+        """ Gets the listens whose marker documents do not exist, reading them in one request
+
+        Parameters
+        ----------
+        listens : list - the (artist_id, track_id, track_details, add_to_week) of each listen
+
+        Returns
+        -------
+        list - the listens that have not been written, in the same order
+        """
+        doc_refs = [
+            self.listen_marker_collection.document(listen_marker_id(track_id, track_details["timestamp"]))
+            for _, track_id, track_details, _ in listens
+        ]
+        return [listen for listen, snapshot in zip(listens, self._get_snapshots(doc_refs)) if not snapshot.exists]
+
+    def _write_new_listens(self, listens):
+        """ Writes the listens with _write_listens, skipping any whose marker shows an earlier commit wrote them """
+        try:
+            self._write_listens(listens)
+        except AlreadyExists:
+            # An earlier commit that reported an error was applied, so only the listens it did not hold are written
+            listens = self._unwritten_listens(listens)
+            if listens:
+                self._write_listens(listens)
+
+    def add_song(self, track_id, artist_id, track_details, add_to_week=False):
         """ Adds a song to the firebase if it is not already in there. If it is, it increases the play count and time for the song and artist 
+
+        Every write for the listen is committed as one atomic batch, so a failure never leaves a listen half applied.
+        The artist and song are only read, in one request, when they are not in the known ids. Adding a listen that
+        was already written, such as on a retry after a commit that was applied but reported an error, does nothing,
+        see LISTEN_MARKERS.
         
         Parameters
         ----------
@@ -197,26 +525,49 @@ class FireManager():
 
         track_details : dict - the information about the track to add to firebase
 
+        add_to_week : bool (default=False) - whether to also add the listen to the previous week's list of songs
+
         Returns
         -------
         None
         """
-        if artist_id == "":
-            artist_id = track_id
-        track_details["time_info"] = self._get_time_info(track_details["timestamp"])
+        self.add_songs([(track_id, artist_id, track_details, add_to_week)])
 
-        # Check if artist exists
-        artist = self.artist_collection.document(artist_id).get()
-        if not artist.exists:
-            self._init_artist(artist_id, track_id, track_details)
+    def add_songs(self, listens):
+        """ Adds several listens as one atomic batch, see add_song
 
-        # Check if song exists
-        song = self.song_collection.document(track_id).get()
-        if not song.exists:
-            self._init_song(artist_id, track_id, track_details)
+        Parameters
+        ----------
+        listens : list - the (track_id, artist_id, track_details, add_to_week) of each listen in the order they were
+        listened to, at most MAX_LISTENS_PER_BATCH
 
-        # Increase stats
-        self._add_listen(artist_id, track_id, track_details)
+        Returns
+        -------
+        None
+        """
+        if len(listens) > MAX_LISTENS_PER_BATCH:
+            raise ValueError(f"At most {MAX_LISTENS_PER_BATCH} listens can be added at once, got {len(listens)}")
+        prepared = []
+        for track_id, artist_id, track_details, add_to_week in listens:
+            if artist_id == "":
+                artist_id = track_id
+            track_details["time_info"] = self._get_time_info(track_details["timestamp"])
+            prepared.append((artist_id, track_id, track_details, add_to_week))
+
+        # Only the artists and songs that are not known to exist already are read
+        known = all(
+            artist_id in self.known_artists and track_id in self.known_tracks for artist_id, track_id, _, _ in prepared
+        )
+        try:
+            self._write_new_listens(prepared)
+        except NotFound:
+            if not known:
+                raise
+            # The local snapshot is stale, so check the documents this time
+            for artist_id, track_id, _, _ in prepared:
+                self.known_artists.discard(artist_id)
+                self.known_tracks.discard(track_id)
+            self._write_new_listens(prepared)
 
     def merge_tracks(self, track_id1, track_id2):
         """ Merges the listening information for two tracks that should be the same ids 
@@ -268,7 +619,8 @@ class FireManager():
         save_dict_json(artist_list, "firebase_artist_list")
 
     def download_history(self):
-        """ Downloads and saves the artist list as a dictionary to firebase_history.json
+        """ Downloads and saves the history documents as a dictionary keyed by collection then month to
+        firebase_history.json
         
         Paramaters
         ----------
@@ -279,14 +631,32 @@ class FireManager():
         None
         """
         history_dict = {}
-        for collection in self.history_collections:
+        for collection in self.get_history_collections():
+            history_dict[collection.id] = {}
             history_docs = collection.stream()
             for doc in history_docs:
                 history_dict[collection.id][doc.id] = doc.to_dict()
         save_dict_json(history_dict, "firebase_history")
 
+    def get_history_collections(self):
+        """ Lists every history_{year} collection in firebase, including years added since this manager was made
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        list - the history collections in year order
+        """
+        collections = [collection for collection in self.db.collections() if collection.id.startswith("history_")]
+        return sorted(collections, key=lambda collection : collection.id)
+
     def download_songs(self):
         """ Downloads and saves the song documents as a dictionary to firebase_songs.json
+
+        The listens of every song are read from the year buckets with one collection group query, together with any
+        listens still stored on the song document itself, and saved as the song's base64 records, see codec.py.
         
         Paramaters
         ----------
@@ -297,11 +667,107 @@ class FireManager():
         None
         """
         song_dict = {}
+        song_buckets = {}
         song_docs = self.song_collection.stream()
         for doc in song_docs:
             song_dict[doc.id] = doc.to_dict()
+            song_buckets[doc.id] = []
+        for track_id, bucket in self.stream_listen_buckets():
+            if track_id in song_buckets:
+                song_buckets[track_id].append(bucket)
+        for track_id in song_dict:
+            song_dict[track_id] = snapshot_song(song_dict[track_id], song_buckets[track_id])
         save_dict_json(song_dict, "firebase_songs")
 
+    def stream_listen_buckets(self):
+        """ Streams the listen buckets of every song with one collection group query
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        generator of (str, dict) - the track_id and data of each bucket, in track_id then year order
+        """
+        for doc in self.db.collection_group(LISTEN_BUCKETS).stream():
+            # Only song buckets, not any other collection that happens to be named the same
+            song_ref = doc.reference.parent.parent
+            if song_ref is not None and song_ref.parent.id == self.song_collection.id:
+                yield song_ref.id, doc.to_dict()
+
+    def get_listen_bucket(self, track_id, year):
+        """ Gets the document holding a song's listens in a year
+
+        Parameters
+        ----------
+        track_id : str - the id of the song
+
+        year : int - the year of the listens
+
+        Returns
+        -------
+        google.cloud.firestore_v1.document.DocumentReference - the bucket document
+        """
+        return self.song_collection.document(track_id).collection(LISTEN_BUCKETS).document(f"{year}")
+
+    def get_listen_timestamps(self, track_years):
+        """ Gets when the written listens of several songs ended, reading their year buckets in one request
+
+        Parameters
+        ----------
+        track_years : list - the (track_id, year) of each bucket to read
+
+        Returns
+        -------
+        dict - the UTC epoch seconds of the listens of each track id, empty for buckets that do not exist
+        """
+        track_years = sorted(set(track_years))
+        if len(track_years) == 0:
+            return {}
+        doc_refs = [self.get_listen_bucket(track_id, year) for track_id, year in track_years]
+        timestamps = {track_id: [] for track_id, _ in track_years}
+        for (track_id, _), snapshot in zip(track_years, self._get_snapshots(doc_refs)):
+            if snapshot.exists:
+                timestamps[track_id].append(_read_bucket(snapshot.to_dict())[0])
+        return {
+            track_id: np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int64)
+            for track_id, chunks in timestamps.items()
+        }
+
+    def migrate_listens(self):
+        """ Moves the listens still stored as lists of dicts, on song documents or in year buckets, into encoded
+        year buckets
+
+        Each song is moved in one batch that also removes the list, so an interrupted migration can be run again. A
+        song's buckets are read and rewritten whole, so run it while the listener is stopped.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        int - the number of songs migrated
+        """
+        num_migrated = 0
+        for doc in self.song_collection.stream():
+            song = doc.to_dict()
+            buckets = [bucket_doc.to_dict() for bucket_doc in doc.reference.collection(LISTEN_BUCKETS).stream()]
+            if "listens" not in song and not any("listens" in bucket for bucket in buckets):
+                continue
+            listens = [listens_from_dicts(song.get("listens", []))] + [_read_bucket(bucket) for bucket in buckets]
+            timestamps = np.concatenate([t for t, _ in listens])
+            ms_played = np.concatenate([m for _, m in listens])
+            batch = self.db.batch()
+            for year, bucket in bucket_listens(timestamps, ms_played).items():
+                batch.set(self.get_listen_bucket(doc.id, year), stamped(bucket))
+            if "listens" in song:
+                batch.update(doc.reference, {"listens": firestore.DELETE_FIELD, UPDATED_AT: firestore.SERVER_TIMESTAMP})
+            batch.commit()
+            num_migrated += 1
+        return num_migrated
+
     def get_track_doc(self, track_id):
         """ Reads the specified track's document from firebase 
         
@@ -344,7 +810,7 @@ class FireManager():
         None
         """
         artist_doc_ref = self.artist_collection.document(artist_id)
-        artist_doc_ref.set(artist_info)
+        artist_doc_ref.set(stamped(artist_info))
 
     def set_artist_list(self, artist_list):
         """ Sets the entire artist_list information, overwriting any existing data 
@@ -357,7 +823,7 @@ class FireManager():
         -------
         None
         """
-        self.artist_list_doc.set({"list":artist_list})
+        self.artist_list_doc.set(stamped({"list":artist_list}))
 
     def set_history(self, history):
         """ Sets the entire history information, overwriting any existing data 
@@ -375,7 +841,7 @@ class FireManager():
         for year in history:
             for month in history[year]:
                 month_doc_ref = self.history_collections[int(year)].document(f"{month}")
-                month_doc_ref.set(history[year][month])
+                month_doc_ref.set(stamped(history[year][month]))
 
     def set_track(self, track_id, track_info):
         """ Sets the track information at the given track_id, overwriting any existing data 
@@ -391,47 +857,78 @@ class FireManager():
         None
         """
         song_doc_ref = self.song_collection.document(track_id)
-        song_doc_ref.set(track_info)
+        song_doc_ref.set(stamped(track_info))
 
     def add_to_week(self, track_id, artist_id, track_details):
         """ Adds to previous week's list of songs
         """
-        self.prev_week_doc.update({
-            "tracks": firestore.ArrayUnion([{
-                "artist_id": artist_id,
-                "artist_name": track_details["artist_name"],
-                "listen_time": track_details["ms_played"],
-                "song_name": track_details["song_name"],
-                "track_id": track_id,
-                "timestamp": track_details["timestamp"]
-            }])
-        })
+        batch = self.db.batch()
+        self._add_to_week(batch, track_id, artist_id, track_details)
+        batch.commit()
 
     def get_prev_week(self):
-        """ Gets the previous week doc from firebase
-        
+        """ Gets the listens of the previous week from the buckets of the days that have not expired, all read in
+        one request
+
         Parameters
         ----------
         None
 
         Returns
         -------
-        dict - the previous week doc in a dictionary
+        dict - the listens of the buckets as "tracks", oldest day first
         """
-        return self.prev_week_doc.get().to_dict()
+        doc_refs = [self.prev_week_days.document(day) for day in self._prev_week_live_days()]
+        tracks = []
+        for snapshot in self._get_snapshots(doc_refs):
+            if snapshot.exists:
+                tracks.extend(snapshot.to_dict()["tracks"])
+        return {"tracks": tracks}
 
-    def set_prev_week(self, tracks, stage=True):
-        """ Sets the previous week doc to tracks
+    def expire_prev_week(self):
+        """ Deletes the previous week buckets of the days before the last PREV_WEEK_DAYS. The bucket ids are listed
+        without reading the buckets, so this costs the same however far behind it is.
 
         Parameters
         ----------
-        tracks (dict) : the tracks to add to prev week.
-
-        stage (bool, default=True) : whether to write to stage or regular
+        None
 
         Returns
         -------
+        list - the days deleted
+        """
+        oldest_day = self._prev_week_live_days()[0]
+        expired = [doc_ref for doc_ref in self.prev_week_days.list_documents() if doc_ref.id < oldest_day]
+        for start in range(0, len(expired), 500):
+            batch = self.db.batch()
+            for doc_ref in expired[start:start + 500]:
+                batch.delete(doc_ref)
+            batch.commit()
+        return [doc_ref.id for doc_ref in expired]
+
+    def migrate_prev_week(self):
+        """ Moves the listens of the old single previous week document into the day buckets and empties it
+
+        Parameters
+        ----------
         None
+
+        Returns
+        -------
+        int - the number of listens moved
         """
-        doc = self.prev_week_stage_doc if stage else self.prev_week_doc
-        doc.set(tracks)
+        prev_week = self.prev_week_doc.get()
+        tracks = prev_week.to_dict().get("tracks", []) if prev_week.exists else []
+        oldest_day = self._prev_week_live_days()[0]
+        days = {}
+        for track in tracks:
+            day = self._prev_week_day(track["timestamp"])
+            if day >= oldest_day:
+                days.setdefault(day, []).append(track)
+        batch = self.db.batch()
+        for day, day_tracks in days.items():
+            batch.set(self.prev_week_days.document(day), {"day": day, "tracks": firestore.ArrayUnion(day_tracks)}, merge=True)
+        if prev_week.exists:
+            batch.update(self.prev_week_doc, {"tracks": firestore.DELETE_FIELD})
+        batch.commit()
+        return sum(len(day_tracks) for day_tracks in days.values())
@@ -0,0 +1,241 @@
+""" Incrementally merges new listens into the existing agg_* outputs of aggregate.py """
+import os
+
+import pandas as pd
+import numpy as np
+
+from aggregate import (STATE_FILE, agg_artists, agg_rollups, agg_tracks, get_cached_fb_info, get_cached_info, new_listens,
+                       read_dict_json, read_high_water_mark, save_dict_json, save_high_water_mark)
+from codec import encode_listens, to_text, track_listens
+from firebase import FireManager
+from upload import BulkUploader, aggregate_writes
+
+def _union(old, new):
+    """ Appends the items of new that are not in old, keeping order """
+    seen = set(old)
+    return old + [item for item in new if item not in seen]
+
+def merge_tracks(tracks, new_tracks):
+    """ Merges track aggregates of newer listens into tracks in place
+
+    Parameters
+    ----------
+    tracks : dict - the existing track aggregates keyed by track_id
+
+    new_tracks : dict - the track aggregates of listens newer than any in tracks
+
+    Returns
+    -------
+    list - the ids of the tracks that changed
+    """
+    for track_id, new in new_tracks.items():
+        if track_id not in tracks:
+            tracks[track_id] = new
+            continue
+        track = tracks[track_id]
+        track["last_listen"] = new["last_listen"]
+        track["listen_count"] += new["listen_count"]
+        track["listen_time"] += new["listen_time"]
+        # The existing records are read as either format, so an agg_tracks from before the codec is upgraded
+        timestamps, ms_played = track_listens(track)
+        new_timestamps, new_ms_played = track_listens(new)
+        track.pop("listens", None)
+        track["records"] = to_text(encode_listens(
+            np.concatenate([timestamps, new_timestamps]), np.concatenate([ms_played, new_ms_played])
+        ))
+    return list(new_tracks)
+
+def merge_history(history, new_history):
+    """ Merges monthly history of newer listens into history in place. Keys are stored as strings, as they are when
+    read back from agg_history.json.
+
+    Parameters
+    ----------
+    history : dict - the existing history keyed by year then month
+
+    new_history : dict - the history of listens newer than any in history
+
+    Returns
+    -------
+    list - the (year, month) keys that changed
+    """
+    changed = []
+    for year, months in new_history.items():
+        year_history = history.setdefault(f"{year}", {})
+        for month, new in months.items():
+            changed.append((f"{year}", f"{month}"))
+            if f"{month}" not in year_history:
+                year_history[f"{month}"] = new
+                continue
+            month_history = year_history[f"{month}"]
+            month_history["listen_count"] += new["listen_count"]
+            month_history["listen_time"] += new["listen_time"]
+            month_history["uq_artists"] = _union(month_history["uq_artists"], new["uq_artists"])
+            month_history["uq_songs"] = _union(month_history["uq_songs"], new["uq_songs"])
+    return changed
+
+def merge_artists(artists, artist_list, new_artists, new_artist_list):
+    """ Merges artist aggregates of newer listens into artists and artist_list in place
+
+    Parameters
+    ----------
+    artists : dict - the existing artist aggregates keyed by artist_id
+
+    artist_list : list - the existing artist list
+
+    new_artists : dict - the artist aggregates of listens newer than any in artists
+
+    new_artist_list : list - the artist list of the newer listens
+
+    Returns
+    -------
+    tuple (list, bool) - the ids of the artists that changed and whether the artist list changed
+    """
+    for artist_id, new in new_artists.items():
+        if artist_id not in artists:
+            artists[artist_id] = new
+            continue
+        artist = artists[artist_id]
+        artist["last_listen"] = new["last_listen"]
+        artist["last_listen_time"] = new["last_listen_time"]
+        artist["listen_count"] += new["listen_count"]
+        artist["listen_time"] += new["listen_time"]
+        known_tracks = set(track["track_id"] for track in artist["tracks"])
+        artist["tracks"].extend(track for track in new["tracks"] if track["track_id"] not in known_tracks)
+
+    known_artists = set(artist["artist_id"] for artist in artist_list)
+    added = [artist for artist in new_artist_list if artist["artist_id"] not in known_artists]
+    artist_list.extend(added)
+    return list(new_artists), len(added) > 0
+
+def _add_stats(stats, new_stats):
+    """ Adds the listen_count and listen_time of each key of new_stats to stats in place """
+    for key, new in new_stats.items():
+        if key not in stats:
+            stats[key] = dict(new)
+            continue
+        stats[key]["listen_count"] += new["listen_count"]
+        stats[key]["listen_time"] += new["listen_time"]
+
+def merge_rollups(rollups, new_rollups):
+    """ Merges song or artist rollups of newer listens into rollups in place
+
+    Parameters
+    ----------
+    rollups : dict - the existing rollups keyed by id
+
+    new_rollups : dict - the rollups of listens newer than any in rollups
+
+    Returns
+    -------
+    list - the ids of the rollups that changed
+    """
+    for doc_id, new in new_rollups.items():
+        if doc_id not in rollups:
+            rollups[doc_id] = new
+            continue
+        rollup = rollups[doc_id]
+        for field in ["month", "weekday", "hour", "tracks"]:
+            if field in new:
+                _add_stats(rollup[field], new[field])
+        for year_month, track_ids in new.get("month_songs", {}).items():
+            rollup["month_songs"][year_month] = _union(rollup["month_songs"].get(year_month, []), track_ids)
+    return list(new_rollups)
+
+def update_aggregates(info):
+    """ Merges the listens in info newer than the high water mark into the saved agg_* files and advances the mark
+
+    Parameters
+    ----------
+    info : pd.DataFrame - listens in the format returned by aggregate.get_info or aggregate.get_fb_info
+
+    Returns
+    -------
+    dict - the changed "tracks" and "artists" ids, the changed "history" (year, month) keys and whether the
+    "artist_list" changed
+    """
+    exists = os.path.exists("agg_tracks.json")
+    if exists and not os.path.exists(STATE_FILE):
+        raise FileNotFoundError(
+            f"agg_tracks.json has no {STATE_FILE}, so the listens it holds are unknown. Rebuild the agg_* files with "
+            "aggregate.py or parallel.py, which save it."
+        )
+    high_water_mark, boundary = read_high_water_mark()
+    is_new = new_listens(info, high_water_mark, boundary)
+    new_info = info[is_new]
+    changes = {"tracks": [], "artists": [], "history": [], "artist_list": False}
+    if new_info.shape[0] == 0:
+        return changes
+
+    tracks = read_dict_json("agg_tracks") if exists else {}
+    history = read_dict_json("agg_history") if exists else {}
+    artists = read_dict_json("agg_artists") if exists else {}
+    artist_list = read_dict_json("agg_artist_list") if exists else []
+    if os.path.exists("agg_song_rollups.json"):
+        song_rollups = read_dict_json("agg_song_rollups")
+        artist_rollups = read_dict_json("agg_artist_rollups")
+    else:
+        # Aggregates built before the rollups get them from the listens already merged
+        song_rollups, artist_rollups = agg_rollups(info[~is_new])
+
+    new_tracks, new_history = agg_tracks(new_info)
+    new_artists, new_artist_list = agg_artists(new_info)
+    changes["tracks"] = merge_tracks(tracks, new_tracks)
+    changes["history"] = merge_history(history, new_history)
+    changes["artists"], changes["artist_list"] = merge_artists(artists, artist_list, new_artists, new_artist_list)
+    new_song_rollups, new_artist_rollups = agg_rollups(new_info)
+    merge_rollups(song_rollups, new_song_rollups)
+    merge_rollups(artist_rollups, new_artist_rollups)
+
+    save_dict_json(tracks, "agg_tracks")
+    save_dict_json(history, "agg_history")
+    save_dict_json(artists, "agg_artists")
+    save_dict_json(artist_list, "agg_artist_list")
+    save_dict_json(song_rollups, "agg_song_rollups")
+    save_dict_json(artist_rollups, "agg_artist_rollups")
+    # Every listen in info is now merged, so the listens at the new mark are all of those in info
+    save_high_water_mark(info)
+    return changes
+
+def upload_changes(fb, changes):
+    """ Uploads only the documents listed in changes from the saved agg_* files
+
+    Parameters
+    ----------
+    fb : FireManager - the firebase manager to upload with
+
+    changes : dict - the changes returned by update_aggregates
+
+    Returns
+    -------
+    None
+    """
+    tracks = read_dict_json("agg_tracks")
+    history = read_dict_json("agg_history")
+    artists = read_dict_json("agg_artists")
+    artist_list = read_dict_json("agg_artist_list") if changes["artist_list"] else None
+    song_rollups = read_dict_json("agg_song_rollups")
+    artist_rollups = read_dict_json("agg_artist_rollups")
+
+    changed_history = {}
+    for year, month in changes["history"]:
+        changed_history.setdefault(year, {})[month] = history[year][month]
+
+    BulkUploader(fb).upload(aggregate_writes(
+        fb,
+        tracks={track_id: tracks[track_id] for track_id in changes["tracks"]},
+        history=changed_history,
+        artists={artist_id: artists[artist_id] for artist_id in changes["artists"]},
+        artist_list=artist_list,
+        # Listens are only ever added to the months that changed, so the buckets of other years are unchanged
+        listen_years=set(int(year) for year, _ in changes["history"]),
+        # A track's or artist's rollup changes exactly when it does
+        song_rollups={track_id: song_rollups[track_id] for track_id in changes["tracks"]},
+        artist_rollups={artist_id: artist_rollups[artist_id] for artist_id in changes["artists"]},
+    ))
+
+if __name__ == "__main__":
+    info = pd.concat((get_cached_info(), get_cached_fb_info())).reset_index(drop=True)
+    changes = update_aggregates(info)
+    print(f"{len(changes['tracks'])} tracks, {len(changes['artists'])} artists, {len(changes['history'])} months changed")
+    upload_changes(FireManager(), changes)
@@ -12,8 +12,12 @@ import spotipy
 import spotipy.util as util
 from spotipy.oauth2 import SpotifyClientCredentials
 
+from duration_cache import DurationCache
 from gmail import Gmail
-from firebase import FireManager, ServiceUnavailable
+from poll_scheduler import PollScheduler
+from firebase import FireManager
+from reconcile import Reconciler
+from write_queue import ListenQueue, WriteBehindWorker
 
 def print_track(track):
     with open(f"track.json", "w") as f:
@@ -33,6 +37,12 @@ class Listener():
         self.last_released_sec = 0
         self.last_update_id = ''
         self.firebase = FireManager()
+        self.queue = ListenQueue()
+        self.writer = WriteBehindWorker(self.queue, self.firebase)
+        self.scheduler = PollScheduler()
+        self.durations = DurationCache(lambda track_ids : self.spotify.tracks(track_ids))
+        self.durations.warm()
+        self.reconciler = Reconciler(self)
         self.id_map = {
             "Arctic Monkeys": "7Ln80lUS6He07XvHI8qqHH",
             "FKA Twigs": "6nB0iY1cjSY1KyhYyuIIKH",
@@ -137,7 +147,8 @@ class Listener():
             return details
 
     def _get_track_duration(self, track_id):
-        """ Gets the duration of the track in ms from the spotify api. If the track is not found 0 is returned 
+        """ Gets the duration of the track in ms from the duration cache, which only asks the spotify api for tracks
+        it has not seen. If the track is not found 0 is returned 
         
         Parameters
         ----------
@@ -148,8 +159,7 @@ class Listener():
         int - the length of the song in milliseconds
         """
         try:
-            info = self.spotify.track(track_id)
-            return info["duration_ms"]
+            return self.durations.get(track_id)
         except requests.exceptions.ReadTimeout as e:
             print(e)
             return 0
@@ -190,7 +200,44 @@ class Listener():
         token = util.prompt_for_user_token(username, scope, client_id=client_id, client_secret=client_secret, redirect_uri=redirect_uri)
         return spotipy.Spotify(auth=token)
         
-    def _should_release(self, current_id, last_id, last_track):
+    def _queue_release(self, track_id, track, info):
+        """ Queues a released listen to be written to firebase by the write behind worker, so polling never waits
+        on firebase
+
+        Parameters
+        ----------
+        track_id : str - the id of the released track
+
+        track : dict - the dictionary of information returned by the spotify current_user_playing_track endpoint
+
+        info : dict - the info about the listen, see _get_info
+
+        Returns
+        -------
+        None
+        """
+        self.queue.put(track_id, self._get_artist_id(track), info, add_to_week=True)
+        self.writer.notify()
+        metrics = self.writer.metrics()
+        polls = self.scheduler.metrics()
+        durations = self.durations.metrics()
+        print(f"Queued {info['song_name']}, {metrics['depth']} waiting, {metrics['lag_sec']:.0f}s behind | "
+              f"{polls['calls_per_hour']:.0f} polls/h, changes seen {polls['mean_latency_sec']:.1f}s late on average | "
+              f"{durations['hit_rate']:.0%} of durations cached")
+
+    def _reconcile(self):
+        """ Queues the listens in the recently played history that polling missed. A backfill is never worth
+        stopping the listener for, so any error is logged and the reconcile is tried again when it is next due. """
+        try:
+            added = self.reconciler.reconcile()
+        except Exception:
+            tb = traceback.format_exc(limit=3)
+            print(f"Reconciling recently played failed, retrying in {self.reconciler.interval_sec}s\n{tb}")
+            return
+        for _, _, info, _ in added:
+            print(f"Backfilling {info['song_name']} played at {info['timestamp']}")
+
+    def _should_release(self, current_id, last_id, last_track, now=None, track_duration=None):
         """ Decides to release info for the last track or not 
         
         Parameters
@@ -201,6 +248,10 @@ class Listener():
 
         last_track : dict - the info about the last track
 
+        now : float (default=None) - the epoch seconds the song change was seen, the current time if None
+
+        track_duration : int (default=None) - the duration of the last track in ms, looked up if None
+
         Returns
         -------
         boolean - True if info should be released false otherwise
@@ -215,14 +266,15 @@ class Listener():
             return False, None
 
         # Check if we just released anything
-        now = datetime.now().timestamp()
+        now = datetime.now().timestamp() if now is None else now
         if now - self.last_released_sec <= 22:
             return False, None
 
         # Check if we listened to at least half of the song
         last_info = None
         if last_track["currently_playing_type"] == "track" or last_track["currently_playing_type"] is None:
-            track_duration = self._get_track_duration(last_id)
+            if track_duration is None:
+                track_duration = self._get_track_duration(last_id)
             last_info = self._get_info(last_track, track_duration=track_duration)
             if track_duration > 0 and float(last_info["ms_played"])/float(track_duration) < 0.5:
                 # Reset last_released_id to allow next song to be released if it is the same as the
@@ -249,10 +301,12 @@ class Listener():
         
         """
         if track_id != self.last_update_id:
-            self.last_update_id = track_id
+            # The playing track comes with its duration, so it is cached before the track is released
+            self.durations.put_many({track_id: track["item"].get("duration_ms")})
             track_details = self._get_track_details(track_id, track)
             track_details["track_id"] = track_id
             self.firebase.update_current(track_details)
+            self.last_update_id = track_id
 
     def listen(self):
         """ Listens to the songs and outputs info whenever a new song has been listened to
@@ -267,35 +321,31 @@ class Listener():
         """
         
         gmail = Gmail()
+        self.writer.start()
         last_track = self.spotify.current_user_playing_track()
         last_id = self._get_track_id(last_track)
 
         while True:
             try:
+                # Backfill any songs played while not polling, such as before a restart or during a ReadTimeout
+                if self.reconciler.due():
+                    self._reconcile()
+
                 # Read current track from api
                 current_track = self.spotify.current_user_playing_track()
-                while current_track is None:
-                    time.sleep(10)
-                    current_track = self.spotify.current_user_playing_track()
-
                 if current_track is None or current_track["item"] is None or self._check_if_podcast(current_track):
+                    # Nothing to track, so wait longer each time
+                    self.scheduler.record_poll(None)
+                    time.sleep(self.scheduler.next_delay(None))
                     continue
 
                 current_id = self._get_track_id(current_track)
+                self.scheduler.record_poll(current_track, changed=current_id != last_id)
 
                 # Add info to database (if any)
                 should_release, last_info = self._should_release(current_id, last_id, last_track)
                 if should_release and last_info is not None:
-                    artist_id = self._get_artist_id(last_track)
-                    try:
-                        self.firebase.add_song(last_id, artist_id, last_info)
-                        self.firebase.add_to_week(last_id, artist_id, last_info)
-                    except ServiceUnavailable as e:
-                        print("Reinitializing Firebase")
-                        self.firebase = FireManager()
-                        time.sleep(5)
-                        self.firebase.add_song(last_id, artist_id, last_info)
-                        self.firebase.add_to_week(last_id, artist_id, last_info)
+                    self._queue_release(last_id, last_track, last_info)
        
                 self._update_current(current_id, current_track)
 
@@ -303,8 +353,8 @@ class Listener():
                 last_id = current_id
                 last_track = current_track
 
-                # Wait 10 seconds
-                time.sleep(10)
+                # Wait until just after the song should end, or until it is worth checking for a skip
+                time.sleep(self.scheduler.next_delay(current_track))
 
             # Check for errors
             except requests.exceptions.ReadTimeout as e:
@@ -1,9 +1,10 @@
 import json
-import re
-from datetime import datetime
 
 import pandas as pd
-import numpy as np
+
+from buckets import group as group_buckets
+from clean import clean_listens
+from reader import LISTEN_COLUMNS, read_history
 
 df_dtypes = {
     'ts':str,
@@ -32,14 +33,7 @@ df_dtypes = {
 }
 
 def read_all_tracks():
-    f = open("../data/AllSongs.json", "r")
-    rows = []
-    for row in f:
-        r = json.loads(row) 
-        rows.append(r)
-    f.close()
-    rows.reverse()
-    return rows
+    return read_history(columns=LISTEN_COLUMNS, reverse=True)
 
 def write_df_dict(df, path):
     if type(df) == pd.Series:
@@ -51,13 +45,7 @@ def write_df_dict(df, path):
         f.write(json_str)
 
 def group(tracks_cleaned):
-    plays = pd.Series(np.ones(tracks_cleaned.shape[0]).astype(int), name="play_count")
-    tracks = pd.concat((tracks_cleaned, plays), axis=1)
-    tracks = pd.get_dummies(tracks, columns=["year", "hour", "month", "year_month"])
-    tracks_songs = tracks.drop(columns=["artist_name", "day", "minute", "play_id"])
-    tracks_songs = tracks_songs.groupby('track_name').sum()
-    tracks_artists = tracks.drop(columns=["track_name", "day", "minute", "play_id"])
-    tracks_artists = tracks_artists.groupby('artist_name').sum()
+    tracks_songs, tracks_artists = group_buckets(tracks_cleaned)
     return tracks_songs, tracks_artists
 
 def clean_all(tracks):
@@ -65,22 +53,7 @@ def clean_all(tracks):
     df = df.rename(columns={'master_metadata_track_name':'track_name', 'master_metadata_album_artist_name':'artist_name', 'ts':'end_time'})
     df = df.loc[:, ['track_name', 'artist_name', 'ms_played', 'end_time']]
     df = df.dropna()
-    df['track_name'] = df['track_name'].astype(str)
-    df['artist_name'] = df['artist_name'].astype(str)
-    df['ms_played'] = pd.to_numeric(df['ms_played'])
-    df['end_time'] = df['end_time'].apply(lambda date : re.sub(r':[0-9][0-9] UTC', '', date))
-    df['end_time'] = df['end_time'].apply(lambda date_str : datetime.strptime(date_str, '%Y-%m-%d %H:%M'))
-    df['year'] = df['end_time'].apply(lambda dt : dt.date().year)
-    df['month'] = df['end_time'].apply(lambda dt : dt.date().month)
-    df['day'] = df['end_time'].apply(lambda dt : dt.date().day)
-    df['weekday'] = df['end_time'].apply(lambda dt : dt.weekday())
-    df['hour'] = df['end_time'].apply(lambda dt : dt.time().hour)
-    df['minute'] = df['end_time'].apply(lambda dt : dt.time().minute)
-    df['year_month'] = df.apply(lambda row : f"{row['year']}{0 if row['month'] < 10 else ''}{row['month']}", axis=1)
-    df['timestamp'] = df['end_time'].apply(lambda dt : int(dt.timestamp()))
-    df = df.sort_values(by='end_time').reset_index(drop=True)
-    df = df.drop(columns=['end_time'])
-    return df    
+    return clean_listens(df)
 
 def get_artist_songs(tracks):
     tracks = tracks.loc[:, ["artist_name", "track_name"]]
@@ -0,0 +1,165 @@
+""" Sharded multi-process rebuild of agg_tracks, agg_history, agg_artists and agg_artist_list
+
+Usage: python parallel.py --workers 8
+"""
+import argparse
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from aggregate import agg_artists, agg_tracks, get_cached_fb_info, get_cached_info, save_dict_json, save_high_water_mark
+
+def _categorize(info):
+    """ Stores the string columns as categoricals so shards are cheap to write and read """
+    info = info.reset_index(drop=True)
+    for column in info.columns:
+        if not pd.api.types.is_numeric_dtype(info[column]):
+            info[column] = info[column].astype("category")
+    return info
+
+def write_shards(info, key, n_shards, directory):
+    """ Partitions the listens by a hash of key and writes each partition to its own file, so workers read their
+    shard from disk instead of being sent the frame
+
+    Parameters
+    ----------
+    info : pd.DataFrame - the listens
+
+    key : str - the column to partition by
+
+    n_shards : int - the number of partitions
+
+    directory : str - the directory to write the shards to
+
+    Returns
+    -------
+    list - the paths of the non empty shards
+    """
+    shard_ids = pd.util.hash_pandas_object(info[key], index=False).values % n_shards
+    paths = []
+    for shard_id in range(n_shards):
+        shard = info[shard_ids == shard_id]
+        if shard.shape[0] == 0:
+            continue
+        path = os.path.join(directory, f"{key}_{shard_id}.pkl")
+        shard.to_pickle(path)
+        paths.append(path)
+    return paths
+
+def _agg_tracks_shard(path):
+    """ Aggregates a track shard. The tracks come back already serialized so the main process only joins them. """
+    tracks, history = agg_tracks(pd.read_pickle(path))
+    track_jsons = [(track_id, json.dumps(track)) for track_id, track in tracks.items()]
+    track_artists = {track_id: track["artist_id"] for track_id, track in tracks.items()}
+    return track_jsons, history, track_artists
+
+def _agg_artists_shard(path):
+    artists, artist_list = agg_artists(pd.read_pickle(path))
+    return [(artist_id, json.dumps(artist)) for artist_id, artist in artists.items()], artist_list
+
+def _save_json_pairs(pairs, filename):
+    """ Saves serialized (key, value) pairs sorted by key, written exactly as save_dict_json writes the dict """
+    with open(f"{filename}.json", "w") as f:
+        f.write("{" + ", ".join(f"{json.dumps(key)}: {value}" for key, value in sorted(pairs)) + "}")
+
+def _dedupe(items):
+    return list(dict.fromkeys(items))
+
+def merge_histories(histories, track_artists):
+    """ Merges the monthly history of each track shard into the history agg_tracks gives for all listens
+
+    Each shard's uq_songs lists its tracks in sorted order, so the months are ordered, and each month's artists
+    listed, by the first track listened to in them, as in agg_tracks.
+
+    Parameters
+    ----------
+    histories : list - the history dict of each shard
+
+    track_artists : dict - the artist_id of every track
+
+    Returns
+    -------
+    dict - the merged history keyed by year then month
+    """
+    months = {}
+    for history in histories:
+        for year, year_history in history.items():
+            for month, month_history in year_history.items():
+                if (year, month) not in months:
+                    months[(year, month)] = {"listen_count": 0, "listen_time": 0, "uq_songs": []}
+                months[(year, month)]["listen_count"] += month_history["listen_count"]
+                months[(year, month)]["listen_time"] += month_history["listen_time"]
+                months[(year, month)]["uq_songs"].extend(month_history["uq_songs"])
+
+    for month_history in months.values():
+        month_history["uq_songs"] = sorted(month_history["uq_songs"])
+
+    merged = {}
+    for year, month in sorted(months, key=lambda year_month : (months[year_month]["uq_songs"][0], year_month)):
+        month_history = months[(year, month)]
+        if year not in merged:
+            merged[year] = {}
+        merged[year][month] = {
+            "listen_count": month_history["listen_count"],
+            "listen_time": month_history["listen_time"],
+            "uq_artists": _dedupe(track_artists[track_id] for track_id in month_history["uq_songs"]),
+            "uq_songs": month_history["uq_songs"],
+        }
+    return merged
+
+def rebuild_parallel(info, workers=os.cpu_count(), n_shards=None, directory="."):
+    """ Writes agg_tracks, agg_history, agg_artists, agg_artist_list and agg_state as aggregate.py does, with the listens
+    sharded by track_id and by artist_id across a process pool
+
+    Parameters
+    ----------
+    info : pd.DataFrame - the listens
+
+    workers : int (default=os.cpu_count()) - the number of worker processes
+
+    n_shards : int (default=None) - the number of shards per key, defaults to workers
+
+    directory : str (default=".") - the directory to write the files to
+
+    Returns
+    -------
+    None
+    """
+    n_shards = n_shards or workers
+    info = _categorize(info)
+    with tempfile.TemporaryDirectory() as shard_dir, ProcessPoolExecutor(max_workers=workers) as pool:
+        track_results = pool.map(_agg_tracks_shard, write_shards(info, "track_id", n_shards, shard_dir))
+        artist_results = pool.map(_agg_artists_shard, write_shards(info, "artist_id", n_shards, shard_dir))
+        track_results = list(track_results)
+        artist_results = list(artist_results)
+
+    # Shards hold disjoint keys, so tracks and artists only need to be combined in sorted key order
+    track_jsons = [pair for shard_jsons, _, _ in track_results for pair in shard_jsons]
+    _save_json_pairs(track_jsons, os.path.join(directory, "agg_tracks"))
+
+    track_artists = {}
+    for _, _, shard_artists in track_results:
+        track_artists.update(shard_artists)
+    history = merge_histories([shard_history for _, shard_history, _ in track_results], track_artists)
+    save_dict_json(history, os.path.join(directory, "agg_history"))
+
+    artist_jsons = [pair for shard_jsons, _ in artist_results for pair in shard_jsons]
+    _save_json_pairs(artist_jsons, os.path.join(directory, "agg_artists"))
+    artist_list = sorted(
+        (artist for _, shard_list in artist_results for artist in shard_list),
+        key=lambda artist : artist["artist_id"]
+    )
+    save_dict_json(artist_list, os.path.join(directory, "agg_artist_list"))
+    save_high_water_mark(info, directory)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuilds the agg_* files from all listens")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="the number of worker processes")
+    parser.add_argument("--shards", type=int, default=None, help="the number of shards per key (default: workers)")
+    args = parser.parse_args()
+
+    info = pd.concat((get_cached_info(), get_cached_fb_info())).reset_index(drop=True)
+    rebuild_parallel(info, workers=args.workers, n_shards=args.shards)
@@ -38,9 +38,10 @@ def get_prev_week_dates():
 def get_prev_week_tracks_task(fb):
     """ Gets all of the tracks played in the previous week.
     
-    These tracks are stored in a specific document in Firestore and the Firebase
-    class has a method to easily retrieve them. This function also converts the 
-    index to the timestamp of each track and sorts the tracks by time.
+    These tracks are stored in one Firestore document per day and the Firebase
+    class reads the days that have not expired in a single request. This 
+    function also converts the index to the timestamp of each track and sorts 
+    the tracks by time.
     
     Arguments
     ---------
@@ -77,33 +78,24 @@ def trim_to_week_task(df):
 
 
 @task(max_retries=10, retry_delay=timedelta(seconds=600))
-def update_prev_week_task(fb, df, stage=True):
-    """ Sets the previous week document in firebase to only include listens that
-    are still from the previous week.
-    
-    The previous week document in Firestore has no way to enforce that its 
-    listens are actually only from the previous week. All listens that are 
-    listened to are added to this document. If left unpruned, eventually the 
-    document would become too large. This function updates the document by 
-    resetting it and then only adding back listens that are still less than a 
-    week from being played.
+def expire_prev_week_task(fb):
+    """ Deletes the days of the previous week documents in firebase that are 
+    older than the previous week.
+
+    Every listen is added to the document of the day it was listened to, so 
+    old listens are removed by deleting whole days without reading them. If 
+    this fails, the listens of the remaining days are unaffected and the 
+    expired days are deleted on the next run.
 
     Arguments
     ---------
     fb (Firebase Object): An instance of the firebase class
 
-    df (pd.DataFrame): A dataframe of listens that are from the previous week
-
-    stage (boolean, default=True): Whether or not to write to the stage version
-    of the prev week doc. If false, then the production version is written to.
-
     Returns
     -------
-    None
+    (list): The days that were deleted.
     """
-    df["timestamp"] = df.index
-    df_dict = df.to_dict(orient="records")
-    fb.set_prev_week({"tracks": df_dict}, stage=stage)
+    return fb.expire_prev_week()
 
 
 @task(max_retries=10, retry_delay=timedelta(seconds=600))
@@ -161,7 +153,7 @@ def build_update_playlist_flow(name):
     with Flow(name, schedule=None) as flow:
         df = get_prev_week_tracks_task(fb)
         df = trim_to_week_task(df)
-        update_prev_week_task(fb, df, stage=False)
+        expire_prev_week_task(fb)
         top = get_top_tracks_task(df, k=25)
         set_week_playlist_task(sp, top)
     return flow
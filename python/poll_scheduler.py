@@ -0,0 +1,118 @@
+""" Schedules the polls of the currently playing track around when the song is expected to end
+
+While a song plays the listener only needs to look often enough to notice a skip, just after the song is half played,
+which decides whether it is released, and just after the song should end, so the next poll is timed from progress_ms
+and the song's duration. While nothing is playing the interval backs off exponentially.
+"""
+import time
+
+class PollScheduler():
+    """ Decides how long to wait before the next poll of current_user_playing_track and keeps track of the API calls
+    and how late song changes are noticed
+
+    Parameters
+    ----------
+    max_playing_sec : float (default=20) - the longest wait while a song plays, which bounds how stale the progress
+    of a skipped song can be
+
+    boundary_sec : float (default=10) - within this many seconds of the end of a song the next poll is just after
+    the end. Listener counts a song as fully played within 11 seconds of its end, so this must be less than 11.
+
+    after_end_sec : float (default=1.5) - how long after the expected end of a song to poll
+
+    idle_sec : float (default=10) - the wait after the first poll with nothing playing
+
+    max_idle_sec : float (default=60) - the longest wait while nothing is playing
+
+    min_sec : float (default=1) - the shortest wait between polls
+    """
+    def __init__(self, max_playing_sec=20, boundary_sec=10, after_end_sec=1.5, idle_sec=10, max_idle_sec=60, min_sec=1):
+        self.max_playing_sec = max_playing_sec
+        self.boundary_sec = boundary_sec
+        self.after_end_sec = after_end_sec
+        self.idle_sec = idle_sec
+        self.max_idle_sec = max_idle_sec
+        self.min_sec = min_sec
+        self.calls = 0
+        self.changes = 0
+        self.total_latency_sec = 0
+        self.max_latency_sec = 0
+        self._idle_polls = 0
+        self._last_poll = None
+        self._start = None
+
+    def next_delay(self, track):
+        """ Gets the seconds to wait before polling again
+
+        Parameters
+        ----------
+        track : dict - the response of current_user_playing_track, or None if nothing is playing
+
+        Returns
+        -------
+        float - the seconds until the next poll
+        """
+        if track is None or not track.get("is_playing") or track.get("item") is None:
+            delay = min(self.idle_sec * 2 ** self._idle_polls, self.max_idle_sec)
+            self._idle_polls += 1
+            return delay
+        self._idle_polls = 0
+
+        duration_ms = track["item"].get("duration_ms") or 0
+        if duration_ms <= 0 or track.get("progress_ms") is None:
+            return self.idle_sec
+        remaining_sec = (duration_ms - track["progress_ms"]) / 1000
+        to_half_sec = (duration_ms / 2 - track["progress_ms"]) / 1000
+        if to_half_sec > 0:
+            # Listener releases a song played at least half way, so look just after the half way mark, which tells
+            # whether a song skipped after this poll should be released
+            delay = min(to_half_sec + self.after_end_sec, self.max_playing_sec)
+        elif remaining_sec <= self.boundary_sec:
+            # Close enough to the end that the song counts as fully played, so look again once it has ended
+            delay = remaining_sec + self.after_end_sec
+        else:
+            # Land the poll before the end inside the boundary, so the last progress seen counts as a full play
+            delay = min(remaining_sec - self.boundary_sec / 2, self.max_playing_sec)
+        return max(delay, self.min_sec)
+
+    def record_poll(self, track, changed=False, now=None):
+        """ Counts an API call and, if the song changed since the last poll, how late the change was noticed
+
+        The new song began progress_ms ago, so that is how late the change was noticed, up to the time since the
+        last poll.
+
+        Parameters
+        ----------
+        track : dict - the response of current_user_playing_track, or None if nothing is playing
+
+        changed : bool (default=False) - whether the song is different from the one at the last poll
+
+        now : float (default=None) - the time of the poll in seconds, time.time() if None
+
+        Returns
+        -------
+        None
+        """
+        now = time.time() if now is None else now
+        if self._start is None:
+            self._start = now
+        if changed and track is not None and self._last_poll is not None:
+            latency_sec = min((track.get("progress_ms") or 0) / 1000, now - self._last_poll)
+            self.changes += 1
+            self.total_latency_sec += latency_sec
+            self.max_latency_sec = max(self.max_latency_sec, latency_sec)
+        self.calls += 1
+        self._last_poll = now
+
+    def metrics(self, now=None):
+        """ Gets the API calls, the calls per hour since the first poll, and the mean and max seconds between a song
+        changing and the change being noticed """
+        now = time.time() if now is None else now
+        hours = (now - self._start) / 3600 if self._start is not None else 0
+        return {
+            "calls": self.calls,
+            "calls_per_hour": self.calls / hours if hours > 0 else 0,
+            "changes": self.changes,
+            "mean_latency_sec": self.total_latency_sec / self.changes if self.changes else 0,
+            "max_latency_sec": self.max_latency_sec,
+        }
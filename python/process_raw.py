@@ -1,21 +1,13 @@
-import json
-import pandas as pd
-import numpy as np
+from reader import iter_history
 
 if __name__ == "__main__":
-    f = open("data/AllSongs.json", "r")
-    rows = []
-    for row in f:
-        r = json.loads(row) 
-        rows.append(r)
-    f.close()
-
-    rows.reverse()
-
-    df = pd.DataFrame(rows)
-    df = df.drop(columns=['ip_addr_decrypted'])
-    df = df.rename(columns={'master_metadata_track_name':'track_name', 'master_metadata_album_artist_name':'artist_name', 'master_metadata_album_album_name':'album_name'})
-    df['offline'] = df['offline'].fillna(False)
-    df['shuffle'] = df['shuffle'].fillna(False)
-    df['skipped'] = df['skipped'].fillna(False)
-    df.to_csv('processed_data.csv')
\ No newline at end of file
+    start = 0
+    for chunk in iter_history("data/AllSongs.json", columns=None, reverse=True):
+        df = chunk.drop(columns=['ip_addr_decrypted'])
+        df = df.rename(columns={'master_metadata_track_name':'track_name', 'master_metadata_album_artist_name':'artist_name', 'master_metadata_album_album_name':'album_name'})
+        df['offline'] = df['offline'].fillna(False)
+        df['shuffle'] = df['shuffle'].fillna(False)
+        df['skipped'] = df['skipped'].fillna(False)
+        df.index = range(start, start + df.shape[0])
+        df.to_csv('processed_data.csv', mode='w' if start == 0 else 'a', header=start == 0)
+        start += df.shape[0]
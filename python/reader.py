@@ -0,0 +1,204 @@
+""" Streaming reader for the newline delimited AllSongs.json extended streaming history """
+import json
+import os
+
+import pandas as pd
+import numpy as np
+
+ALL_SONGS_PATH = "../data/AllSongs.json"
+
+# The columns needed to build the listen table, see clean.clean_listens
+LISTEN_COLUMNS = ['master_metadata_track_name', 'master_metadata_album_artist_name', 'ms_played', 'ts']
+
+COLUMN_DTYPES = {
+    'ms_played': np.int64,
+}
+
+def _read_lines(f, reverse=False, block_size=1 << 20):
+    """ Yields the lines of a binary file, optionally from last to first without reading the whole file
+
+    Parameters
+    ----------
+    f : file - the file opened in binary mode
+
+    reverse : bool (default=False) - whether to yield the lines from the end of the file
+
+    block_size : int (default=1MB) - the number of bytes read at a time when reversing
+
+    Returns
+    -------
+    generator of bytes - the lines of the file
+    """
+    if not reverse:
+        yield from f
+        return
+    f.seek(0, os.SEEK_END)
+    pos = f.tell()
+    tail = b""
+    while pos > 0:
+        size = min(block_size, pos)
+        pos -= size
+        f.seek(pos)
+        lines = (f.read(size) + tail).split(b"\n")
+        tail = lines[0]
+        yield from reversed(lines[1:])
+    yield tail
+
+def _to_frame(values, columns):
+    df = pd.DataFrame(values, columns=columns)
+    for column in columns:
+        if column in COLUMN_DTYPES and not df[column].isna().any():
+            df[column] = df[column].astype(COLUMN_DTYPES[column])
+    return df
+
+def _history_keys(path, reverse=False):
+    """ Gets every key of the rows of the extended history in the order they first appear """
+    keys = {}
+    with open(path, "rb") as f:
+        for line in _read_lines(f, reverse=reverse):
+            if line.strip():
+                keys.update(dict.fromkeys(json.loads(line)))
+    return list(keys)
+
+def iter_history(path=ALL_SONGS_PATH, columns=LISTEN_COLUMNS, chunk_size=100000, reverse=False):
+    """ Streams the extended history in DataFrame chunks, keeping only the given columns
+
+    Only one chunk of parsed rows is held in memory at a time. Keys missing from a row are read as None.
+
+    Parameters
+    ----------
+    path : str (default=ALL_SONGS_PATH) - the path to the newline delimited json file
+
+    columns : list (default=LISTEN_COLUMNS) - the keys of each row to keep, or None for every key in the file, which
+    takes an extra pass to find so that every chunk has the same columns
+
+    chunk_size : int (default=100000) - the number of rows per chunk
+
+    reverse : bool (default=False) - whether to read the rows from the end of the file to the start
+
+    Returns
+    -------
+    generator of pd.DataFrame - the chunks of rows with the given columns
+    """
+    if columns is None:
+        columns = _history_keys(path, reverse=reverse)
+    values = {column: [] for column in columns}
+    num_rows = 0
+    with open(path, "rb") as f:
+        for line in _read_lines(f, reverse=reverse):
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            for column in columns:
+                values[column].append(row.get(column))
+            num_rows += 1
+            if num_rows == chunk_size:
+                yield _to_frame(values, columns)
+                values = {column: [] for column in columns}
+                num_rows = 0
+    if num_rows > 0:
+        yield _to_frame(values, columns)
+
+def read_history(path=ALL_SONGS_PATH, columns=LISTEN_COLUMNS, chunk_size=100000, reverse=False):
+    """ Reads the given columns of the extended history into one DataFrame, see iter_history
+
+    Returns
+    -------
+    pd.DataFrame - the rows with the given columns
+    """
+    chunks = list(iter_history(path, columns=columns, chunk_size=chunk_size, reverse=reverse))
+    if len(chunks) == 0:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(chunks, ignore_index=True)
+
+def _fill(f, buf, pos, block_size):
+    """ Drops the consumed part of buf and appends the next block of f. Returns the new buf and whether f is done """
+    block = f.read(block_size)
+    return buf[pos:] + block, block == ""
+
+def iter_json_object(path, block_size=1 << 20):
+    """ Streams the (key, value) pairs of a file holding one large JSON object, such as the firebase_songs.json
+    snapshot, holding at most one value in memory at a time
+
+    Parameters
+    ----------
+    path : str - the path to the json file
+
+    block_size : int (default=1MB) - the number of characters read at a time
+
+    Returns
+    -------
+    generator of (str, object) - the keys and decoded values of the object in file order
+    """
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as f:
+        buf, pos, done = "", 0, False
+        state = "start"
+        key = None
+        while True:
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            if pos == len(buf):
+                if done:
+                    raise ValueError(f"{path} ended before its JSON object was closed")
+                buf, done = _fill(f, buf, pos, block_size)
+                pos = 0
+                continue
+
+            char = buf[pos]
+            if state == "start":
+                if char != "{":
+                    raise ValueError(f"{path} does not hold a JSON object")
+                pos += 1
+                state = "first_key"
+            elif (state == "first_key" or state == "next") and char == "}":
+                return
+            elif state == "next":
+                if char != ",":
+                    raise ValueError(f"Expected ',' at {pos} while reading {path}")
+                pos += 1
+                state = "key"
+            elif state == "colon":
+                if char != ":":
+                    raise ValueError(f"Expected ':' at {pos} while reading {path}")
+                pos += 1
+                state = "value"
+            else:
+                # Decode a key or a value, reading more of the file if it is cut off by the end of the buffer
+                try:
+                    decoded, end = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    if done:
+                        raise
+                    buf, done = _fill(f, buf, pos, block_size)
+                    pos = 0
+                    continue
+                if end == len(buf) and not done:
+                    buf, done = _fill(f, buf, pos, block_size)
+                    pos = 0
+                    continue
+                pos = end
+                if state == "value":
+                    yield key, decoded
+                    state = "next"
+                else:
+                    key = decoded
+                    state = "colon"
+
+def iter_ndjson_documents(path):
+    """ Streams the documents of a newline delimited snapshot written by export.py, one line at a time
+
+    Parameters
+    ----------
+    path : str - the path to the ndjson file
+
+    Returns
+    -------
+    generator of (str, dict) - the id and data of each document in file order
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            document = json.loads(line)
+            yield document["id"], document["data"]
@@ -0,0 +1,194 @@
+""" Backfills listens that polling missed from the spotify recently played history
+
+A song that starts and ends while the listener is not polling, because it restarted, was getting a new token or was
+waiting out a ReadTimeout, is never released. The recently played history has every play of at least 30 seconds, so
+it is compared with the listens already written, or waiting in the listen queue, and the plays that are missing are
+put in the listen queue under the listener's rules for which plays count, for the write behind worker to write.
+"""
+import json
+import os
+import time
+from datetime import datetime, timezone
+
+# The most plays the recently played endpoint returns, which is also about as far back as it remembers
+RECENTLY_PLAYED_LIMIT = 50
+
+def _played_at(item):
+    """ Gets when a recently played item finished playing in UTC epoch seconds """
+    return datetime.fromisoformat(item["played_at"].replace("Z", "+00:00")).timestamp()
+
+class Reconciler():
+    """ Queues the plays in the recently played history that are not among the written or queued listens
+
+    Only plays the listener can no longer release are considered: those that ended at least settle_sec ago and are
+    not the latest play, which the listener still holds until it sees the next song. The history has no ms played,
+    so each play is taken to have lasted until it ended or the previous play ended, whichever is shorter, and is
+    skipped if that is less than half of the song, as Listener._should_release does. A play matches a written listen
+    of the same track that ended within match_sec of it, and each written listen matches at most one play.
+
+    The time of the newest play considered is saved in state_path, so each play is only compared once and the
+    comparison survives restarts. It is only advanced once the missing plays are in the queue, which is on disk.
+
+    Parameters
+    ----------
+    listener : listen.Listener - the listener whose spotify client, FireManager, ListenQueue, WriteBehindWorker and
+    id rules are used
+
+    state_path : str (default="reconcile_state.json") - the file the cursor is saved in
+
+    interval_sec : float (default=600) - how often due says to reconcile. The history covers about 50 songs, so this
+    must be well under the time they take to play.
+
+    settle_sec : float (default=300) - how long after a play ends before it can be backfilled
+
+    match_sec : float (default=90) - how far apart a play and a written listen of the same track can end and still
+    match, at most half of the song
+    """
+    def __init__(self, listener, state_path="reconcile_state.json", interval_sec=600, settle_sec=300, match_sec=90):
+        self.listener = listener
+        self.state_path = state_path
+        self.interval_sec = interval_sec
+        self.settle_sec = settle_sec
+        self.match_sec = match_sec
+        self.cursor = self._load_cursor()
+        self.runs = 0
+        self.checked = 0
+        self.added = 0
+        self._last_run = None
+
+    def _load_cursor(self):
+        """ Loads the end time of the newest play already compared, None if nothing has been """
+        if not os.path.exists(self.state_path):
+            return None
+        with open(self.state_path) as f:
+            return json.load(f).get("cursor")
+
+    def _save_cursor(self, cursor):
+        with open(self.state_path, "w") as f:
+            f.write(json.dumps({"cursor": cursor}))
+        self.cursor = cursor
+
+    def due(self, now=None):
+        """ Checks whether interval_sec has passed since the last reconcile, or there has not been one """
+        now = time.time() if now is None else now
+        return self._last_run is None or now - self._last_run >= self.interval_sec
+
+    def _candidates(self, items, now):
+        """ Gets the plays that the listener can no longer release and have not been compared, with their listen
+
+        Parameters
+        ----------
+        items : list - the items of the recently played response
+
+        now : float - the current UTC epoch seconds
+
+        Returns
+        -------
+        list of (float, tuple) - the end time of each play and its (track_id, artist_id, track_details, add_to_week),
+        oldest first
+        """
+        plays = sorted(
+            ((_played_at(item), item["track"]) for item in items if item["track"].get("type", "track") == "track"),
+            key=lambda play : play[0]
+        )
+        candidates = []
+        # The latest play may still be held by the listener, so it is left for the next reconcile
+        for idx in range(len(plays) - 1):
+            played_at, item = plays[idx]
+            if played_at > now - self.settle_sec:
+                break
+            if self.cursor is not None and played_at <= self.cursor:
+                continue
+
+            duration = item.get("duration_ms") or 0
+            ms_played = duration
+            if idx > 0:
+                ms_played = min(duration, int((played_at - plays[idx - 1][0]) * 1000))
+            if duration > 0 and (duration - ms_played) < 11000:
+                ms_played = duration
+            if duration > 0 and float(ms_played)/float(duration) < 0.5:
+                candidates.append((played_at, None))
+                continue
+
+            # Shaped as a current_user_playing_track response so the listener's id and info rules apply unchanged
+            track = {
+                "item": item,
+                "progress_ms": ms_played,
+                "timestamp": int(played_at * 1000) - ms_played,
+                "currently_playing_type": "track",
+            }
+            track_id = self.listener._get_track_id(track)
+            info = self.listener._get_info(track, track_duration=duration)
+            candidates.append((played_at, (track_id, self.listener._get_artist_id(track), info, True)))
+        return candidates
+
+    def _written_timestamps(self, listens):
+        """ Gets the end times of the listens already written or queued for the tracks of listens
+
+        The queue is read before the buckets, since the write behind worker only removes a listen from the queue
+        once it is written, so a listen being written while this runs is seen in one or the other.
+        """
+        written = {}
+        for _, (track_id, _, track_details, _) in self.listener.queue.peek(self.listener.queue.depth()):
+            written.setdefault(track_id, []).append(track_details["timestamp"].timestamp())
+
+        track_years = set()
+        for track_id, _, track_details, _ in listens:
+            for offset in [-self.match_sec, self.match_sec]:
+                end = track_details["timestamp"].timestamp() + offset
+                track_years.add((track_id, datetime.fromtimestamp(end, tz=timezone.utc).year))
+        for track_id, timestamps in self.listener.firebase.get_listen_timestamps(track_years).items():
+            written.setdefault(track_id, []).extend(timestamps.tolist())
+        return written
+
+    def _missing(self, listens, written):
+        """ Gets the listens that do not match a written listen of the same track """
+        missing = []
+        for listen in listens:
+            track_id, _, track_details, _ = listen
+            end = track_details["timestamp"].timestamp()
+            match_sec = self.match_sec
+            if track_details["duration"] > 0:
+                match_sec = min(match_sec, track_details["duration"] / 2000)
+            timestamps = written.get(track_id, [])
+            matches = [idx for idx, timestamp in enumerate(timestamps) if abs(timestamp - end) <= match_sec]
+            if matches:
+                del timestamps[min(matches, key=lambda idx : abs(timestamps[idx] - end))]
+            else:
+                missing.append(listen)
+        return missing
+
+    def reconcile(self, now=None):
+        """ Queues the plays in the recently played history that polling missed. They get the write behind
+        worker's retries and dead letter table, so a listen that can not be written never stops the listener.
+
+        Parameters
+        ----------
+        now : float (default=None) - the current UTC epoch seconds, time.time() if None
+
+        Returns
+        -------
+        list - the (track_id, artist_id, track_details, add_to_week) of each listen queued, oldest first
+        """
+        now = time.time() if now is None else now
+        self._last_run = now
+        self.runs += 1
+        response = self.listener.spotify.current_user_recently_played(limit=RECENTLY_PLAYED_LIMIT)
+        candidates = self._candidates(response["items"], now)
+        if len(candidates) == 0:
+            return []
+
+        listens = [listen for _, listen in candidates if listen is not None]
+        missing = self._missing(listens, self._written_timestamps(listens)) if listens else []
+        for track_id, artist_id, track_details, add_to_week in missing:
+            self.listener.queue.put(track_id, artist_id, track_details, add_to_week=add_to_week)
+        if missing:
+            self.listener.writer.notify()
+        self.checked += len(candidates)
+        self.added += len(missing)
+        self._save_cursor(candidates[-1][0])
+        return missing
+
+    def metrics(self):
+        """ Gets the reconciles run, the plays compared, the listens backfilled and the cursor """
+        return {"runs": self.runs, "checked": self.checked, "added": self.added, "cursor": self.cursor}
@@ -4,6 +4,7 @@ import time
 
 import pandas as pd
 import numpy as np
+from reader import read_history
 from spotify import Spotify
 
 ALL = False
@@ -14,14 +15,8 @@ def save_dict(track, filename):
         f.write(json.dumps(track))
 
 def read_all_tracks():
-    f = open("../data/AllSongs.json", "r")
-    rows = []
-    for row in f:
-        r = json.loads(row) 
-        rows.append(r)
-    f.close()
-    rows.reverse()
-    return rows
+    columns = ["master_metadata_track_name", "master_metadata_album_artist_name", "master_metadata_album_album_name"]
+    return read_history(columns=columns, reverse=True)
 
 def save_tracks(sp, known_ids, uq_tracks):
     track_ids = []
@@ -0,0 +1,244 @@
+""" Concurrent, checkpointed bulk upload of documents to Firestore """
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from aggregate import read_dict_json
+from codec import track_listens
+from firebase import ARTIST_ROLLUPS, RETRYABLE_ERRORS, SONG_ROLLUPS, FireManager, bucket_listens, stamped
+
+# Firestore allows 500 writes and 10MiB per commit
+MAX_BATCH_WRITES = 500
+MAX_BATCH_BYTES = 9 * 1024 * 1024
+
+def aggregate_writes(fb, tracks=None, history=None, artists=None, artist_list=None, listen_years=None,
+                     song_rollups=None, artist_rollups=None):
+    """ Lists the documents that hold the agg_* outputs of aggregate.py. Each track's listens are written to its year
+    buckets rather than to the song document.
+
+    Parameters
+    ----------
+    fb : FireManager - the firebase manager whose collections the documents are in
+
+    tracks : dict (default=None) - the track documents keyed by track_id
+
+    history : dict (default=None) - the history documents keyed by year then month
+
+    artists : dict (default=None) - the artist documents keyed by artist_id
+
+    artist_list : list (default=None) - the artist list, not written if None
+
+    listen_years : set (default=None) - only write the listen buckets of these years, all years if None
+
+    song_rollups : dict (default=None) - the song rollup documents keyed by track_id, see aggregate.agg_rollups
+
+    artist_rollups : dict (default=None) - the artist rollup documents keyed by artist_id
+
+    Returns
+    -------
+    list of (str, DocumentReference, dict) - the key, reference and data of each document
+    """
+    tracks = tracks or {}
+    history = history or {}
+    artists = artists or {}
+    song_rollups = song_rollups or {}
+    artist_rollups = artist_rollups or {}
+    writes = []
+    if artist_list is not None:
+        writes.append(("utils/artist_list", fb.artist_list_doc, {"list": artist_list}))
+    for year in history:
+        for month in history[year]:
+            doc_ref = fb.db.collection(f"history_{year}").document(f"{month}")
+            writes.append((f"history_{year}/{month}", doc_ref, history[year][month]))
+    for artist_id in artists:
+        writes.append((f"artists/{artist_id}", fb.artist_collection.document(artist_id), artists[artist_id]))
+    for track_id in tracks:
+        track = {field: value for field, value in tracks[track_id].items() if field not in ("listens", "records")}
+        writes.append((f"songs/{track_id}", fb.song_collection.document(track_id), track))
+        for year, bucket in bucket_listens(*track_listens(tracks[track_id])).items():
+            if listen_years is None or year in listen_years:
+                writes.append((f"songs/{track_id}/listens/{year}", fb.get_listen_bucket(track_id, year), bucket))
+    for track_id, rollup in song_rollups.items():
+        writes.append((f"{SONG_ROLLUPS}/{track_id}", fb.song_rollup_collection.document(track_id), rollup))
+    for artist_id, rollup in artist_rollups.items():
+        writes.append((f"{ARTIST_ROLLUPS}/{artist_id}", fb.artist_rollup_collection.document(artist_id), rollup))
+    return writes
+
+class BulkUploader():
+    """ Sets documents in concurrent batches, ramping up the write rate and retrying failed batches with backoff
+
+    Finished documents are appended to a checkpoint file with a digest of their data, so an interrupted upload
+    skips them when it is run again with the same data. The checkpoint is removed once an upload completes.
+
+    Parameters
+    ----------
+    fb : FireManager - the firebase manager to write with
+
+    checkpoint_path : str (default="upload_checkpoint.txt") - the checkpoint file
+
+    max_in_flight : int (default=8) - the most batches being committed at once
+
+    batch_size : int (default=MAX_BATCH_WRITES) - the most documents per batch
+
+    start_ops_per_sec : float (default=500) - the starting document write rate
+
+    ramp_seconds : float (default=300) - the rate grows by half every ramp_seconds
+
+    max_retries : int (default=6) - the number of times a failed batch is retried before giving up
+
+    backoff_sec : float (default=1) - the wait before the first retry, doubled on each further retry
+    """
+    def __init__(self, fb, checkpoint_path="upload_checkpoint.txt", max_in_flight=8, batch_size=MAX_BATCH_WRITES,
+                 start_ops_per_sec=500, ramp_seconds=300, max_retries=6, backoff_sec=1):
+        self.fb = fb
+        self.checkpoint_path = checkpoint_path
+        self.max_in_flight = max_in_flight
+        self.batch_size = min(batch_size, MAX_BATCH_WRITES)
+        self.start_ops_per_sec = start_ops_per_sec
+        self.ramp_seconds = ramp_seconds
+        self.max_retries = max_retries
+        self.backoff_sec = backoff_sec
+        self._lock = threading.Lock()
+        self._num_done = 0
+
+    def _load_checkpoint(self):
+        """ Reads the digests of the documents uploaded by an interrupted upload
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        dict - the digest of each uploaded document's data keyed by the document's key
+        """
+        done = {}
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    key, _, digest = line.rstrip("\n").rpartition(" ")
+                    done[key] = digest
+        return done
+
+    def _make_batches(self, writes, done):
+        """ Groups the writes that are not in the checkpoint into batches within Firestore's commit limits
+
+        Parameters
+        ----------
+        writes : list - the (key, DocumentReference, data) of each document
+
+        done : dict - the checkpoint digests
+
+        Returns
+        -------
+        list of lists - the batches of (key, DocumentReference, data, digest)
+        """
+        batches = []
+        batch = []
+        batch_bytes = 0
+        for key, doc_ref, data in writes:
+            data_json = json.dumps(data, sort_keys=True, default=str)
+            digest = hashlib.sha1(data_json.encode("utf-8")).hexdigest()
+            if done.get(key) == digest:
+                continue
+            if len(batch) == self.batch_size or (batch and batch_bytes + len(data_json) > MAX_BATCH_BYTES):
+                batches.append(batch)
+                batch = []
+                batch_bytes = 0
+            batch.append((key, doc_ref, data, digest))
+            batch_bytes += len(data_json)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _wait_for_rate(self, start, num_sent):
+        """ Sleeps until num_sent writes are within the write rate, which starts at start_ops_per_sec and grows by
+        half every ramp_seconds """
+        while True:
+            elapsed = time.monotonic() - start
+            ops_per_sec = self.start_ops_per_sec * 1.5 ** int(elapsed // self.ramp_seconds)
+            wait_sec = num_sent / ops_per_sec - elapsed
+            if wait_sec <= 0:
+                return
+            time.sleep(min(wait_sec, 1))
+
+    def _commit(self, batch, total):
+        """ Commits a batch, retrying with exponential backoff, then records it in the checkpoint
+
+        Parameters
+        ----------
+        batch : list - the (key, DocumentReference, data, digest) of each document
+
+        total : int - the number of documents being uploaded, for progress
+
+        Returns
+        -------
+        None
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                write_batch = self.fb.db.batch()
+                for _, doc_ref, data, _ in batch:
+                    write_batch.set(doc_ref, stamped(data))
+                write_batch.commit()
+                break
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                wait_sec = self.backoff_sec * 2 ** attempt * (1 + random.random())
+                print(f"Batch failed with {e}, retrying in {wait_sec:.1f}s")
+                time.sleep(wait_sec)
+
+        with self._lock:
+            with open(self.checkpoint_path, "a", encoding="utf-8") as f:
+                f.write("".join(f"{key} {digest}\n" for key, _, _, digest in batch))
+            self._num_done += len(batch)
+            print(f"Uploaded {self._num_done}/{total}")
+
+    def upload(self, writes):
+        """ Sets every document, skipping those already uploaded by an interrupted run with the same data
+
+        Parameters
+        ----------
+        writes : list - the (key, DocumentReference, data) of each document, see aggregate_writes
+
+        Returns
+        -------
+        None
+        """
+        batches = self._make_batches(writes, self._load_checkpoint())
+        total = sum(len(batch) for batch in batches)
+        self._num_done = 0
+        start = time.monotonic()
+        num_sent = 0
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as pool:
+            in_flight = set()
+            for batch in batches:
+                self._wait_for_rate(start, num_sent)
+                if len(in_flight) == self.max_in_flight:
+                    finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        future.result()
+                in_flight.add(pool.submit(self._commit, batch, total))
+                num_sent += len(batch)
+            for future in in_flight:
+                future.result()
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+if __name__ == "__main__":
+    fb = FireManager()
+    writes = aggregate_writes(
+        fb,
+        tracks=read_dict_json("agg_tracks"),
+        history=read_dict_json("agg_history"),
+        artists=read_dict_json("agg_artists"),
+        artist_list=read_dict_json("agg_artist_list"),
+        song_rollups=read_dict_json("agg_song_rollups"),
+        artist_rollups=read_dict_json("agg_artist_rollups"),
+    )
+    BulkUploader(fb).upload(writes)
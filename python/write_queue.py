@@ -0,0 +1,248 @@
+""" Durable write-behind queue of released listens, drained to firebase by a background worker
+
+Listener puts each released listen in the queue, which is a SQLite file, and carries on polling. The worker commits
+the queued listens in batches with FireManager.add_songs and only removes them once they are written, so listens
+survive firebase outages and restarts.
+"""
+import json
+import sqlite3
+import threading
+import time
+import traceback
+from datetime import datetime, timezone
+
+from firebase import MAX_LISTENS_PER_BATCH, RETRYABLE_ERRORS
+
+def _dump_details(track_details):
+    """ Serializes track_details, storing its timestamp datetime as epoch seconds """
+    return json.dumps(dict(track_details, timestamp=track_details["timestamp"].timestamp()))
+
+def _load_details(details_json):
+    track_details = json.loads(details_json)
+    track_details["timestamp"] = datetime.fromtimestamp(track_details["timestamp"], tz=timezone.utc)
+    return track_details
+
+class ListenQueue():
+    """ A first in first out queue of listens stored in a SQLite file. Listens that can never be written are moved
+    to a dead letter table rather than dropped.
+
+    Parameters
+    ----------
+    path : str (default="listen_queue.db") - the SQLite file
+    """
+    def __init__(self, path="listen_queue.db"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS listens (id INTEGER PRIMARY KEY AUTOINCREMENT, track_id TEXT, artist_id TEXT, "
+            "details TEXT, add_to_week INTEGER, enqueued_at REAL, attempts INTEGER DEFAULT 0)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS dead_listens (id INTEGER PRIMARY KEY, track_id TEXT, artist_id TEXT, "
+            "details TEXT, add_to_week INTEGER, enqueued_at REAL, attempts INTEGER, error TEXT)"
+        )
+
+    def put(self, track_id, artist_id, track_details, add_to_week=False):
+        """ Adds a listen to the end of the queue. It is on disk once this returns.
+
+        Parameters
+        ----------
+        track_id : str - the id of the track
+
+        artist_id : str - the id of the artist
+
+        track_details : dict - the information about the listen, as passed to FireManager.add_song
+
+        add_to_week : bool (default=False) - whether to also add the listen to the previous week's list of songs
+
+        Returns
+        -------
+        None
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO listens (track_id, artist_id, details, add_to_week, enqueued_at) VALUES (?, ?, ?, ?, ?)",
+                (track_id, artist_id, _dump_details(track_details), int(add_to_week), time.time())
+            )
+
+    def peek(self, limit):
+        """ Gets the oldest listens without removing them
+
+        Parameters
+        ----------
+        limit : int - the most listens to get
+
+        Returns
+        -------
+        list of (int, tuple) - the queue id of each listen and its (track_id, artist_id, track_details, add_to_week)
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, track_id, artist_id, details, add_to_week FROM listens ORDER BY id LIMIT ?", (limit,)
+            ).fetchall()
+        return [
+            (row_id, (track_id, artist_id, _load_details(details), bool(add_to_week)))
+            for row_id, track_id, artist_id, details, add_to_week in rows
+        ]
+
+    def remove(self, ids):
+        """ Removes the listens with the given queue ids once they are written """
+        with self._lock:
+            self._conn.executemany("DELETE FROM listens WHERE id = ?", [(row_id,) for row_id in ids])
+
+    def record_attempt(self, ids):
+        """ Counts a failed attempt to write the listens with the given queue ids """
+        with self._lock:
+            self._conn.executemany("UPDATE listens SET attempts = attempts + 1 WHERE id = ?", [(row_id,) for row_id in ids])
+
+    def kill(self, row_id, error):
+        """ Moves a listen that can not be written to the dead letter table with the error it failed with """
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.execute(
+                "INSERT INTO dead_listens SELECT id, track_id, artist_id, details, add_to_week, enqueued_at, "
+                "attempts + 1, ? FROM listens WHERE id = ?", (error, row_id)
+            )
+            self._conn.execute("DELETE FROM listens WHERE id = ?", (row_id,))
+            self._conn.execute("COMMIT")
+
+    def depth(self):
+        """ Gets the number of listens waiting to be written """
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM listens").fetchone()[0]
+
+    def lag(self):
+        """ Gets the seconds the oldest waiting listen has been queued for, 0 if the queue is empty """
+        with self._lock:
+            oldest = self._conn.execute("SELECT MIN(enqueued_at) FROM listens").fetchone()[0]
+        return 0 if oldest is None else time.time() - oldest
+
+    def dead(self):
+        """ Gets the number of listens in the dead letter table """
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM dead_listens").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class WriteBehindWorker(threading.Thread):
+    """ Drains a ListenQueue to firebase in batches on a background thread
+
+    A batch that fails with a retryable error is retried with exponential backoff, keeping the listens in the queue.
+    A batch that fails with any other error is written one listen at a time so only the listens that fail on their
+    own are moved to the dead letter table.
+
+    Parameters
+    ----------
+    queue : ListenQueue - the queue to drain
+
+    firebase : FireManager - the firebase manager to write with
+
+    batch_size : int (default=20) - the most listens committed at once, at most MAX_LISTENS_PER_BATCH
+
+    backoff_sec : float (default=1) - the wait after the first failure, doubled on each further failure
+
+    max_backoff_sec : float (default=300) - the longest wait between attempts
+
+    idle_sec : float (default=5) - the wait between checks of an empty queue, cut short by notify
+    """
+    def __init__(self, queue, firebase, batch_size=20, backoff_sec=1, max_backoff_sec=300, idle_sec=5):
+        super().__init__(name="write-behind", daemon=True)
+        self.queue = queue
+        self.firebase = firebase
+        self.batch_size = min(batch_size, MAX_LISTENS_PER_BATCH)
+        self.backoff_sec = backoff_sec
+        self.max_backoff_sec = max_backoff_sec
+        self.idle_sec = idle_sec
+        self.written = 0
+        self.retries = 0
+        self.last_error = None
+        self._failures = 0
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+
+    def notify(self):
+        """ Wakes the worker to write a listen that was just queued """
+        self._wake.set()
+
+    def stop(self, timeout=None):
+        """ Stops the worker after the batch it is writing, leaving the rest of the queue on disk """
+        self._stopping.set()
+        self._wake.set()
+        self.join(timeout)
+
+    def metrics(self):
+        """ Gets the queue depth, the lag of the oldest queued listen in seconds, the listens written, the failed
+        attempts, the dead listens and the last error """
+        return {
+            "depth": self.queue.depth(),
+            "lag_sec": self.queue.lag(),
+            "written": self.written,
+            "retries": self.retries,
+            "dead": self.queue.dead(),
+            "last_error": self.last_error,
+        }
+
+    def _write_singly(self, items):
+        """ Writes listens one at a time after their batch failed, moving those that fail to the dead letter table """
+        for row_id, listen in items:
+            try:
+                self.firebase.add_songs([listen])
+            except RETRYABLE_ERRORS:
+                raise
+            except Exception:
+                self.last_error = traceback.format_exc(limit=3)
+                self.queue.kill(row_id, self.last_error)
+                continue
+            self.queue.remove([row_id])
+            self.written += 1
+
+    def drain_once(self):
+        """ Writes the oldest batch of queued listens
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        int - the number of listens taken from the queue, or -1 if the write failed and should be retried
+        """
+        items = self.queue.peek(self.batch_size)
+        if len(items) == 0:
+            return 0
+        try:
+            try:
+                self.firebase.add_songs([listen for _, listen in items])
+            except RETRYABLE_ERRORS:
+                raise
+            except Exception:
+                self.last_error = traceback.format_exc(limit=3)
+                self._write_singly(items)
+                return len(items)
+        except RETRYABLE_ERRORS as e:
+            self.last_error = repr(e)
+            self.retries += 1
+            self.queue.record_attempt([row_id for row_id, _ in items])
+            return -1
+        self.queue.remove([row_id for row_id, _ in items])
+        self.written += len(items)
+        return len(items)
+
+    def run(self):
+        while not self._stopping.is_set():
+            num_drained = self.drain_once()
+            if num_drained > 0:
+                self._failures = 0
+            elif num_drained == 0:
+                self._wake.wait(self.idle_sec)
+                self._wake.clear()
+            else:
+                wait_sec = min(self.backoff_sec * 2 ** self._failures, self.max_backoff_sec)
+                self._failures += 1
+                print(f"Write behind failed with {self.last_error}, retrying in {wait_sec:.1f}s")
+                self._stopping.wait(wait_sec)
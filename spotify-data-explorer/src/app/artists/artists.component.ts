@@ -3,9 +3,10 @@ import { ActivatedRoute, Params } from '@angular/router';
 import { AngularFirestore, AngularFirestoreDocument } from '@angular/fire/firestore';
 import { FormControl } from '@angular/forms';
 import { Router } from '@angular/router';
-import { Observable } from 'rxjs';
-import { map, startWith } from 'rxjs/operators';
+import { Observable, combineLatest } from 'rxjs';
+import { map, startWith, take } from 'rxjs/operators';
 import { Chart } from 'chart.js';
+import { rollup_months } from '../rollups';
 
 const MONTHS = ["January", "February", "March", "April", "May", "June", "July", "August", "September", "October", "November", "December"]
 const MONTH_KEYS = ['10/2015', '11/2015', '12/2015', '1/2016', '2/2016', '3/2016', '4/2016', '5/2016', '6/2016', '7/2016', '8/2016', '9/2016', '10/2016', '11/2016', '12/2016', '1/2017', '2/2017', '3/2017', '4/2017', '5/2017', '6/2017', '7/2017', '8/2017', '9/2017', '10/2017', '11/2017', '12/2017', '1/2018', '2/2018', '3/2018', '4/2018', '5/2018', '6/2018', '7/2018', '8/2018', '9/2018', '10/2018', '11/2018', '12/2018', '1/2019', '2/2019', '3/2019', '4/2019', '5/2019', '6/2019', '7/2019', '8/2019', '9/2019', '10/2019', '11/2019', '12/2019', '1/2020', '2/2020', '3/2020', '4/2020', '5/2020', '6/2020', '7/2020', '8/2020', '9/2020', '10/2020', '11/2020', '12/2020', '1/2021', '2/2021', '3/2021', '4/2021', '5/2021', '6/2021', '7/2021', '8/2021', '9/2021', '10/2021', '11/2021', '12/2021', '1/2022', '2/2022', '3/2022', '4/2022', '5/2022', '6/2022', '7/2022', '8/2022', '9/2022', '10/2022', '11/2022', '12/2022']
@@ -58,7 +59,7 @@ export class ArtistsComponent implements OnInit {
     /* GRAPH VARIABLES */
     artist_graph;
     song_graph;
-    tracks = {};
+    song_names = {};
     active_artist_dataset_time = "month";
     active_artist_dataset_stat = "counts";
     active_artist_time_unit = {
@@ -136,10 +137,14 @@ export class ArtistsComponent implements OnInit {
             this.artist_id = params["id"]
         })
 
-        // Subscribe to artist
+        // Subscribe to artist and to its rollup of listens per month and per track
         this.artist_doc = this.afs.doc<Item>('artists/' + this.artist_id);
         this.artist_item = this.artist_doc.valueChanges();
-        this.artist_item.subscribe(val => this.populate_info(val))
+        let artist_rollup = this.afs.doc<Item>('artist_rollups/' + this.artist_id).valueChanges();
+        combineLatest([this.artist_item, artist_rollup]).subscribe(([val, rollup]) => {
+            this.populate_info(val)
+            this.recount_stats(rollup)
+        })
 
         // Define artist graph
         let artist_canvas = <HTMLCanvasElement>document.getElementById('artist_canvas');
@@ -273,7 +278,10 @@ export class ArtistsComponent implements OnInit {
     }
 
     select_song(event) {
-        this.set_song_chart_data(this.tracks[event.option.value.track_id])
+        let track_id = event.option.value.track_id
+        let track_item = this.afs.doc<Item>('songs/' + track_id).valueChanges();
+        let track_rollup = this.afs.doc<Item>('song_rollups/' + track_id).valueChanges();
+        combineLatest([track_item, track_rollup]).pipe(take(1)).subscribe(([track_info, rollup]) => this.set_song_chart_data(track_info, rollup))
     }
 
     /* INFO AND GRAPH FUNCTIONS */
@@ -295,19 +303,13 @@ export class ArtistsComponent implements OnInit {
         let llt = val["last_listen_time"]
         this.artist_last_song_date = MONTHS[llt["month"] - 1] + " " + llt["day"] + ", " + llt["year"]
 
-        this.set_artist_chart_data(val["tracks"])
-        this.update_song_options(val);
-    }
-
-    set_artist_chart_data(tracks) {
-        tracks.forEach(track => {
-            let track_doc = this.afs.doc<Item>('songs/' + track["track_id"]);
-            let track_item = track_doc.valueChanges();
-            track_item.subscribe(val => this.update_track(val))
+        val["tracks"].forEach(track => {
+            this.song_names[track["track_id"]] = track["song_name"]
         });
+        this.update_song_options(val);
     }
 
-    set_song_chart_data(track_info) {
+    set_song_chart_data(track_info, rollup) {
         // Populate info
         this.song_listen_count = track_info["listen_count"]
         let song_time_info = this.transform_time(track_info["listen_time"])
@@ -322,15 +324,14 @@ export class ArtistsComponent implements OnInit {
         var year_times = this.init_dict("year", 0)
         var month_counts = this.init_dict("month", 0)
         var month_times = this.init_dict("month", 0)
-        for (let listen_idx in track_info["listens"]) {
-            let listen_year = track_info["listens"][listen_idx]["year"]
-            let listen_month = track_info["listens"][listen_idx]["month"] + "/" + listen_year;
-            let ms_played = track_info["listens"][listen_idx]["duration"]
-            year_counts[listen_year] += 1;
-            year_times[listen_year] += ms_played
-            month_counts[listen_month] += 1;
-            month_times[listen_month] += ms_played;
-        }
+        rollup_months(rollup).forEach(month_stats => {
+            let listen_year = month_stats["year"]
+            let listen_month = month_stats["month"] + "/" + listen_year;
+            year_counts[listen_year] += month_stats["listen_count"];
+            year_times[listen_year] += month_stats["listen_time"]
+            month_counts[listen_month] += month_stats["listen_count"];
+            month_times[listen_month] += month_stats["listen_time"];
+        });
 
         // Calculate year values
         var year_count_data = []
@@ -388,11 +389,6 @@ export class ArtistsComponent implements OnInit {
         this.song_graph.update()
     }
 
-    update_track(track) {
-        this.tracks[track["track_id"]] = track
-        this.recount_stats()
-    }
-
     init_dict(timescale, default_val) {
         let arr = (timescale == "year") ? YEAR_KEYS : MONTH_KEYS;
         var my_dict = {}
@@ -407,7 +403,7 @@ export class ArtistsComponent implements OnInit {
         return my_dict
     }
 
-    recount_stats() {
+    recount_stats(rollup) {
         var year_counts = this.init_dict("year", 0)
         var year_times = this.init_dict("year", 0)
         var year_unique_songs = this.init_dict("year", "set")
@@ -420,10 +416,11 @@ export class ArtistsComponent implements OnInit {
         var highest_pc_song;
         var highest_time = 0;
         var highest_time_song;
-        for (let track_id in this.tracks) {
-            let pc = this.tracks[track_id]["listen_count"]
-            let play_time = this.tracks[track_id]["listen_time"]
-            let song_name = this.tracks[track_id]["song_name"]
+        let track_stats = (rollup && rollup["tracks"]) || {}
+        for (let track_id in track_stats) {
+            let pc = track_stats[track_id]["listen_count"]
+            let play_time = track_stats[track_id]["listen_time"]
+            let song_name = this.song_names[track_id]
             if (pc > highest_pc) {
                 highest_pc = pc;
                 highest_pc_song = song_name;
@@ -439,19 +436,19 @@ export class ArtistsComponent implements OnInit {
         let most_time_info = this.transform_time(highest_time)
         this.most_time = most_time_info[0] + " " + most_time_info[1]
 
-        for (let track_id in this.tracks) {
-            for (let listen_idx in this.tracks[track_id]["listens"]) {
-                let listen_year = this.tracks[track_id]["listens"][listen_idx]["year"]
-                let listen_month = this.tracks[track_id]["listens"][listen_idx]["month"] + "/" + listen_year;
-                let ms_played = this.tracks[track_id]["listens"][listen_idx]["duration"]
-                year_counts[listen_year] += 1;
-                year_times[listen_year] += ms_played
+        let month_songs = (rollup && rollup["month_songs"]) || {}
+        rollup_months(rollup).forEach(month_stats => {
+            let listen_year = month_stats["year"]
+            let listen_month = month_stats["month"] + "/" + listen_year;
+            year_counts[listen_year] += month_stats["listen_count"];
+            year_times[listen_year] += month_stats["listen_time"]
+            month_counts[listen_month] += month_stats["listen_count"];
+            month_times[listen_month] += month_stats["listen_time"];
+            (month_songs[month_stats["key"]] || []).forEach(track_id => {
                 year_unique_songs[listen_year].add(track_id)
-                month_counts[listen_month] += 1;
-                month_times[listen_month] += ms_played;
                 month_unique_songs[listen_month].add(track_id)
-            }
-        }
+            });
+        });
         // YEARS
         var year_count_data = []
         var year_time_data = []
@@ -0,0 +1,17 @@
+// Reads the rollup documents kept for each song and artist, see SONG_ROLLUPS in python/firebase.py
+
+// Gets the listen_count and listen_time of each month of a rollup, with the month and year of its "YYYYMM" key
+export function rollup_months(rollup) {
+    let months = [];
+    let month_stats = (rollup && rollup["month"]) || {};
+    for (let key in month_stats) {
+        months.push({
+            "key": key,
+            "year": parseInt(key.slice(0, 4)),
+            "month": parseInt(key.slice(4)),
+            "listen_count": month_stats[key]["listen_count"],
+            "listen_time": month_stats[key]["listen_time"]
+        });
+    }
+    return months;
+}
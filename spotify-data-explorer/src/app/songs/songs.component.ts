@@ -3,6 +3,8 @@ import { ActivatedRoute, Params } from '@angular/router';
 import { AngularFirestore, AngularFirestoreDocument } from '@angular/fire/firestore';
 import { Router } from '@angular/router';
 import { Chart } from 'chart.js';
+import { combineLatest } from 'rxjs';
+import { rollup_months } from '../rollups';
 
 const MONTHS = ["January", "February", "March", "April", "May", "June", "July", "August", "September", "October", "November", "December"]
 
@@ -81,10 +83,11 @@ export class SongsComponent implements OnInit {
             this.song_id = params["id"]
         })
 
-        // Subscribe to song
+        // Subscribe to song and to its rollup of listens per month
         this.song_doc = this.afs.doc<Item>('songs/' + this.song_id);
         this.song_item = this.song_doc.valueChanges();
-        this.song_item.subscribe(val => this.populate_info(val))
+        let song_rollup = this.afs.doc<Item>('song_rollups/' + this.song_id).valueChanges();
+        combineLatest([this.song_item, song_rollup]).subscribe(([val, rollup]) => this.populate_info(val, rollup))
 
         // Init graph
         let canvas = <HTMLCanvasElement>document.getElementById('canvas');
@@ -141,7 +144,7 @@ export class SongsComponent implements OnInit {
     }
 
     // Fill in stats about the song
-    populate_info(val) {
+    populate_info(val, rollup) {
         this.song_name = val["song_name"]
         this.artist_name = val["artist_name"]
         this.listen_count = val["listen_count"]
@@ -152,24 +155,23 @@ export class SongsComponent implements OnInit {
         this.first_song_date = MONTHS[flt["month"] - 1] + " " + flt["day"] + ", " + flt["year"]
         let llt = val["last_listen"]
         this.last_song_date = MONTHS[llt["month"] - 1] + " " + llt["day"] + ", " + llt["year"]
-        this.set_chart_data(val)
+        this.set_chart_data(rollup)
     }
 
     // Calculate data for graph
-    set_chart_data(val) {
+    set_chart_data(rollup) {
         var year_counts = { 2015: 0, 2016: 0, 2017: 0, 2018: 0, 2019: 0, 2020: 0, 2021: 0, 2022: 0 };
         var year_times = { 2015: 0, 2016: 0, 2017: 0, 2018: 0, 2019: 0, 2020: 0, 2021: 0, 2022: 0 };
         var month_counts = { '10/2015': 0, '11/2015': 0, '12/2015': 0, '1/2016': 0, '2/2016': 0, '3/2016': 0, '4/2016': 0, '5/2016': 0, '6/2016': 0, '7/2016': 0, '8/2016': 0, '9/2016': 0, '10/2016': 0, '11/2016': 0, '12/2016': 0, '1/2017': 0, '2/2017': 0, '3/2017': 0, '4/2017': 0, '5/2017': 0, '6/2017': 0, '7/2017': 0, '8/2017': 0, '9/2017': 0, '10/2017': 0, '11/2017': 0, '12/2017': 0, '1/2018': 0, '2/2018': 0, '3/2018': 0, '4/2018': 0, '5/2018': 0, '6/2018': 0, '7/2018': 0, '8/2018': 0, '9/2018': 0, '10/2018': 0, '11/2018': 0, '12/2018': 0, '1/2019': 0, '2/2019': 0, '3/2019': 0, '4/2019': 0, '5/2019': 0, '6/2019': 0, '7/2019': 0, '8/2019': 0, '9/2019': 0, '10/2019': 0, '11/2019': 0, '12/2019': 0, '1/2020': 0, '2/2020': 0, '3/2020': 0, '4/2020': 0, '5/2020': 0, '6/2020': 0, '7/2020': 0, '8/2020': 0, '9/2020': 0, '10/2020': 0, '11/2020': 0, '12/2020': 0, '1/2021': 0, '2/2021': 0, '3/2021': 0, '4/2021': 0, '5/2021': 0, '6/2021': 0, '7/2021': 0, '8/2021': 0, '9/2021': 0, '10/2021': 0, '11/2021': 0, '12/2021': 0, '1/2022': 0, '2/2022': 0, '3/2022': 0, '4/2022': 0, '5/2022': 0, '6/2022': 0, '7/2022': 0, '8/2022': 0, '9/2022': 0, '10/2022': 0, '11/2022': 0, '12/2022': 0 };
         var month_times = { '10/2015': 0, '11/2015': 0, '12/2015': 0, '1/2016': 0, '2/2016': 0, '3/2016': 0, '4/2016': 0, '5/2016': 0, '6/2016': 0, '7/2016': 0, '8/2016': 0, '9/2016': 0, '10/2016': 0, '11/2016': 0, '12/2016': 0, '1/2017': 0, '2/2017': 0, '3/2017': 0, '4/2017': 0, '5/2017': 0, '6/2017': 0, '7/2017': 0, '8/2017': 0, '9/2017': 0, '10/2017': 0, '11/2017': 0, '12/2017': 0, '1/2018': 0, '2/2018': 0, '3/2018': 0, '4/2018': 0, '5/2018': 0, '6/2018': 0, '7/2018': 0, '8/2018': 0, '9/2018': 0, '10/2018': 0, '11/2018': 0, '12/2018': 0, '1/2019': 0, '2/2019': 0, '3/2019': 0, '4/2019': 0, '5/2019': 0, '6/2019': 0, '7/2019': 0, '8/2019': 0, '9/2019': 0, '10/2019': 0, '11/2019': 0, '12/2019': 0, '1/2020': 0, '2/2020': 0, '3/2020': 0, '4/2020': 0, '5/2020': 0, '6/2020': 0, '7/2020': 0, '8/2020': 0, '9/2020': 0, '10/2020': 0, '11/2020': 0, '12/2020': 0, '1/2021': 0, '2/2021': 0, '3/2021': 0, '4/2021': 0, '5/2021': 0, '6/2021': 0, '7/2021': 0, '8/2021': 0, '9/2021': 0, '10/2021': 0, '11/2021': 0, '12/2021': 0, '1/2022': 0, '2/2022': 0, '3/2022': 0, '4/2022': 0, '5/2022': 0, '6/2022': 0, '7/2022': 0, '8/2022': 0, '9/2022': 0, '10/2022': 0, '11/2022': 0, '12/2022': 0 };
-        for (let listen_idx in val["listens"]) {
-            let listen_year = val["listens"][listen_idx]["year"]
-            let listen_month = val["listens"][listen_idx]["month"] + "/" + listen_year;
-            let ms_played = val["listens"][listen_idx]["duration"]
-            year_counts[listen_year] += 1;
-            year_times[listen_year] += ms_played
-            month_counts[listen_month] += 1;
-            month_times[listen_month] += ms_played;
-        }
+        rollup_months(rollup).forEach(month_stats => {
+            let listen_year = month_stats["year"]
+            let listen_month = month_stats["month"] + "/" + listen_year;
+            year_counts[listen_year] += month_stats["listen_count"];
+            year_times[listen_year] += month_stats["listen_time"]
+            month_counts[listen_month] += month_stats["listen_count"];
+            month_times[listen_month] += month_stats["listen_time"];
+        });
 
         // Calculate year values
         var year_count_data = []